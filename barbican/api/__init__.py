@@ -18,9 +18,14 @@ API handler for Cloudkeep's Barbican
 """
 
 import falcon
+from barbican.common import exception
 from barbican.openstack.common import jsonutils as json
 
 
+# Size of the chunks request bodies are read in.
+STREAM_CHUNK_SIZE = 65536
+
+
 class ApiResource(object):
     """
     Base class for API resources
@@ -36,6 +41,32 @@ def abort(status=falcon.HTTP_500, message=None):
     raise falcon.HTTPError(status, message)
 
 
+class PolicyCredentials(object):
+    """
+    The roles, user and tenant of the caller of a request, as verified and
+    passed on by Keystone's auth_token middleware, for policy checks.
+    """
+
+    def __init__(self, req):
+        roles = req.get_header('X-Roles') or ''
+        self.roles = [role.strip() for role in roles.split(',')
+                      if role.strip()]
+        self.user = req.get_header('X-User-Id')
+        self.tenant = req.get_header('X-Tenant-Id')
+
+
+def enforce_policy(req, policy_enforcer, action, target=None):
+    """
+    Helper function for aborting, with a 403, a request whose caller the
+    policy does not allow to perform action.
+    """
+    try:
+        policy_enforcer.enforce(PolicyCredentials(req), action,
+                                target or {})
+    except exception.Forbidden:
+        abort(falcon.HTTP_403, 'Forbidden')
+
+
 def load_body(req):
     """
     Helper function for loading an HTTP request body from JSON into a
@@ -54,3 +85,58 @@ def load_body(req):
         abort(falcon.HTTP_400, 'Malformed JSON')
 
     return parsed_body
+
+
+def check_content_length(req, max_bytes):
+    """
+    Helper function for rejecting, with a 413, a request that declares a
+    Content-Length larger than max_bytes. Returns the Content-Length.
+    """
+    content_length = req.content_length
+    if content_length is not None and content_length > max_bytes:
+        _request_too_large(max_bytes)
+    return content_length
+
+
+def load_stream(req, max_bytes):
+    """
+    Helper function for reading a raw HTTP request body of at most
+    max_bytes, aborting with a 413 if it is larger.
+
+    Requests declaring an oversized Content-Length are rejected before
+    anything is read. Otherwise the body is read in bounded chunks, never
+    past the declared Content-Length, so at most max_bytes is ever
+    buffered for a single request.
+    """
+    content_length = check_content_length(req, max_bytes)
+
+    # Without a Content-Length, read one byte past the limit to detect
+    #   oversized bodies.
+    if content_length is None:
+        remaining = max_bytes + 1
+    else:
+        remaining = content_length
+
+    chunks = []
+    read_bytes = 0
+    try:
+        while remaining > 0:
+            chunk = req.stream.read(min(STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            read_bytes += len(chunk)
+            remaining -= len(chunk)
+    except IOError:
+        abort(falcon.HTTP_500, 'Read Error')
+
+    if read_bytes > max_bytes:
+        _request_too_large(max_bytes)
+
+    return ''.join(chunks)
+
+
+def _request_too_large(max_bytes):
+    """Throw exception indicating the request body is too large."""
+    abort(falcon.HTTP_413, 'Request body exceeds the maximum of '
+                           '{0} bytes'.format(max_bytes))
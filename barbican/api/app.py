@@ -19,8 +19,10 @@ API application handler for Cloudkeep's Barbican
 
 import falcon
 
-from barbican.api.resources import (VersionResource,
-                                    SecretsResource, SecretResource,
+from barbican.api.resources import (VersionResource, DatabasePoolResource,
+                                    TenantUsageResource,
+                                    SecretsResource, SecretsBatchResource,
+                                    SecretResource,
                                     OrdersResource, OrderResource)
 from barbican.common import config
 from barbican.crypto.extension_manager import CryptoExtensionManager
@@ -41,16 +43,25 @@ def create_main_app(global_config, **local_conf):
 
     # Resources
     VERSIONS = VersionResource()
+    DB_POOL = DatabasePoolResource()
+    USAGE = TenantUsageResource()
     SECRETS = SecretsResource(crypto_mgr)
+    SECRETS_BATCH = SecretsBatchResource(crypto_mgr)
     SECRET = SecretResource(crypto_mgr)
     ORDERS = OrdersResource()
     ORDER = OrderResource()
 
     wsgi_app = api = falcon.API()
     api.add_route('/', VERSIONS)
+    api.add_route('/v1/admin/db-pool', DB_POOL)
+    api.add_route('/v1/admin/usage/{keystone_id}', USAGE)
     api.add_route('/v1/{tenant_id}/secrets', SECRETS)
+    # Note: Must precede the single secret route, which would match it too.
+    api.add_route('/v1/{tenant_id}/secrets/batch', SECRETS_BATCH)
     api.add_route('/v1/{tenant_id}/secrets/{secret_id}', SECRET)
     api.add_route('/v1/{tenant_id}/orders', ORDERS)
     api.add_route('/v1/{tenant_id}/orders/{order_id}', ORDER)
 
+    # Note: Periodic tasks are run by a separate barbican-periodic-worker
+    #   (or celery beat) process, as uWSGI may fork its workers after this.
     return wsgi_app
@@ -0,0 +1,81 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Middleware that gives each request a single database session and
+transaction, shared by all of the repositories the request uses.
+"""
+
+import webob.dec
+import webob.exc
+
+from barbican.api.middleware import Middleware
+from barbican.common import exception
+from barbican.common import utils
+from barbican.model import repositories
+
+LOG = utils.getLogger(__name__)
+
+
+class RequestSessionFilter(Middleware):
+    """
+    Begins a request-scoped session before passing the request on, and
+    commits it once the response is ready. The transaction is rolled back
+    instead if the application raises or returns a server error.
+
+    The session is tagged with the tenant in the request's path, so that
+    the tenant's reads follow its writes to the primary database.
+
+    While the database is unreachable, requests fail fast with a 503.
+    """
+
+    def __init__(self, app):
+        super(RequestSessionFilter, self).__init__(app)
+
+    @webob.dec.wsgify
+    def __call__(self, req):
+        try:
+            return self._call_in_session(req)
+        except exception.ServiceUnavailable as e:
+            LOG.warn("Database unavailable, failing request fast")
+            response = webob.exc.HTTPServiceUnavailable()
+            if e.retry_after:
+                response.retry_after = e.retry_after
+            return response
+
+    def _call_in_session(self, req):
+        session = repositories.begin_request_session(
+            client_id=self._get_tenant_id(req))
+        commit = False
+        try:
+            response = req.get_response(self.application)
+            commit = response.status_int < 500
+            return response
+        finally:
+            if not commit:
+                LOG.debug("Rolling back request session")
+            repositories.end_request_session(session, commit=commit)
+
+    def _get_tenant_id(self, req):
+        """
+        Return the tenant ID from a /v1/{tenant_id}/... path, or from a
+        /v1/admin/{resource}/{tenant_id} path, if any.
+        """
+        parts = req.path_info.strip('/').split('/')
+        if len(parts) < 2 or parts[0] != 'v1':
+            return None
+        if parts[1] == 'admin':
+            return parts[3] if len(parts) > 3 else None
+        return parts[1]
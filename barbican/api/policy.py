@@ -41,6 +41,9 @@ CONF.register_opts(policy_opts)
 
 DEFAULT_RULES = {
     'default': policy.TrueCheck(),
+    'admin': policy.parse_rule('role:admin'),
+    'admin:db_pool:get': policy.parse_rule('rule:admin'),
+    'admin:usage:get': policy.parse_rule('rule:admin'),
 }
 
 
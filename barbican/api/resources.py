@@ -17,27 +17,66 @@
 API-facing resource controllers.
 """
 
+import base64
+import calendar
+import contextlib
+import datetime
+import email.utils
+import hashlib
+
 import falcon
+from oslo.config import cfg
 
-from barbican.api import abort, ApiResource, load_body, policy
+from barbican.api import (abort, ApiResource, check_content_length,
+                          enforce_policy, load_body, load_stream, policy)
+from barbican.api import serializers
+from barbican.api.serializers import OrderSerializer, SecretSerializer
 from barbican.common.resources import (create_secret,
+                                       create_secrets,
                                        create_encrypted_datum,
-                                       get_or_create_tenant)
+                                       get_idempotent_response,
+                                       get_or_create_tenant,
+                                       release_idempotency_key,
+                                       reserve_idempotency_key,
+                                       store_idempotent_response)
+from barbican.common import exception
 from barbican.common import utils
-from barbican.crypto.mime_types import augment_fields_with_content_types
 from barbican.model.models import (Tenant, Secret, TenantSecret,
                                    EncryptedDatum, Order, States)
 from barbican.model.repositories import (TenantRepo, SecretRepo,
                                          OrderRepo, TenantSecretRepo,
-                                         EncryptedDatumRepo)
+                                         EncryptedDatumRepo,
+                                         IdempotencyKeyRepo,
+                                         TenantUsageRepo,
+                                         commit_request_session,
+                                         get_pool_stats)
+from barbican.openstack.common import excutils
 from barbican.openstack.common.gettextutils import _
 from barbican.openstack.common import jsonutils as json
+from barbican.openstack.common import timeutils
 from barbican.queue import get_queue_api
 from barbican.version import __version__
 
 
 LOG = utils.getLogger(__name__)
 
+api_opts = [
+    cfg.IntOpt('default_limit_paging', default=10,
+               help=_('Number of entities returned per page by default')),
+    cfg.IntOpt('max_limit_paging', default=100,
+               help=_('Maximum number of entities returned per page')),
+    cfg.IntOpt('max_allowed_secret_in_bytes', default=1048576,
+               help=_('Maximum size of a secret payload upload in bytes')),
+    cfg.IntOpt('max_secrets_per_batch', default=100,
+               help=_('Maximum number of secrets created or retrieved per '
+                      'batch request')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(api_opts)
+
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
 
 def _secret_not_found():
     """Throw exception indicating secret not found."""
@@ -80,9 +119,34 @@ def _secret_not_in_order():
     abort(falcon.HTTP_400, _("Secret metadata expected but not received."))
 
 
-def json_handler(obj):
-    """Convert objects into json-friendly equivalents."""
-    return obj.isoformat() if hasattr(obj, 'isoformat') else obj
+def _invalid_secret_batch():
+    """
+    Throw exception that the batch of secret definitions is malformed.
+    """
+    abort(falcon.HTTP_400, _("Expected a list of up to {0} secrets, each "
+                             "with a name and mime_type.").format(
+                                 CONF.max_secrets_per_batch))
+
+
+def _invalid_secret_batch_item(e):
+    """
+    Throw exception that one of the batch's secrets could not be created.
+    """
+    abort(falcon.HTTP_400, str(e))
+
+
+def _invalid_secret_ids():
+    """
+    Throw exception that the list of secret IDs to retrieve is malformed.
+    """
+    abort(falcon.HTTP_400, _("Expected 'ids' to list up to {0} "
+                             "comma-separated secret IDs.").format(
+                                 CONF.max_secrets_per_batch))
+
+
+def _invalid_paging_param(name):
+    """Throw exception indicating a paging parameter is malformed."""
+    abort(falcon.HTTP_400, _("Invalid paging parameter '{0}'.").format(name))
 
 
 def convert_secret_to_href(tenant_id, secret_id):
@@ -103,13 +167,110 @@ def convert_order_to_href(tenant_id, order_id):
     return utils.hostname_for_refs(tenant_id=tenant_id, resource=resource)
 
 
-def convert_to_hrefs(tenant_id, fields):
-    """Convert id's within a fields dict to HATEOS-style hrefs"""
-    if 'secret_id' in fields:
-        fields['secret_ref'] = convert_secret_to_href(tenant_id,
-                                                      fields['secret_id'])
-        del fields['secret_id']
-    return fields
+def encode_paging_cursor(marker):
+    """Convert a (created_at, id) paging marker into an opaque cursor"""
+    created_at, entity_id = marker
+    raw = '{0}|{1}'.format(timeutils.strtime(created_at), entity_id)
+    return base64.urlsafe_b64encode(raw)
+
+
+def decode_paging_cursor(cursor):
+    """
+    Convert an opaque cursor back into a (created_at, id) paging marker.
+
+    :raises ValueError if the cursor is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(str(cursor))
+    except TypeError:
+        raise ValueError('Malformed paging cursor.')
+    created_at, sep, entity_id = raw.partition('|')
+    if not sep or not entity_id:
+        raise ValueError('Malformed paging cursor.')
+    return timeutils.parse_strtime(created_at), entity_id
+
+
+def _get_paging_limit(req):
+    """Return the requested page size, clamped to the configured maximum."""
+    limit = req.get_param('limit')
+    if limit is None:
+        return CONF.default_limit_paging
+    try:
+        limit = int(limit)
+    except ValueError:
+        _invalid_paging_param('limit')
+    if limit < 1:
+        _invalid_paging_param('limit')
+    return min(limit, CONF.max_limit_paging)
+
+
+def _get_paging_marker(req, name):
+    """Return the paging marker for the named cursor parameter, if any."""
+    cursor = req.get_param(name)
+    if not cursor:
+        return None
+    try:
+        return decode_paging_cursor(cursor)
+    except ValueError:
+        _invalid_paging_param(name)
+
+
+def entity_etag(entity_id, last_modified):
+    """Build a strong ETag from an entity's ID and last-modified time"""
+    raw = '{0}|{1}'.format(entity_id, timeutils.strtime(last_modified))
+    return '"{0}"'.format(hashlib.sha1(raw).hexdigest())
+
+
+def _set_cache_validators(resp, entity_id, last_modified):
+    """Set the ETag and Last-Modified headers for a response, if known."""
+    if not last_modified:
+        return
+    resp.set_header('ETag', entity_etag(entity_id, last_modified))
+    resp.set_header('Last-Modified', email.utils.formatdate(
+        calendar.timegm(last_modified.utctimetuple()), usegmt=True))
+
+
+def _is_not_modified(req, etag, last_modified):
+    """
+    Return True if the client's conditional request headers show that its
+    cached copy of the entity is still current.
+    """
+    if req.if_none_match:
+        tags = [tag.strip() for tag in req.if_none_match.split(',')]
+        return '*' in tags or etag in tags
+
+    if req.if_modified_since:
+        since = email.utils.parsedate(req.if_modified_since)
+        if since:
+            since = datetime.datetime(*since[:6])
+            return last_modified.replace(microsecond=0) <= since
+
+    return False
+
+
+def check_not_modified(req, resp, repo, entity_id):
+    """
+    Answer a conditional GET with a 304 if the entity is unchanged.
+
+    Only the entity's timestamps are queried, and only when the request
+    carries If-None-Match or If-Modified-Since headers.
+
+    :returns: True if a 304 response was prepared and no body is needed.
+    """
+    if not req.if_none_match and not req.if_modified_since:
+        return False
+
+    last_modified = repo.get_last_modified(entity_id)
+    if not last_modified:
+        return False
+
+    etag = entity_etag(entity_id, last_modified)
+    if not _is_not_modified(req, etag, last_modified):
+        return False
+
+    resp.status = falcon.HTTP_304
+    _set_cache_validators(resp, entity_id, last_modified)
+    return True
 
 
 class VersionResource(ApiResource):
@@ -125,73 +286,328 @@ class VersionResource(ApiResource):
                                 'build': __version__})
 
 
+class DatabasePoolResource(ApiResource):
+    """Returns this process's database connection pool counters"""
+
+    def __init__(self, policy_enforcer=None):
+        self.policy = policy_enforcer or policy.Enforcer()
+
+    def on_get(self, req, resp):
+        enforce_policy(req, self.policy, 'admin:db_pool:get')
+
+        resp.status = falcon.HTTP_200
+        resp.set_header('Content-Type', 'application/json')
+        resp.body = json.dumps({'db_pool': get_pool_stats()})
+
+
+class TenantUsageResource(ApiResource):
+    """Returns a tenant's counts of live secrets and orders"""
+
+    def __init__(self, usage_repo=None, policy_enforcer=None):
+        self.usage_repo = usage_repo or TenantUsageRepo()
+        self.policy = policy_enforcer or policy.Enforcer()
+
+    def on_get(self, req, resp, keystone_id):
+        enforce_policy(req, self.policy, 'admin:usage:get')
+
+        usage = self.usage_repo.find_by_keystone_id(keystone_id)
+
+        resp.status = falcon.HTTP_200
+        resp.set_header('Content-Type', 'application/json')
+        resp.body = json.dumps({'tenant_id': keystone_id,
+                                'secrets': usage.secrets if usage else 0,
+                                'orders': usage.orders if usage else 0})
+
+
+def _invalid_idempotency_key():
+    """
+    Throw exception that the Idempotency-Key header is malformed.
+    """
+    abort(falcon.HTTP_400, _("Idempotency-Key must be at most {0} "
+                             "characters.").format(
+                                 MAX_IDEMPOTENCY_KEY_LENGTH))
+
+
+def _get_idempotency_key(req):
+    """Return the request's Idempotency-Key header value, if any."""
+    key = req.get_header('Idempotency-Key')
+    if key and len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        _invalid_idempotency_key()
+    return key
+
+
+def _idempotency_key_in_use():
+    """
+    Throw exception that a request made with the same Idempotency-Key is
+    still in progress.
+    """
+    abort(falcon.HTTP_409, _("A request made with this Idempotency-Key is "
+                             "still in progress."))
+
+
+def replay_idempotent_response(resp, keystone_id, resource, key, repo):
+    """
+    Answer a retried create request with the response to the original
+    request made with the same Idempotency-Key, if there was one.
+
+    Otherwise the key is reserved for this request, which must then store
+    its response, or release the key if it fails (see
+    releasing_idempotency_key()). Retries made while the original request
+    is still in progress are rejected with a 409.
+
+    :retval True if the response was replayed
+    """
+    if not key:
+        return False
+
+    response = get_idempotent_response(keystone_id, resource, key, repo)
+    if not response:
+        if reserve_idempotency_key(keystone_id, resource, key, repo):
+            return False
+        # Another request holds the key, and may have just completed.
+        response = get_idempotent_response(keystone_id, resource, key, repo)
+        if not response:
+            _idempotency_key_in_use()
+
+    LOG.debug('Replaying response for Idempotency-Key {0}'.format(key))
+    location, body = response
+    resp.status = falcon.HTTP_202
+    resp.set_header('Location', location)
+    resp.body = body
+    return True
+
+
+@contextlib.contextmanager
+def releasing_idempotency_key(keystone_id, resource, key, repo):
+    """
+    Release the Idempotency-Key reserved by replay_idempotent_response()
+    if the request fails, so that the client may retry it.
+    """
+    try:
+        yield
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            if key:
+                release_idempotency_key(keystone_id, resource, key, repo)
+
+
 class SecretsResource(ApiResource):
-    """Handles Secret creation requests."""
+    """Handles Secret creation and listing requests."""
 
     def __init__(self, crypto_manager, policy_enforcer=None,
                  tenant_repo=None, secret_repo=None,
-                 tenant_secret_repo=None, datum_repo=None):
+                 tenant_secret_repo=None, datum_repo=None,
+                 idempotency_repo=None):
         LOG.debug('Creating SecretsResource')
         self.tenant_repo = tenant_repo or TenantRepo()
         self.secret_repo = secret_repo or SecretRepo()
         self.tenant_secret_repo = tenant_secret_repo or TenantSecretRepo()
         self.datum_repo = datum_repo or EncryptedDatumRepo()
+        self.idempotency_repo = idempotency_repo or IdempotencyKeyRepo()
         self.crypto_manager = crypto_manager
         self.policy = policy_enforcer or policy.Enforcer()
 
     def on_post(self, req, resp, tenant_id):
         LOG.debug('Start on_post for tenant-ID {0}:'.format(tenant_id))
 
+        idempotency_key = _get_idempotency_key(req)
+        if replay_idempotent_response(resp, tenant_id, 'secrets',
+                                      idempotency_key,
+                                      self.idempotency_repo):
+            return
+
+        with releasing_idempotency_key(tenant_id, 'secrets',
+                                       idempotency_key,
+                                       self.idempotency_repo):
+            data = load_body(req)
+            tenant = get_or_create_tenant(tenant_id, self.tenant_repo)
+
+            new_secret = create_secret(data, tenant, self.crypto_manager,
+                                       self.secret_repo,
+                                       self.tenant_secret_repo,
+                                       self.datum_repo)
+
+            location = '/{0}/secrets/{1}'.format(tenant_id, new_secret.id)
+            url = convert_secret_to_href(tenant_id, new_secret.id)
+            LOG.debug('URI to secret is {0}'.format(url))
+            body = json.dumps({'secret_ref': url})
+
+            if idempotency_key:
+                store_idempotent_response(tenant_id, 'secrets',
+                                          idempotency_key, location, body,
+                                          self.idempotency_repo)
+
+        resp.status = falcon.HTTP_202
+        resp.set_header('Location', location)
+        resp.body = body
+
+    def on_get(self, req, resp, tenant_id):
+        LOG.debug('Start secrets on_get for tenant-ID {0}:'.format(tenant_id))
+
+        limit = _get_paging_limit(req)
+        after = _get_paging_marker(req, 'next')
+        before = None if after else _get_paging_marker(req, 'previous')
+
+        rows, more = self.secret_repo.get_by_create_date(tenant_id, limit,
+                                                         after=after,
+                                                         before=before)
+
+        serializer = SecretSerializer(tenant_id)
+        body = {'secrets': [serializer.to_dict(secret)
+                            for secret, marker in rows]}
+
+        # Paging backwards always leaves a next page behind us, and paging
+        # forwards from a cursor always leaves a previous page.
+        if before:
+            has_next, has_previous = True, more
+        else:
+            has_next, has_previous = more, after is not None
+        if rows and has_next:
+            body['next'] = self._paging_href(tenant_id, limit, 'next',
+                                             rows[-1][1])
+        if rows and has_previous:
+            body['previous'] = self._paging_href(tenant_id, limit,
+                                                 'previous', rows[0][1])
+
+        resp.status = falcon.HTTP_200
+        resp.set_header('Content-Type', 'application/json')
+        resp.body = serializers.dumps(body)
+
+    def _paging_href(self, tenant_id, limit, direction, marker):
+        """Build the HATEOS-style href for an adjacent page of secrets."""
+        resource = 'secrets?limit={0}&{1}={2}'.format(
+            limit, direction, encode_paging_cursor(marker))
+        return utils.hostname_for_refs(tenant_id=tenant_id,
+                                       resource=resource)
+
+
+class SecretsBatchResource(ApiResource):
+    """Handles bulk Secret creation and retrieval requests."""
+
+    def __init__(self, crypto_manager, policy_enforcer=None,
+                 tenant_repo=None, secret_repo=None,
+                 tenant_secret_repo=None, datum_repo=None):
+        LOG.debug('Creating SecretsBatchResource')
+        self.tenant_repo = tenant_repo or TenantRepo()
+        self.secret_repo = secret_repo or SecretRepo()
+        self.tenant_secret_repo = tenant_secret_repo or TenantSecretRepo()
+        self.datum_repo = datum_repo or EncryptedDatumRepo()
+        self.crypto_manager = crypto_manager
+        self.policy = policy_enforcer or policy.Enforcer()
+
+    def on_post(self, req, resp, tenant_id):
+        LOG.debug('Start batch on_post for tenant-ID {0}:'.format(tenant_id))
+
         data = load_body(req)
+        data_list = data.get('secrets') if isinstance(data, dict) else None
+        if not data_list or not isinstance(data_list, list) \
+                or len(data_list) > CONF.max_secrets_per_batch:
+            _invalid_secret_batch()
+        for secret_data in data_list:
+            if not isinstance(secret_data, dict) or 'name' not in secret_data \
+                    or 'mime_type' not in secret_data:
+                _invalid_secret_batch()
+
         tenant = get_or_create_tenant(tenant_id, self.tenant_repo)
 
-        new_secret = create_secret(data, tenant, self.crypto_manager,
-                                   self.secret_repo, self.tenant_secret_repo,
-                                   self.datum_repo)
+        try:
+            new_secrets = create_secrets(data_list, tenant,
+                                         self.crypto_manager,
+                                         self.secret_repo,
+                                         self.tenant_secret_repo,
+                                         self.datum_repo)
+        except exception.InvalidSecretBatchItem as e:
+            LOG.error(str(e))
+            _invalid_secret_batch_item(e)
 
         resp.status = falcon.HTTP_202
-        resp.set_header('Location', '/{0}/secrets/{1}'.format(tenant_id,
-                                                              new_secret.id))
-        url = convert_secret_to_href(tenant_id, new_secret.id)
-        LOG.debug('URI to secret is {0}'.format(url))
-        resp.body = json.dumps({'secret_ref': url})
+        resp.body = json.dumps({'secret_refs': [
+            convert_secret_to_href(tenant_id, new_secret.id)
+            for new_secret in new_secrets]})
+
+    def on_get(self, req, resp, tenant_id):
+        LOG.debug('Start batch on_get for tenant-ID {0}:'.format(tenant_id))
+
+        # Drop blanks and duplicates, but answer in the order requested.
+        secret_ids = []
+        for secret_id in (req.get_param('ids') or '').split(','):
+            secret_id = secret_id.strip()
+            if secret_id and secret_id not in secret_ids:
+                secret_ids.append(secret_id)
+        if not secret_ids or len(secret_ids) > CONF.max_secrets_per_batch:
+            _invalid_secret_ids()
+
+        found = self.secret_repo.get_by_ids(tenant_id, secret_ids)
+
+        serializer = SecretSerializer(tenant_id)
+        secrets = []
+        for secret_id in secret_ids:
+            if secret_id in found:
+                secrets.append(serializer.to_dict(found[secret_id]))
+            else:
+                secrets.append({'not_found': True,
+                                'secret_ref':
+                                serializer.secret_ref(secret_id)})
+
+        resp.status = falcon.HTTP_200
+        resp.set_header('Content-Type', 'application/json')
+        resp.body = serializers.dumps({'secrets': secrets})
 
 
 class SecretResource(ApiResource):
     """Handles Secret retrieval and deletion requests"""
 
     def __init__(self, crypto_manager, policy_enforcer=None,
-                 tenant_repo=None, secret_repo=None,
-                 tenant_secret_repo=None, datum_repo=None):
+                 tenant_repo=None, secret_repo=None, datum_repo=None):
         self.crypto_manager = crypto_manager
         self.tenant_repo = tenant_repo or TenantRepo()
         self.repo = secret_repo or SecretRepo()
-        self.tenant_secret_repo = tenant_secret_repo or TenantSecretRepo()
         self.datum_repo = datum_repo or EncryptedDatumRepo()
         self.policy = policy_enforcer or policy.Enforcer()
 
     def on_get(self, req, resp, tenant_id, secret_id):
 
-        secret = self.repo.get(entity_id=secret_id, suppress_exception=True)
+        metadata_only = not req.accept or req.accept == 'application/json'
+        if metadata_only and check_not_modified(req, resp, self.repo,
+                                                secret_id):
+            return
+
+        if metadata_only:
+            secret = self.repo.get(entity_id=secret_id,
+                                   suppress_exception=True)
+        else:
+            secret = self.repo.get_with_payload(entity_id=secret_id,
+                                                suppress_exception=True)
         if not secret:
             _secret_not_found()
 
         resp.status = falcon.HTTP_200
 
-        if not req.accept or req.accept == 'application/json':
+        if metadata_only:
             # Metadata-only response, no decryption necessary.
+            _set_cache_validators(resp, secret.id, secret.last_modified())
             resp.set_header('Content-Type', 'application/json')
-            resp.body = json.dumps(augment_fields_with_content_types(secret),
-                                   default=json_handler)
+            resp.body = SecretSerializer(tenant_id).to_json(secret,
+                                                            include_ref=False)
         else:
             tenant = get_or_create_tenant(tenant_id, self.tenant_repo)
             resp.set_header('Content-Type', req.accept)
-            resp.body = self.crypto_manager.decrypt(req.accept, secret, tenant)
+            plain_text = self.crypto_manager.decrypt(req.accept, secret,
+                                                     tenant)
+
+            # Plugins may hand back large secrets as an iterator of chunks,
+            #   which are streamed out rather than buffered here.
+            if isinstance(plain_text, basestring):
+                resp.body = plain_text
+            else:
+                resp.stream = plain_text
 
     def on_put(self, req, resp, tenant_id, secret_id):
 
         if not req.content_type or req.content_type == 'application/json':
             _put_accept_incorrect(req.content_type)
+        # Reject oversized payloads before touching the database.
+        check_content_length(req, CONF.max_allowed_secret_in_bytes)
 
         secret = self.repo.get(entity_id=secret_id, suppress_exception=True)
         if not secret:
@@ -201,19 +617,17 @@ class SecretResource(ApiResource):
         if secret.encrypted_data:
             _secret_already_has_data()
 
-        try:
-            plain_text = req.stream.read()
-        except IOError:
-            abort(falcon.HTTP_500, 'Read Error')
+        plain_text = load_stream(req, CONF.max_allowed_secret_in_bytes)
+
+        tenant = get_or_create_tenant(tenant_id, self.tenant_repo)
 
         resp.status = falcon.HTTP_200
 
         try:
             create_encrypted_datum(secret,
                                    plain_text,
-                                   tenant_id,
+                                   tenant,
                                    self.crypto_manager,
-                                   self.tenant_secret_repo,
                                    self.datum_repo)
         except ValueError:
             LOG.error('Problem creating an encrypted datum for the secret.',
@@ -221,9 +635,7 @@ class SecretResource(ApiResource):
             _failed_to_create_encrypted_datum()
 
     def on_delete(self, req, resp, tenant_id, secret_id):
-        secret = self.repo.get(entity_id=secret_id)
-
-        self.repo.delete_entity(secret)
+        self.repo.delete_entity_by_id(entity_id=secret_id)
 
         resp.status = falcon.HTTP_200
 
@@ -232,24 +644,51 @@ class OrdersResource(ApiResource):
     """Handles Order requests for Secret creation"""
 
     def __init__(self, tenant_repo=None, order_repo=None,
-                 queue_resource=None, policy_enforcer=None):
+                 queue_resource=None, policy_enforcer=None,
+                 idempotency_repo=None):
 
         LOG.debug('Creating OrdersResource')
         self.tenant_repo = tenant_repo or TenantRepo()
         self.order_repo = order_repo or OrderRepo()
+        self.idempotency_repo = idempotency_repo or IdempotencyKeyRepo()
         self.queue = queue_resource or get_queue_api()
         self.policy = policy_enforcer or policy.Enforcer()
 
     def on_post(self, req, resp, tenant_id):
 
+        idempotency_key = _get_idempotency_key(req)
+        if replay_idempotent_response(resp, tenant_id, 'orders',
+                                      idempotency_key,
+                                      self.idempotency_repo):
+            return
+
+        with releasing_idempotency_key(tenant_id, 'orders', idempotency_key,
+                                       self.idempotency_repo):
+            new_order = self._create_order(req, tenant_id)
+
+            location = '/{0}/orders/{1}'.format(tenant_id, new_order.id)
+            url = convert_order_to_href(tenant_id, new_order.id)
+            body = json.dumps({'order_ref': url})
+
+            if idempotency_key:
+                store_idempotent_response(tenant_id, 'orders',
+                                          idempotency_key, location, body,
+                                          self.idempotency_repo)
+
+            # Send to workers to process, once they are able to see the
+            #   order.
+            commit_request_session()
+            self.queue.process_order(order_id=new_order.id,
+                                     keystone_id=tenant_id)
+
+        resp.status = falcon.HTTP_202
+        resp.set_header('Location', location)
+        resp.body = body
+
+    def _create_order(self, req, tenant_id):
         # Retrieve Tenant, or else create new Tenant
         #   if this is a request from a new tenant.
-        tenant = self.tenant_repo.get(tenant_id, suppress_exception=True)
-        if not tenant:
-            tenant = Tenant()
-            tenant.keystone_id = tenant_id
-            tenant.status = States.ACTIVE
-            self.tenant_repo.create_from(tenant)
+        tenant = get_or_create_tenant(tenant_id, self.tenant_repo)
 
         body = load_body(req)
         LOG.debug('Start on_post...{0}'.format(body))
@@ -279,15 +718,7 @@ class OrdersResource(ApiResource):
         new_order.secret_expiration = secret_info.get('expiration', None)
         new_order.tenant_id = tenant.id
         self.order_repo.create_from(new_order)
-
-        # Send to workers to process.
-        self.queue.process_order(order_id=new_order.id)
-
-        resp.status = falcon.HTTP_202
-        resp.set_header('Location', '/{0}/orders/{1}'.format(tenant_id,
-                                                             new_order.id))
-        url = convert_order_to_href(tenant_id, new_order.id)
-        resp.body = json.dumps({'order_ref': url})
+        return new_order
 
 
 class OrderResource(ApiResource):
@@ -298,16 +729,16 @@ class OrderResource(ApiResource):
         self.policy = policy_enforcer or policy.Enforcer()
 
     def on_get(self, req, resp, tenant_id, order_id):
+        if check_not_modified(req, resp, self.repo, order_id):
+            return
+
         #TODO: Use a falcon exception here
         order = self.repo.get(entity_id=order_id)
         resp.status = falcon.HTTP_200
-        resp.body = json.dumps(convert_to_hrefs(order.tenant_id,
-                                                order.to_dict_fields()),
-                               default=json_handler)
+        _set_cache_validators(resp, order.id, order.last_modified())
+        resp.body = OrderSerializer(tenant_id).to_json(order)
 
     def on_delete(self, req, resp, tenant_id, order_id):
-        order = self.repo.get(entity_id=order_id)
-
-        self.repo.delete_entity(order)
+        self.repo.delete_entity_by_id(entity_id=order_id)
 
         resp.status = falcon.HTTP_200
@@ -0,0 +1,98 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+JSON serializers for API responses.
+
+These take an entity's fields from its to_dict_fields(), converting their
+datetimes to ISO 8601 strings up front rather than through a default
+handler called back by the encoder, and reuse a single JSON encoder so
+that the C-accelerated one is used if available.
+"""
+
+import datetime
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from barbican.common import utils
+from barbican.crypto.mime_types import get_content_types
+
+
+_ENCODER = json.JSONEncoder()
+
+
+def dumps(obj):
+    """Encode obj, which must only hold JSON-native values, as JSON."""
+    return _ENCODER.encode(obj)
+
+
+def _to_json_native(fields):
+    """Convert the datetimes in fields, and in dicts nested in it, to ISO
+    8601 strings, in place."""
+    for key, value in fields.iteritems():
+        if isinstance(value, datetime.datetime):
+            fields[key] = value.isoformat()
+        elif isinstance(value, dict):
+            _to_json_native(value)
+    return fields
+
+
+class SecretSerializer(object):
+    """Serializes Secret entities belonging to a single tenant."""
+
+    def __init__(self, tenant_id):
+        self.secrets_href = utils.hostname_for_refs(tenant_id=tenant_id,
+                                                    resource='secrets/')
+
+    def secret_ref(self, secret_id):
+        """Return the HATEOS-style href for the secret."""
+        return self.secrets_href + (secret_id or '????')
+
+    def to_dict(self, secret, include_ref=True):
+        """Return a dict of the secret's JSON-native API fields."""
+        fields = _to_json_native(secret.to_dict_fields())
+
+        content_types = get_content_types(secret)
+        if content_types:
+            fields['content_types'] = content_types
+
+        if include_ref:
+            fields['secret_ref'] = self.secret_ref(secret.id)
+        return fields
+
+    def to_json(self, secret, include_ref=True):
+        """Return the secret's API representation as a JSON string."""
+        return dumps(self.to_dict(secret, include_ref))
+
+
+class OrderSerializer(object):
+    """Serializes Order entities belonging to a single tenant."""
+
+    def __init__(self, tenant_id):
+        self.secrets = SecretSerializer(tenant_id)
+
+    def to_dict(self, order):
+        """Return a dict of the order's JSON-native API fields."""
+        fields = _to_json_native(order.to_dict_fields())
+        fields['secret_ref'] = self.secrets.secret_ref(
+            fields.pop('secret_id'))
+        return fields
+
+    def to_json(self, order):
+        """Return the order's API representation as a JSON string."""
+        return dumps(self.to_dict(order))
@@ -0,0 +1,94 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-process caching for Barbican.
+"""
+
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """
+    Thread-safe, size-bounded cache whose entries expire after a TTL.
+
+    Once the cache is full the least recently used entry is evicted to make
+    room. Hit, miss and eviction counts are kept for monitoring.
+    """
+
+    def __init__(self, max_size, ttl):
+        """
+        :param max_size: maximum number of entries, or 0 to disable caching
+        :param ttl: seconds an entry remains valid after it is stored
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key, or None if absent or expired."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return None
+
+            # Re-insert to mark as most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, ttl=None):
+        """
+        Store value under key, evicting the oldest entry if full.
+
+        :param ttl: seconds the entry remains valid, if not the cache's TTL
+        """
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._entries[key] = (value, time.time() +
+                                  (self.ttl if ttl is None else ttl))
+
+    def invalidate(self, key):
+        """Remove key from the cache, if present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return a dict of the cache's size and hit/miss counters."""
+        with self._lock:
+            return {'size': len(self._entries),
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
@@ -136,6 +136,10 @@ class InvalidFilterRangeValue(Invalid):
     message = _("Unable to filter using the specified range.")
 
 
+class InvalidSecretBatchItem(Invalid):
+    message = _("Secret %(index)s of the batch is not valid: %(reason)s")
+
+
 class ReadonlyProperty(Forbidden):
     message = _("Attribute '%(property)s' is read-only.")
 
@@ -152,6 +156,10 @@ class DatabaseMigrationError(BarbicanException):
     message = _("There was an error migrating the database.")
 
 
+class UnknownShard(BarbicanException):
+    message = _("No database shard named %(shard)s is configured")
+
+
 class ClientConnectionError(BarbicanException):
     message = _("There was an error connecting to a server")
 
@@ -16,31 +16,225 @@
 """
 Shared business logic.
 """
+import datetime
+import threading
+
+from oslo.config import cfg
+
 from barbican.crypto.extension_manager import (
     CryptoMimeTypeNotSupportedException
 )
-from barbican.model.models import (Tenant, Secret, TenantSecret, States)
+from barbican.model.models import Secret, TenantSecret, States
+from barbican.model import repositories
+from barbican.common import cache
+from barbican.common import exception
 from barbican.common import utils
+from barbican.openstack.common.gettextutils import _
+from barbican.openstack.common import timeutils
 
 LOG = utils.getLogger(__name__)
 
+tenant_cache_opts = [
+    cfg.IntOpt('tenant_cache_size', default=1000,
+               help=_('Maximum number of tenants cached per process, or 0 '
+                      'to disable tenant caching')),
+    cfg.IntOpt('tenant_cache_ttl', default=600,
+               help=_('Seconds a cached tenant remains valid')),
+]
+
+idempotency_opts = [
+    cfg.IntOpt('idempotency_key_ttl', default=86400,
+               help=_('Seconds for which a request made with an '
+                      'Idempotency-Key header can be safely retried')),
+    cfg.IntOpt('idempotency_cache_size', default=1000,
+               help=_('Maximum number of idempotency keys cached per '
+                      'process, or 0 to disable caching them')),
+    cfg.IntOpt('idempotency_pending_ttl', default=300,
+               help=_('Seconds an Idempotency-Key stays reserved for a '
+                      'request that never completes, such as one whose '
+                      'process died')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(tenant_cache_opts)
+CONF.register_opts(idempotency_opts)
+
+_TENANT_CACHE = None
+_IDEMPOTENCY_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_tenant_cache():
+    """
+    Returns the process-wide cache of tenants, keyed by both Keystone ID
+    and internal ID. Tenants are never modified once created, so they can
+    safely be shared between requests and worker tasks.
+    """
+    global _TENANT_CACHE
+    if _TENANT_CACHE is None:
+        with _CACHE_LOCK:
+            if _TENANT_CACHE is None:
+                _TENANT_CACHE = cache.LRUCache(CONF.tenant_cache_size,
+                                               CONF.tenant_cache_ttl)
+    return _TENANT_CACHE
+
+
+def _put_tenant(tenant):
+    tenant_cache = get_tenant_cache()
+    tenant_cache.put(('keystone_id', tenant.keystone_id), tenant)
+    tenant_cache.put(('id', tenant.id), tenant)
 
-def get_or_create_tenant(tenant_id, tenant_repo):
-    """Returns tenant with matching tenant_id.  Creates it if it does
+
+def _cache_tenant(tenant):
+    """
+    Add tenant to the tenant cache under both of its IDs, once the current
+    request commits, so that a tenant created by a request that is then
+    rolled back is never cached.
+    """
+    if tenant.id:
+        repositories.after_request_commit(_put_tenant, tenant)
+
+
+def get_or_create_tenant(keystone_id, tenant_repo):
+    """Returns tenant with matching keystone_id.  Creates it if it does
     not exist."""
-    tenant = tenant_repo.get(tenant_id, suppress_exception=True)
+    tenant = get_tenant_cache().get(('keystone_id', keystone_id))
+    if tenant:
+        return tenant
+
+    tenant = tenant_repo.find_by_keystone_id(keystone_id,
+                                             suppress_exception=True)
     if not tenant:
-        LOG.debug('Creating tenant for {0}'.format(tenant_id))
-        tenant = Tenant()
-        tenant.keystone_id = tenant_id
-        tenant.status = States.ACTIVE
-        tenant_repo.create_from(tenant)
+        LOG.debug('Creating tenant for {0}'.format(keystone_id))
+        tenant = tenant_repo.create_or_get(keystone_id)
+
+    _cache_tenant(tenant)
+    return tenant
+
+
+def get_tenant(tenant_id, tenant_repo):
+    """Returns tenant with matching (internal) tenant_id.
+
+    :raises NotFound if the tenant does not exist.
+    """
+    tenant = get_tenant_cache().get(('id', tenant_id))
+    if tenant:
+        return tenant
+
+    tenant = tenant_repo.get(tenant_id)
+    _cache_tenant(tenant)
     return tenant
 
 
+def get_idempotency_cache():
+    """
+    Returns the process-wide cache of responses to requests made with an
+    Idempotency-Key, keyed by (keystone_id, resource, key).
+    """
+    global _IDEMPOTENCY_CACHE
+    if _IDEMPOTENCY_CACHE is None:
+        with _CACHE_LOCK:
+            if _IDEMPOTENCY_CACHE is None:
+                _IDEMPOTENCY_CACHE = cache.LRUCache(
+                    CONF.idempotency_cache_size, CONF.idempotency_key_ttl)
+    return _IDEMPOTENCY_CACHE
+
+
+def _remaining_seconds(expires_at):
+    delta = expires_at - timeutils.utcnow()
+    return delta.days * 86400 + delta.seconds
+
+
+def get_idempotent_response(keystone_id, resource, key, idempotency_repo):
+    """
+    Returns the (location, body) of the response to the tenant's earlier
+    request to create resource with the Idempotency-Key key, or None if
+    there was no such request, it is still in progress, or its key has
+    expired.
+    """
+    cache_key = (keystone_id, resource, key)
+    response = get_idempotency_cache().get(cache_key)
+    if response:
+        return response
+
+    entry = idempotency_repo.find_by_key(keystone_id, resource, key)
+    if not entry or entry.status != States.ACTIVE:
+        return None
+
+    response = (entry.location, entry.response_body)
+    get_idempotency_cache().put(cache_key, response,
+                                _remaining_seconds(entry.expires_at))
+    return response
+
+
+def reserve_idempotency_key(keystone_id, resource, key, idempotency_repo):
+    """
+    Reserves the Idempotency-Key key for a request to create resource,
+    before the request does any work, so that retries made while it is
+    still running do not repeat that work.
+
+    :returns: True if reserved, or False if an earlier request made with
+              the key holds it
+    """
+    expires_at = timeutils.utcnow() + datetime.timedelta(
+        seconds=CONF.idempotency_pending_ttl)
+    return idempotency_repo.reserve(keystone_id, resource, key, expires_at)
+
+
+def release_idempotency_key(keystone_id, resource, key, idempotency_repo):
+    """
+    Releases the Idempotency-Key key reserved by a request to create
+    resource that failed, so that the request may be retried.
+    """
+    idempotency_repo.release(keystone_id, resource, key)
+
+
+def store_idempotent_response(keystone_id, resource, key, location, body,
+                              idempotency_repo):
+    """
+    Records the response to a request to create resource made with the
+    reserved Idempotency-Key key, so that retries of it can be answered
+    with it. The response is recorded, and cached, only once the request's
+    work is committed.
+    """
+    idempotency_repo.complete(keystone_id, resource, key, location, body,
+                              timeutils.utcnow() + datetime.timedelta(
+                                  seconds=CONF.idempotency_key_ttl))
+
+    repositories.after_request_commit(get_idempotency_cache().put,
+                                      (keystone_id, resource, key),
+                                      (location, body))
+
+
+def _encrypt(plain_text, secret, tenant, crypto_manager):
+    """Returns the encrypted datum for plain_text, or None if the secret's
+    mime-type is not supported."""
+    LOG.debug('Encrypting plain_text secret')
+    try:
+        return crypto_manager.encrypt(plain_text, secret, tenant)
+    except CryptoMimeTypeNotSupportedException as e:
+        # TODO: return error
+        LOG.error(e.message)
+        return None
+
+
 def create_secret(data, tenant, crypto_manager,
                   secret_repo, tenant_secret_repo, datum_repo,
                   ok_to_generate=False):
+    """
+    Creates a secret, its tenant association and its encrypted data (if
+    any) in a single database transaction, so a failure part way through
+    never leaves a partial secret behind.
+
+    :param data: the secret definition
+    :param tenant: the tenant who owns the secret
+    :param crypto_manager: the crypto plugin manager
+    :param secret_repo: the secret repository
+    :param tenant_secret_repo: the tenant/secret association repository
+    :param datum_repo: the encrypted datum repository
+    :param ok_to_generate: generate the secret data if none is supplied
+    :retval The new secret
+    """
 
     # TODO: revisit ok_to_generate
 
@@ -56,42 +250,94 @@ def create_secret(data, tenant, crypto_manager,
     #                           'already exists'.format(name))
 
     new_secret = Secret(data)
-    secret_repo.create_from(new_secret)
-
-    # Create Tenant/Secret entity.
-    new_assoc = TenantSecret()
-    new_assoc.tenant_id = tenant.id
-    new_assoc.secret_id = new_secret.id
-    new_assoc.role = "admin"
-    new_assoc.status = States.ACTIVE
-    tenant_secret_repo.create_from(new_assoc)
 
+    # Encrypt up front, so the transaction is only held for the writes.
+    new_datum = None
     if 'plain_text' in data:
-        LOG.debug('Encrypting plain_text secret')
-        try:
-            new_datum = crypto_manager.encrypt(data['plain_text'],
-                                               new_secret,
-                                               tenant)
-            datum_repo.create_from(new_datum)
-        except CryptoMimeTypeNotSupportedException as e:
-            # TODO: return error
-            LOG.error(e.message)
+        new_datum = _encrypt(data['plain_text'], new_secret, tenant,
+                             crypto_manager)
     elif ok_to_generate:
-        try:
-            # TODO: Generate a good key
-            new_datum = crypto_manager.encrypt('plain_text_key',
-                                               new_secret,
-                                               tenant)
-            datum_repo.create_from(new_datum)
-        except CryptoMimeTypeNotSupportedException as e:
-            # TODO: return error
-            LOG.error(e.message)
+        # TODO: Generate a good key
+        new_datum = _encrypt('plain_text_key', new_secret, tenant,
+                             crypto_manager)
+
+    session = secret_repo.get_session()
+    with session.begin(subtransactions=True):
+        secret_repo.create_from(new_secret, session=session)
+
+        # Create Tenant/Secret entity.
+        new_assoc = TenantSecret()
+        new_assoc.tenant_id = tenant.id
+        new_assoc.secret_id = new_secret.id
+        new_assoc.role = "admin"
+        new_assoc.status = States.ACTIVE
+        tenant_secret_repo.create_from(new_assoc, session=session)
+
+        if new_datum:
+            new_datum.secret_id = new_secret.id
+            datum_repo.create_from(new_datum, session=session)
 
     return new_secret
 
 
+def create_secrets(data_list, tenant, crypto_manager,
+                   secret_repo, tenant_secret_repo, datum_repo):
+    """
+    Creates a batch of secrets in a single database transaction.
+
+    All secrets are encrypted up front, and then the Secret, TenantSecret
+    and EncryptedDatum rows are each written with one batched INSERT per
+    table, rather than the three transactions per secret that
+    create_secret() incurs.
+
+    :param data_list: list of secret definitions, as for create_secret()
+    :param tenant: the tenant who owns the secrets
+    :param crypto_manager: the crypto plugin manager
+    :param secret_repo: the secret repository
+    :param tenant_secret_repo: the tenant/secret association repository
+    :param datum_repo: the encrypted datum repository
+    :retval The list of new secrets, in the order of data_list
+    :raises InvalidSecretBatchItem if a secret cannot be encrypted, in
+            which case none of the secrets are stored
+    """
+    new_secrets = []
+    new_assocs = []
+    new_datums = []
+    for idx, data in enumerate(data_list):
+        new_secret = Secret(data)
+        new_secrets.append(new_secret)
+
+        if 'plain_text' in data:
+            try:
+                new_datum = crypto_manager.encrypt(data['plain_text'],
+                                                   new_secret, tenant)
+            except exception.BarbicanException as e:
+                raise exception.InvalidSecretBatchItem(index=idx, reason=e)
+            new_datums.append((new_secret, new_datum))
+
+    session = secret_repo.get_session()
+    with session.begin(subtransactions=True):
+        secret_repo.create_batch(new_secrets, session=session)
+
+        for new_secret in new_secrets:
+            new_assoc = TenantSecret()
+            new_assoc.tenant_id = tenant.id
+            new_assoc.secret_id = new_secret.id
+            new_assoc.role = "admin"
+            new_assoc.status = States.ACTIVE
+            new_assocs.append(new_assoc)
+        tenant_secret_repo.create_batch(new_assocs, session=session)
+
+        for new_secret, new_datum in new_datums:
+            new_datum.secret_id = new_secret.id
+        datum_repo.create_batch([datum for secret, datum in new_datums],
+                                session=session)
+
+    return new_secrets
+
+
 def create_encrypted_datum(secret, plain_text, tenant, crypto_manager,
-                           tenant_secret_repo, datum_repo):
+                           datum_repo):
     """
     Modifies the secret to add the plain_text secret information.
 
@@ -99,7 +345,6 @@ def create_encrypted_datum(secret, plain_text, tenant, crypto_manager,
     :param plain_text: plain-text of the secret data to store
     :param tenant: the tenant who owns the secret
     :param crypto_manager: the crypto plugin manager
-    :param tenant_secret_repo: the tenant/secret association repository
     :param datum_repo: the encrypted datum repository
     :retval The response body, None if N/A
     """
@@ -112,23 +357,12 @@ def create_encrypted_datum(secret, plain_text, tenant, crypto_manager,
     fields = secret.to_dict_fields()
     fields['plain_text'] = plain_text
 
-    # Encrypt plain_text
-    LOG.debug('Encrypting plain_text secret')
-    try:
-        new_datum = crypto_manager.encrypt(plain_text,
-                                           secret,
-                                           tenant)
-        datum_repo.create_from(new_datum)
-    except CryptoMimeTypeNotSupportedException as e:
-        # TODO: return error
-        LOG.error(e.message)
+    new_datum = _encrypt(plain_text, secret, tenant, crypto_manager)
+    if not new_datum:
+        raise ValueError('Secret mime-type is not supported for encryption.')
 
-    # Create Tenant/Secret entity.
-    new_assoc = TenantSecret()
-    new_assoc.tenant_id = tenant
-    new_assoc.secret_id = secret.id
-    new_assoc.role = "admin"
-    new_assoc.status = States.ACTIVE
-    tenant_secret_repo.create_from(new_assoc)
+    # The secret's Tenant/Secret association was made when it was created.
+    new_datum.secret_id = secret.id
+    datum_repo.create_from(new_datum)
 
     return new_datum
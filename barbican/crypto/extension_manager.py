@@ -57,7 +57,11 @@ class CryptoExtensionManager(named.NamedExtensionManager):
             raise CryptoMimeTypeNotSupportedException(secret.mime_type)
 
     def decrypt(self, accept, secret, tenant):
-        """Delegates decryption to active plugins."""
+        """Delegates decryption to active plugins.
+
+        Returns either the plain text as a string, or an iterator of
+        plain-text chunks, as produced by the plugin.
+        """
         for ext in self.extensions:
             if ext.obj.supports(accept):
                 return ext.obj.decrypt(accept, secret, tenant)
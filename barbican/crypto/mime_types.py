@@ -25,18 +25,28 @@ CTYPES_MAPPINGS = {'text/plain': CTYPES_PLAIN,
                    'application/aes': CTYPES_AES}
 
 
+def get_content_types(secret):
+    """
+    Return the content types that the specified secret's data can be
+    requested as, or None if it has no data of a supported mime-type.
+
+    A secret holds one datum per format stored for it. If several are of
+    supported mime-types, the last of them determines the content types.
+    """
+    content_types = None
+    for datum in secret.encrypted_data or ():
+        content_types = CTYPES_MAPPINGS.get(datum.mime_type, content_types)
+    return content_types
+
+
 def augment_fields_with_content_types(secret):
     """Generate a dict of content types based on the data associated
     with the specified secret."""
 
     fields = secret.to_dict_fields()
 
-    if not secret.encrypted_data:
-        return fields
-
-    # TODO: How deal with merging more than one datum instance?
-    for datum in secret.encrypted_data:
-        if datum.mime_type in CTYPES_MAPPINGS:
-            fields.update({'content_types': CTYPES_MAPPINGS[datum.mime_type]})
+    content_types = get_content_types(secret)
+    if content_types:
+        fields.update({'content_types': content_types})
 
     return fields
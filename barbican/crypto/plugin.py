@@ -31,7 +31,13 @@ class CryptoPluginBase(object):
     @abc.abstractmethod
     def decrypt(self, secret_type, secret, tenant):
         """Decrypt secret into secret_type in the context of the
-        provided tenant"""
+        provided tenant.
+
+        Returns either the whole plain text as a string, or an iterator
+        of plain-text string chunks. Large secrets should be returned as
+        chunks, which are streamed to the client as they are produced.
+        Note that by the time a chunk fails to decrypt the response
+        status has already been sent, so validate before yielding."""
 
     @abc.abstractmethod
     def create(self, secret_type):
@@ -0,0 +1,102 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Index the columns repository queries look rows up by, which tables created
+before migrations were introduced lack.
+
+Tenants created concurrently for the same Keystone ID before keystone_id
+was unique are merged into the oldest of them first, so that its unique
+index can be created.
+"""
+
+from sqlalchemy import Index, MetaData, Table, func, select
+
+from barbican.db.sqlalchemy import migration
+
+# (table, index name, columns, unique)
+INDEXES = [
+    ('tenants', 'ix_tenants_keystone_id', ['keystone_id'], True),
+    ('tenant_secret', 'ix_tenant_secret_tenant_created',
+     ['tenant_id', 'created_at', 'secret_id'], False),
+    ('tenant_secret', 'ix_tenant_secret_secret_id', ['secret_id'], False),
+    ('tenant_secret', 'ix_tenant_secret_deleted',
+     ['deleted', 'deleted_at'], False),
+    ('secrets', 'ix_secrets_name', ['name'], False),
+    ('secrets', 'ix_secrets_deleted', ['deleted', 'deleted_at'], False),
+    ('encrypted_data', 'ix_encrypted_data_secret_id', ['secret_id'], False),
+    ('encrypted_data', 'ix_encrypted_data_deleted',
+     ['deleted', 'deleted_at'], False),
+    ('orders', 'ix_orders_tenant_id', ['tenant_id'], False),
+    ('orders', 'ix_orders_secret_id', ['secret_id'], False),
+    ('orders', 'ix_orders_deleted', ['deleted', 'deleted_at'], False),
+    ('idempotency_keys', 'ix_idempotency_keys_key',
+     ['keystone_id', 'resource', 'key'], True),
+    ('idempotency_keys', 'ix_idempotency_keys_expires_at', ['expires_at'],
+     False),
+]
+
+
+def _indexes(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    for table_name, name, columns, unique in INDEXES:
+        table = Table(table_name, meta, autoload=True)
+        index = Index(name, *[table.c[column] for column in columns],
+                      unique=unique)
+        yield index, name in migration.get_index_names(migrate_engine,
+                                                       table_name)
+
+
+def _merge_duplicate_tenants(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    tenants = Table('tenants', meta, autoload=True)
+    tenant_secret = Table('tenant_secret', meta, autoload=True)
+    orders = Table('orders', meta, autoload=True)
+
+    keystone_ids = [row[0] for row in migrate_engine.execute(
+        select([tenants.c.keystone_id])
+        .where(tenants.c.keystone_id != None)
+        .group_by(tenants.c.keystone_id)
+        .having(func.count() > 1))]
+    for keystone_id in keystone_ids:
+        tenant_ids = [row[0] for row in migrate_engine.execute(
+            select([tenants.c.id])
+            .where(tenants.c.keystone_id == keystone_id)
+            .order_by(tenants.c.created_at, tenants.c.id))]
+        survivor, duplicates = tenant_ids[0], tenant_ids[1:]
+
+        with migrate_engine.begin() as conn:
+            for table in (tenant_secret, orders):
+                conn.execute(table.update()
+                             .where(table.c.tenant_id.in_(duplicates))
+                             .values(tenant_id=survivor))
+            conn.execute(tenants.delete()
+                         .where(tenants.c.id.in_(duplicates)))
+
+
+def upgrade(migrate_engine):
+    if 'ix_tenants_keystone_id' not in migration.get_index_names(
+            migrate_engine, 'tenants'):
+        _merge_duplicate_tenants(migrate_engine)
+
+    for index, exists in _indexes(migrate_engine):
+        if not exists:
+            migration.create_index_online(migrate_engine, index)
+
+
+def downgrade(migrate_engine):
+    for index, exists in _indexes(migrate_engine):
+        if exists:
+            index.drop(migrate_engine)
@@ -0,0 +1,49 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Add the table of tenants stored outside the shard their keystone ID hashes
+to.
+"""
+
+from sqlalchemy import (Boolean, Column, DateTime, Index, MetaData, String,
+                        Table)
+
+
+def _define(meta):
+    table = Table(
+        'tenant_shards', meta,
+        Column('id', String(36), primary_key=True),
+        Column('created_at', DateTime, nullable=False),
+        Column('updated_at', DateTime, nullable=False),
+        Column('deleted_at', DateTime),
+        Column('deleted', Boolean, nullable=False),
+        Column('status', String(20), nullable=False),
+        Column('keystone_id', String(255), nullable=False),
+        Column('shard', String(255), nullable=False),
+        Column('moving', Boolean, nullable=False),
+        mysql_engine='InnoDB')
+    Index('ix_tenant_shards_keystone_id', table.c.keystone_id, unique=True)
+    return table
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    _define(meta).create(checkfirst=True)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    _define(meta).drop(checkfirst=True)
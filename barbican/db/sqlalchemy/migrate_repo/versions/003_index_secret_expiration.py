@@ -0,0 +1,73 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Index secrets by expiration, for the expired-secret sweeper.
+
+Secrets and orders created without an expiration used to be given their
+creation time as one by a column default, so that the sweeper would have
+taken them for expired; such expirations are cleared, as never expiring.
+"""
+
+import datetime
+
+from sqlalchemy import Index, MetaData, Table, select
+
+from barbican.db.sqlalchemy import migration
+
+# Expirations set this close to creation were filled in by the default.
+_DEFAULTED_WITHIN = datetime.timedelta(seconds=1)
+
+_BATCH_SIZE = 500
+
+
+def _clear_defaulted_expirations(migrate_engine, table, column):
+    rows = migrate_engine.execute(
+        select([table.c.id, table.c.created_at, column])
+        .where(column != None))
+    ids = [entity_id for entity_id, created_at, expiration in rows
+           if abs(expiration - created_at) < _DEFAULTED_WITHIN]
+    for idx in xrange(0, len(ids), _BATCH_SIZE):
+        migrate_engine.execute(
+            table.update()
+            .where(table.c.id.in_(ids[idx:idx + _BATCH_SIZE]))
+            .values({column.name: None}))
+
+
+def _expiration_index(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    secrets = Table('secrets', meta, autoload=True)
+    orders = Table('orders', meta, autoload=True)
+    index = Index('ix_secrets_expiration', secrets.c.deleted,
+                  secrets.c.expiration)
+    exists = index.name in migration.get_index_names(migrate_engine,
+                                                     'secrets')
+    return secrets, orders, index, exists
+
+
+def upgrade(migrate_engine):
+    secrets, orders, index, exists = _expiration_index(migrate_engine)
+    _clear_defaulted_expirations(migrate_engine, secrets,
+                                 secrets.c.expiration)
+    _clear_defaulted_expirations(migrate_engine, orders,
+                                 orders.c.secret_expiration)
+    if not exists:
+        migration.create_index_online(migrate_engine, index)
+
+
+def downgrade(migrate_engine):
+    secrets, orders, index, exists = _expiration_index(migrate_engine)
+    if exists:
+        index.drop(migrate_engine)
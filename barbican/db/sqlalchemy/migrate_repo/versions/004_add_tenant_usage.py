@@ -0,0 +1,98 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Add the table of per-tenant secret and order counts, filled in from the
+tenants' existing secrets and orders.
+"""
+
+import datetime
+import uuid
+
+from sqlalchemy import (Boolean, Column, DateTime, ForeignKey, Index,
+                        Integer, MetaData, String, Table, distinct, func,
+                        select)
+
+_BATCH_SIZE = 500
+
+
+def _define(meta):
+    # Loaded for the foreign key to refer to.
+    Table('tenants', meta, autoload=True)
+    table = Table(
+        'tenant_usage', meta,
+        Column('id', String(36), primary_key=True),
+        Column('created_at', DateTime, nullable=False),
+        Column('updated_at', DateTime, nullable=False),
+        Column('deleted_at', DateTime),
+        Column('deleted', Boolean, nullable=False),
+        Column('status', String(20), nullable=False),
+        Column('tenant_id', String(36), ForeignKey('tenants.id'),
+               nullable=False),
+        Column('secrets', Integer, nullable=False),
+        Column('orders', Integer, nullable=False),
+        mysql_engine='InnoDB')
+    Index('ix_tenant_usage_tenant_id', table.c.tenant_id, unique=True)
+    return table
+
+
+def _count_by_tenant(migrate_engine, query):
+    return dict(migrate_engine.execute(query).fetchall())
+
+
+def _fill(migrate_engine, meta, usage):
+    tenants = Table('tenants', meta, autoload=True)
+    tenant_secret = Table('tenant_secret', meta, autoload=True)
+    secrets = Table('secrets', meta, autoload=True)
+    orders = Table('orders', meta, autoload=True)
+
+    tenant_ids = [row[0] for row in migrate_engine.execute(
+        select([tenants.c.id]).order_by(tenants.c.id))]
+    for idx in xrange(0, len(tenant_ids), _BATCH_SIZE):
+        batch = tenant_ids[idx:idx + _BATCH_SIZE]
+        secret_counts = _count_by_tenant(migrate_engine, select(
+            [tenant_secret.c.tenant_id,
+             func.count(distinct(tenant_secret.c.secret_id))],
+            (tenant_secret.c.tenant_id.in_(batch)) &
+            (tenant_secret.c.secret_id == secrets.c.id) &
+            (secrets.c.deleted == False))
+            .group_by(tenant_secret.c.tenant_id))
+        order_counts = _count_by_tenant(migrate_engine, select(
+            [orders.c.tenant_id, func.count()],
+            (orders.c.tenant_id.in_(batch)) & (orders.c.deleted == False))
+            .group_by(orders.c.tenant_id))
+
+        now = datetime.datetime.utcnow()
+        migrate_engine.execute(usage.insert(), [
+            {'id': str(uuid.uuid4()), 'created_at': now, 'updated_at': now,
+             'deleted': False, 'status': 'ACTIVE', 'tenant_id': tenant_id,
+             'secrets': secret_counts.get(tenant_id, 0),
+             'orders': order_counts.get(tenant_id, 0)}
+            for tenant_id in batch])
+
+
+def upgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    usage = _define(meta)
+    if not usage.exists():
+        usage.create()
+    if not migrate_engine.execute(select([func.count()],
+                                         from_obj=usage)).scalar():
+        _fill(migrate_engine, meta, usage)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData(bind=migrate_engine)
+    _define(meta).drop(checkfirst=True)
@@ -0,0 +1,172 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Versioned database schema migrations, using sqlalchemy-migrate.
+
+The migrate.versioning.api functions are not used, as they dispose of the
+engine they are given (and with it the barbican connection pool).
+"""
+
+import os
+
+from migrate import exceptions as versioning_exceptions
+from migrate.versioning import repository as versioning_repository
+from migrate.versioning import schema as versioning_schema
+import sqlalchemy
+from sqlalchemy.engine import reflection
+from sqlalchemy.schema import CreateIndex
+
+from barbican.common import exception
+from barbican.common import utils
+from barbican.model import models
+from barbican.openstack.common.gettextutils import _
+
+LOG = utils.getLogger(__name__)
+
+_REPOSITORY = None
+
+
+def get_migrate_repo_path():
+    """Get the path for the migrate repository."""
+    path = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                        'migrate_repo')
+    assert os.path.exists(path)
+    return path
+
+
+def _get_repository():
+    global _REPOSITORY
+    if _REPOSITORY is None:
+        _REPOSITORY = versioning_repository.Repository(
+            get_migrate_repo_path())
+    return _REPOSITORY
+
+
+def _get_schema(engine):
+    try:
+        return versioning_schema.ControlledSchema(engine, _get_repository())
+    except versioning_exceptions.DatabaseNotControlledError:
+        msg = _("database is not under migration control")
+        raise exception.DatabaseMigrationError(msg)
+
+
+def db_version(engine):
+    """
+    Return the database's current migration number.
+
+    :raises DatabaseMigrationError if not under migration control
+    """
+    return _get_schema(engine).version
+
+
+def latest_version():
+    """Return the migration number the schema is brought up to."""
+    return _get_repository().latest
+
+
+def version_control(engine, version=None):
+    """
+    Place a database under migration control, at version (or the latest
+    version if None).
+
+    :raises DatabaseMigrationError if already under migration control
+    """
+    if version is None:
+        version = latest_version()
+    try:
+        versioning_schema.ControlledSchema.create(engine, _get_repository(),
+                                                  version)
+    except versioning_exceptions.DatabaseAlreadyControlledError:
+        msg = _("database is already under migration control")
+        raise exception.DatabaseMigrationError(msg)
+    return version
+
+
+def upgrade(engine, version=None):
+    """Upgrade the database to version, or the latest version if None."""
+    return _migrate(engine, version, 'Upgrading')
+
+
+def downgrade(engine, version):
+    """Downgrade the database to version."""
+    return _migrate(engine, version, 'Downgrading')
+
+
+def _migrate(engine, version, action):
+    schema = _get_schema(engine)
+    LOG.info(_("{0} database from version {1} to {2}").format(
+        action, schema.version, version or 'latest'))
+
+    changeset = schema.changeset(version)
+    for ver, change in changeset:
+        LOG.info(_("Running migration {0}").format(change))
+        schema.runchange(ver, change, changeset.step)
+    return schema.version
+
+
+def db_sync(engine, version=None):
+    """
+    Bring the database schema up to date, or to version.
+
+    An empty database is created from the models and placed under
+    migration control at the latest version. A database created before
+    migrations were introduced has its missing tables created, and is then
+    upgraded from version 0 so migrations add what its tables lack.
+    """
+    try:
+        current = db_version(engine)
+    except exception.DatabaseMigrationError:
+        empty = not engine.table_names()
+        LOG.info(_("Creating database tables"))
+        models.register_models(engine)
+        current = version_control(engine, None if empty else 0)
+
+    if version is not None and int(version) < current:
+        return downgrade(engine, version)
+    elif version is None or int(version) > current:
+        return upgrade(engine, version)
+    return current
+
+
+def get_index_names(engine, table_name):
+    """Return the names of the indexes on table_name."""
+    inspector = reflection.Inspector.from_engine(engine)
+    return set(index['name'] for index in inspector.get_indexes(table_name))
+
+
+def create_index_online(engine, index):
+    """
+    Create index without blocking writes to its table, where the database
+    supports it: concurrently on PostgreSQL and in-place on MySQL.
+    Elsewhere a plain CREATE INDEX is issued.
+    """
+    sql = unicode(CreateIndex(index).compile(dialect=engine.dialect))
+
+    if engine.name == 'postgresql':
+        # CONCURRENTLY cannot run inside a transaction block.
+        sql = sql.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1)
+        conn = engine.raw_connection()
+        try:
+            conn.connection.autocommit = True
+            conn.cursor().execute(sql)
+        finally:
+            conn.connection.autocommit = False
+            conn.close()
+        return
+
+    if engine.name == 'mysql':
+        sql += ' ALGORITHM=INPLACE LOCK=NONE'
+    engine.execute(sqlalchemy.text(sql).execution_options(autocommit=True))
@@ -21,7 +21,7 @@ from sqlalchemy import Column, Integer, String, BigInteger
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import ForeignKey, DateTime, Boolean, Text, LargeBinary
-from sqlalchemy.orm import relationship, backref, object_mapper
+from sqlalchemy.orm import relationship, backref, object_mapper, deferred
 from sqlalchemy import Index, UniqueConstraint
 
 from barbican.openstack.common import timeutils
@@ -71,15 +71,13 @@ class ModelBase(object):
         session.flush()
 
     def delete(self, session=None):
-        """Delete this object"""
-        import barbican.model.repositories
-        session = session or barbican.model.repositories.get_session()
-        session.delete(self)
-
-        #TODO: Soft delete instead?
-        # self.deleted = True
-        # self.deleted_at = timeutils.utcnow()
-        # self.save(session=session)
+        """
+        Soft-delete this object, leaving a tombstone row for the purge job
+        to remove later.
+        """
+        self.deleted = True
+        self.deleted_at = timeutils.utcnow()
+        self.save(session=session)
 
     def update(self, values):
         """dict.update() behaviour."""
@@ -128,6 +126,15 @@ class ModelBase(object):
         """Sub-class hook method: return dict of fields."""
         return {}
 
+    def last_modified(self):
+        """
+        Returns when this entity, or any data it owns, was last modified.
+
+        Sub-classes that override this must keep their repository's
+        _do_build_last_modified_query() in step with it.
+        """
+        return self.updated_at
+
 
 class TenantSecret(BASE, ModelBase):
     """
@@ -135,6 +142,12 @@ class TenantSecret(BASE, ModelBase):
     """
 
     __tablename__ = 'tenant_secret'
+    __table_args__ = (Index('ix_tenant_secret_tenant_created',
+                            'tenant_id', 'created_at', 'secret_id'),
+                      Index('ix_tenant_secret_secret_id', 'secret_id'),
+                      Index('ix_tenant_secret_deleted',
+                            'deleted', 'deleted_at'),
+                      ModelBase.__table_args__)
 
     tenant_id = Column(Integer, ForeignKey('tenants.id'), primary_key=True)
     secret_id = Column(Integer, ForeignKey('secrets.id'), primary_key=True)
@@ -151,6 +164,9 @@ class Tenant(BASE, ModelBase):
     """
 
     __tablename__ = 'tenants'
+    __table_args__ = (Index('ix_tenants_keystone_id', 'keystone_id',
+                            unique=True),
+                      ModelBase.__table_args__)
 
     keystone_id = Column(String(255))
 
@@ -180,16 +196,21 @@ class Secret(BASE, ModelBase):
     """
 
     __tablename__ = 'secrets'
+    __table_args__ = (Index('ix_secrets_name', 'name'),
+                      Index('ix_secrets_deleted', 'deleted', 'deleted_at'),
+                      Index('ix_secrets_expiration', 'deleted', 'expiration'),
+                      ModelBase.__table_args__)
 
     name = Column(String(255))
-    expiration = Column(DateTime, default=timeutils.utcnow)
+    # Secrets without an expiration never expire.
+    expiration = Column(DateTime)
     mime_type = Column(String(255), nullable=False)
     algorithm = Column(String(255))
     bit_length = Column(Integer)
     cypher_type = Column(String(255))
 
-    # TODO: Performance - Consider avoiding full load of all
-    #   datum attributes here.
+    # Note: Loads only the datum metadata needed to describe the secret,
+    #   as each datum's payload is deferred (see EncryptedDatum).
     encrypted_data = relationship("EncryptedDatum", lazy='joined')
 
     def __init__(self, parsed_request):
@@ -215,6 +236,12 @@ class Secret(BASE, ModelBase):
                 'bit_length': self.bit_length,
                 'cypher_type': self.cypher_type}
 
+    def last_modified(self):
+        """Include the secret's encrypted data, which is added separately."""
+        return max([self.updated_at] +
+                   [datum.updated_at for datum in self.encrypted_data
+                    if datum.updated_at])
+
 
 class EncryptedDatum(BASE, ModelBase):
     """
@@ -225,12 +252,18 @@ class EncryptedDatum(BASE, ModelBase):
     """
 
     __tablename__ = 'encrypted_data'
+    __table_args__ = (Index('ix_encrypted_data_secret_id', 'secret_id'),
+                      Index('ix_encrypted_data_deleted',
+                            'deleted', 'deleted_at'),
+                      ModelBase.__table_args__)
 
     secret_id = Column(String(36), ForeignKey('secrets.id'),
                        nullable=False)
 
     mime_type = Column(String(255))
-    cypher_text = Column(LargeBinary)
+    # Deferred, as only decryption needs the (possibly large) payload.
+    #   See SecretRepo.get_with_payload().
+    cypher_text = deferred(Column(LargeBinary))
     kek_metadata = Column(Text)
 
     def _do_extra_dict_fields(self):
@@ -251,6 +284,10 @@ class Order(BASE, ModelBase):
     """
 
     __tablename__ = 'orders'
+    __table_args__ = (Index('ix_orders_tenant_id', 'tenant_id'),
+                      Index('ix_orders_secret_id', 'secret_id'),
+                      Index('ix_orders_deleted', 'deleted', 'deleted_at'),
+                      ModelBase.__table_args__)
 
     tenant_id = Column(String(36), ForeignKey('tenants.id'),
                        nullable=False)
@@ -260,7 +297,7 @@ class Order(BASE, ModelBase):
     secret_bit_length = Column(Integer)
     secret_cypher_type = Column(String(255))
     secret_mime_type = Column(String(255))
-    secret_expiration = Column(DateTime, default=timeutils.utcnow)
+    secret_expiration = Column(DateTime)
 
     secret_id = Column(String(36), ForeignKey('secrets.id'),
                        nullable=True)
@@ -276,8 +313,91 @@ class Order(BASE, ModelBase):
                 'secret_id': self.secret_id}
 
 
-# Keep this tuple synchronized with the models in the file
-MODELS = [TenantSecret, Tenant, Secret, EncryptedDatum, Order]
+class IdempotencyKey(BASE, ModelBase):
+    """
+    Represents a client-supplied Idempotency-Key for a create request
+
+    The response to the first request made with a given key is kept until
+    the key expires, so that retries of that request can be answered with
+    the same response rather than creating further entities.
+    """
+
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (Index('ix_idempotency_keys_key',
+                            'keystone_id', 'resource', 'key', unique=True),
+                      Index('ix_idempotency_keys_expires_at', 'expires_at'),
+                      ModelBase.__table_args__)
+
+    keystone_id = Column(String(255), nullable=False)
+    resource = Column(String(36), nullable=False)
+    key = Column(String(255), nullable=False)
+    location = Column(String(255))
+    response_body = Column(Text)
+    expires_at = Column(DateTime, nullable=False)
+
+    def _do_extra_dict_fields(self):
+        """Sub-class hook method: return dict of fields."""
+        return {'keystone_id': self.keystone_id,
+                'resource': self.resource,
+                'key': self.key,
+                'expires_at': self.expires_at}
+
+
+class TenantShard(BASE, ModelBase):
+    """
+    Represents the database shard a tenant's entities are stored in, where
+    that is not the shard its keystone ID hashes to
+
+    Rows are kept in the sql_connection database only. While a tenant is
+    moving between shards its entities may be read but not written.
+    """
+
+    __tablename__ = 'tenant_shards'
+    __table_args__ = (Index('ix_tenant_shards_keystone_id', 'keystone_id',
+                            unique=True),
+                      ModelBase.__table_args__)
+
+    keystone_id = Column(String(255), nullable=False)
+    shard = Column(String(255), nullable=False)
+    moving = Column(Boolean, nullable=False, default=False)
+
+    def _do_extra_dict_fields(self):
+        """Sub-class hook method: return dict of fields."""
+        return {'keystone_id': self.keystone_id,
+                'shard': self.shard,
+                'moving': self.moving}
+
+
+class TenantUsage(BASE, ModelBase):
+    """
+    Represents the number of live secrets and orders a tenant has
+
+    The repositories keep the counts up to date within the transactions
+    that create and delete the tenant's secrets and orders, and a periodic
+    reconciliation corrects any drift.
+    """
+
+    __tablename__ = 'tenant_usage'
+    __table_args__ = (Index('ix_tenant_usage_tenant_id', 'tenant_id',
+                            unique=True),
+                      ModelBase.__table_args__)
+
+    tenant_id = Column(String(36), ForeignKey('tenants.id'),
+                       nullable=False)
+    secrets = Column(Integer, nullable=False, default=0)
+    orders = Column(Integer, nullable=False, default=0)
+
+    def _do_extra_dict_fields(self):
+        """Sub-class hook method: return dict of fields."""
+        return {'tenant_id': self.tenant_id,
+                'secrets': self.secrets,
+                'orders': self.orders}
+
+
+# Keep this tuple synchronized with the models in the file, and add a
+#   migration (see barbican.db.sqlalchemy) for each change to them
+MODELS = [TenantSecret, Tenant, Secret, EncryptedDatum, Order,
+          IdempotencyKey, TenantShard, TenantUsage]
 
 
 def register_models(engine):
@@ -21,19 +21,33 @@ quite intense for sqlalchemy, and maybe could be simplified.
 """
 
 
+import bisect
+import collections
+import contextlib
+import copy
+import hashlib
+import itertools
+import random
+import threading
 import time
 import logging
+import weakref
 
 from oslo.config import cfg
 
 import sqlalchemy
+from sqlalchemy.ext.compiler import compiles
 import sqlalchemy.orm as sa_orm
+import sqlalchemy.pool as sa_pool
 import sqlalchemy.sql as sa_sql
 
+from barbican.common import cache
 from barbican.common import exception
-#TODO: from barbican.db.sqlalchemy import migration
+from barbican.db.sqlalchemy import migration
 from barbican.model import models
+from barbican.openstack.common import local
 from barbican.openstack.common import timeutils
+from barbican.openstack.common import uuidutils
 from barbican.openstack.common.gettextutils import _
 from barbican.common import utils
 
@@ -41,9 +55,16 @@ LOG = utils.getLogger(__name__)
 
 
 _ENGINE = None
+_BREAKER = None
 _MAKER = None
+_ENGINE_LOCK = threading.RLock()
+_READ_MAKERS = None
+_READ_MAKERS_LOCK = threading.Lock()
+_RECENT_WRITERS = None
 _MAX_RETRIES = None
 _RETRY_INTERVAL = None
+_MAX_RETRY_INTERVAL = None
+_SHARD_MAP = None
 BASE = models.BASE
 sa_logger = None
 
@@ -54,9 +75,47 @@ STATUSES = ['active', 'saving', 'queued', 'killed', 'pending_delete',
 db_opts = [
     cfg.IntOpt('sql_idle_timeout', default=3600),
     cfg.IntOpt('sql_max_retries', default=60),
-    cfg.IntOpt('sql_retry_interval', default=1),
+    cfg.IntOpt('sql_retry_interval', default=1,
+               help=_('Seconds before the first retry of a failed database '
+                      'connection, doubling with each further retry')),
+    cfg.IntOpt('sql_max_retry_interval', default=10,
+               help=_('Maximum seconds between retries of a failed '
+                      'database connection')),
+    cfg.IntOpt('sql_circuit_breaker_threshold', default=3,
+               help=_('Consecutive failed database connections after '
+                      'which requests fail fast with a 503 until the '
+                      'database is reachable again, or 0 to always retry')),
     cfg.BoolOpt('db_auto_create', default=True),
     cfg.StrOpt('sql_connection', default=None),
+    cfg.IntOpt('sql_pool_size', default=5,
+               help=_('Number of connections kept open in the pool')),
+    cfg.IntOpt('sql_max_overflow', default=10,
+               help=_('Number of connections that may be opened beyond '
+                      'sql_pool_size under load')),
+    cfg.IntOpt('sql_pool_timeout', default=30,
+               help=_('Seconds to wait for a pooled connection before '
+                      'giving up')),
+    cfg.BoolOpt('sql_pool_pre_ping', default=True,
+                help=_('Test pooled connections as they are checked out, '
+                       'replacing any the database has dropped')),
+    cfg.ListOpt('sql_read_connection', default=[],
+                help=_('Connection strings of read replicas of '
+                       'sql_connection, which API requests read from in '
+                       'turn')),
+    cfg.IntOpt('sql_read_your_writes_window', default=5,
+               help=_('Seconds after a tenant writes during which its '
+                      'requests read from sql_connection rather than a '
+                      'replica')),
+    cfg.ListOpt('sql_shard_connection', default=[],
+                help=_('Databases besides sql_connection to store tenants\' '
+                       'entities in, as name=connection pairs. Tenants are '
+                       'spread over these and sql_connection (the shard '
+                       'named "default") by a consistent hash of their '
+                       'keystone ID, unless placed on a shard explicitly')),
+    cfg.IntOpt('sql_shard_map_ttl', default=30,
+               help=_('Seconds a tenant\'s shard is cached for, and so how '
+                      'long moving a tenant waits for every process to '
+                      'notice the move')),
 ]
 
 CONF = cfg.CONF
@@ -68,11 +127,13 @@ def setup_db_env():
     """
     Setup configuration for database
     """
-    global sa_logger, _IDLE_TIMEOUT, _MAX_RETRIES, _RETRY_INTERVAL, _CONNECTION
+    global sa_logger, _IDLE_TIMEOUT, _MAX_RETRIES, _RETRY_INTERVAL, \
+        _MAX_RETRY_INTERVAL, _CONNECTION
 
     _IDLE_TIMEOUT = CONF.sql_idle_timeout
     _MAX_RETRIES = CONF.sql_max_retries
     _RETRY_INTERVAL = CONF.sql_retry_interval
+    _MAX_RETRY_INTERVAL = CONF.sql_max_retry_interval
     _CONNECTION = CONF.sql_connection
     LOG.debug("Sql connection = {0}".format(_CONNECTION))
     sa_logger = logging.getLogger('sqlalchemy.engine')
@@ -84,85 +145,771 @@ def configure_db():
     """
     Establish the database, create an engine if needed, and
     register the models.
+
+    Only the first call in a process does any work, so every repository
+    can call this when constructed.
     """
-    setup_db_env()
     get_engine()
 
 
 def get_session(autocommit=True, expire_on_commit=False):
-    """Helper method to grab session"""
-    global _MAKER
-    if not _MAKER:
-        get_engine()
-        get_maker(autocommit, expire_on_commit)
-        assert(_MAKER)
-    session = _MAKER()
+    """
+    Helper method to grab session: the current request's session if one
+    was begun, otherwise a new one.
+    """
+    session = _get_request_session()
+    if session:
+        return session
+
+    placement = _get_placement()
+    if placement is not None:
+        return placement.shard.get_maker()()
+    return get_maker(autocommit, expire_on_commit)()
+
+
+def _get_request_session():
+    return getattr(local.weak_store, 'db_session', None)
+
+
+def get_read_session(session=None):
+    """
+    Helper method to grab a session for reads that may be served by a read
+    replica: the given session if any, else a replica session shared by
+    the rest of the current request, else get_session().
+
+    Reads stay on the primary outside of requests (as workers must see
+    what requests just wrote), once the request has written, and for a
+    short window after its tenant last wrote.
+    """
+    if session:
+        return session
+
+    request_session = _get_request_session()
+    if request_session is None or request_session.read_from_primary or \
+            not _get_read_makers():
+        return get_session()
+
+    if request_session.read_session is None:
+        request_session.read_session = _next_read_maker()()
+    return request_session.read_session
+
+
+def _get_recent_writers():
+    global _RECENT_WRITERS
+    if _RECENT_WRITERS is None:
+        _RECENT_WRITERS = cache.LRUCache(10000,
+                                         CONF.sql_read_your_writes_window)
+    return _RECENT_WRITERS
+
+
+def _get_read_makers():
+    """Return a sessionmaker per read replica, creating them on first use"""
+    global _READ_MAKERS
+    if _READ_MAKERS is None:
+        with _READ_MAKERS_LOCK:
+            if _READ_MAKERS is None:
+                makers = [sa_orm.sessionmaker(
+                    bind=_create_secondary_engine(conn),
+                    autocommit=True,
+                    expire_on_commit=False)
+                    for conn in CONF.sql_read_connection]
+                _READ_MAKERS = (makers, itertools.cycle(makers))
+    return _READ_MAKERS[0]
+
+
+def _next_read_maker():
+    with _READ_MAKERS_LOCK:
+        return next(_READ_MAKERS[1])
+
+
+def _create_secondary_engine(connection):
+    """Create an engine for a read replica or shard."""
+    connection_dict = sqlalchemy.engine.url.make_url(connection)
+    engine_args = {'pool_recycle': CONF.sql_idle_timeout,
+                   'echo': False,
+                   'convert_unicode': True}
+    engine_args.update(_get_pool_args(connection_dict))
+
+    LOG.debug("Sql secondary connection: {0}; Args: {1}".format(connection,
+                                                           engine_args))
+    engine = sqlalchemy.create_engine(connection, **engine_args)
+    if CONF.sql_pool_pre_ping:
+        sqlalchemy.event.listen(engine, 'checkout', ping_listener)
+    if _MAX_RETRIES is None:
+        setup_db_env()
+    _guard_connections(engine)
+    return engine
+
+
+def _is_write(statement):
+    return not statement.lstrip()[:6].upper() == 'SELECT'
+
+
+def _note_request_write(conn, cursor, statement, *args):
+    """Pin the current request's reads to the primary once it writes."""
+    session = _get_request_session()
+    if session is not None and not session.wrote and _is_write(statement):
+        session.wrote = session.read_from_primary = True
+
+
+def _reject_moving_tenant_write(conn, cursor, statement, *args):
+    """Fail writes for a tenant whose entities are moving between shards."""
+    placement = _get_placement()
+    if placement is not None and placement.moving and _is_write(statement):
+        raise exception.ServiceUnavailable(retry=CONF.sql_shard_map_ttl)
+
+
+def _get_independent_session():
+    """
+    Return a new session, routed to the same shard as get_session(), whose
+    transactions commit independently of the current request's.
+    """
+    placement = _get_placement()
+    maker = placement.shard.get_maker() if placement else get_maker()
+    return maker()
+
+
+def begin_request_session(client_id=None):
+    """
+    Begin a session, and a transaction within it, that get_session() will
+    return to every repository used by the current request (thread or
+    greenthread) until end_request_session() is called.
+
+    The caller must hold a reference to the returned session, as the
+    request-local holder only keeps a weak one.
+
+    :param client_id: identifies the client (its tenant's keystone ID) for
+                      routing to the tenant's shard, and for read-your-writes
+                      routing between replicas
+    """
+    placement = _lookup_placement(client_id)
+    maker = placement.shard.get_maker() if placement else get_maker()
+    session = maker()
+    session.begin()
+    session.client_id = client_id
+    session.placement = placement
+    session.wrote = False
+    session.read_session = None
+    session.commit_hooks = []
+    # Replicas only mirror sql_connection, not the other shards.
+    session.read_from_primary = bool(client_id) and (
+        (placement is not None and placement.shard.connection is not None)
+        or _get_recent_writers().get(client_id) is not None)
+    local.weak_store.db_session = session
     return session
 
 
-def get_engine():
-    """Return a SQLAlchemy engine."""
-    """May assign _ENGINE if not already assigned"""
-    global _ENGINE, sa_logger, _CONNECTION, _IDLE_TIMEOUT, _MAX_RETRIES, \
-        _RETRY_INTERVAL
+def commit_request_session():
+    """
+    Commit the current request's work so far, such as before handing new
+    entities to other processes, and begin a new transaction for the rest
+    of the request. Does nothing if no request session was begun.
+    """
+    session = _get_request_session()
+    if session:
+        session.commit()
+        _run_commit_hooks(session)
+        session.begin()
 
-    if not _ENGINE:
-        tries = _MAX_RETRIES
-        retry_interval = _RETRY_INTERVAL
 
-        connection_dict = sqlalchemy.engine.url.make_url(_CONNECTION)
+def after_request_commit(func, *args):
+    """
+    Call func(*args) once the current request's work so far has been
+    committed, such as to cache what it wrote, or at once outside of a
+    request. The call is dropped if the request is rolled back instead.
+    """
+    session = _get_request_session()
+    if session is None:
+        func(*args)
+    else:
+        session.commit_hooks.append((func, args))
 
-        engine_args = {
-            'pool_recycle': _IDLE_TIMEOUT,
-            'echo': False,
-            'convert_unicode': True}
 
+def _run_commit_hooks(session):
+    hooks, session.commit_hooks = session.commit_hooks, []
+    for func, args in hooks:
         try:
-            LOG.debug("Sql connection: {0}; Args: {1}".format(_CONNECTION,
-                                                              engine_args))
-            _ENGINE = sqlalchemy.create_engine(_CONNECTION, **engine_args)
-
-#TODO:          if 'mysql' in connection_dict.drivername:
-#TODO:          sqlalchemy.event.listen(_ENGINE, 'checkout', ping_listener)
-
-            _ENGINE.connect = wrap_db_error(_ENGINE.connect)
-            _ENGINE.connect()
-        except Exception as err:
-            msg = _("Error configuring registry database with supplied "
-                    "sql_connection. Got error: %s") % err
-            LOG.error(msg)
-            raise
-
-        sa_logger = logging.getLogger('sqlalchemy.engine')
-        if CONF.debug:
-            sa_logger.setLevel(logging.DEBUG)
-
-        if CONF.db_auto_create:
-            LOG.info(_('auto-creating barbican registry DB'))
-            models.register_models(_ENGINE)
-#TODO:      try:
-#TODO:          migration.version_control()
-#TODO:      except exception.DatabaseMigrationError:
-#TODO:          # only arises when the DB exists and is under version control
-#TODO:          pass
-        else:
-            LOG.info(_('not auto-creating barbican registry DB'))
+            func(*args)
+        except Exception:
+            LOG.exception(_('Problem running request commit hook'))
+
+
+def end_request_session(session, commit=True):
+    """Commit or roll back, then close, a begin_request_session() session"""
+    try:
+        if session.transaction is not None:
+            if commit:
+                session.commit()
+                _run_commit_hooks(session)
+            else:
+                session.rollback()
+        if commit and session.wrote and session.client_id:
+            _get_recent_writers().put(session.client_id, True)
+    finally:
+        session.close()
+        if session.read_session is not None:
+            session.read_session.close()
+        if _get_request_session() is session:
+            del local.weak_store.db_session
+
+
+def get_engine():
+    """
+    Return the SQLAlchemy engine, creating it on first use.
 
+    Creation is serialized, so that concurrent first requests share a
+    single engine (and connection pool) per process.
+    """
+    if _ENGINE is None:
+        with _ENGINE_LOCK:
+            if _ENGINE is None:
+                setup_db_env()
+                _create_engine()
     return _ENGINE
 
 
+def _create_engine():
+    """
+    Create the engine and bring the schema up to date, only then
+    publishing the engine for other threads to use.
+    """
+    global _ENGINE, _BREAKER, sa_logger
+
+    connection_dict = sqlalchemy.engine.url.make_url(_CONNECTION)
+
+    engine_args = {
+        'pool_recycle': _IDLE_TIMEOUT,
+        'echo': False,
+        'convert_unicode': True}
+    engine_args.update(_get_pool_args(connection_dict))
+
+    try:
+        LOG.debug("Sql connection: {0}; Args: {1}".format(_CONNECTION,
+                                                          engine_args))
+        engine = sqlalchemy.create_engine(_CONNECTION, **engine_args)
+
+        if CONF.sql_pool_pre_ping:
+            sqlalchemy.event.listen(engine, 'checkout', ping_listener)
+        if CONF.sql_read_connection:
+            sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                                    _note_request_write)
+        if CONF.sql_shard_connection:
+            sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                                    _reject_moving_tenant_write)
+
+        # Wait out the database at start-up; once up, fail fast
+        #   through the breaker whenever it is known to be down.
+        wrap_db_error(engine.connect)().close()
+        breaker = _guard_connections(engine)
+    except Exception as err:
+        msg = _("Error configuring registry database with supplied "
+                "sql_connection. Got error: %s") % err
+        LOG.error(msg)
+        raise
+
+    sa_logger = logging.getLogger('sqlalchemy.engine')
+    if CONF.debug:
+        sa_logger.setLevel(logging.DEBUG)
+
+    if CONF.db_auto_create:
+        LOG.info(_('auto-creating barbican registry DB'))
+        migration.db_sync(engine)
+    else:
+        LOG.info(_('not auto-creating barbican registry DB'))
+
+    _BREAKER = breaker
+    _ENGINE = engine
+
+
 def get_maker(autocommit=True, expire_on_commit=False):
-    """Return a SQLAlchemy sessionmaker."""
-    """May assign __MAKER if not already assigned"""
-    global _MAKER, _ENGINE
-    assert _ENGINE
-    if not _MAKER:
-        _MAKER = sa_orm.sessionmaker(bind=_ENGINE,
-                                     autocommit=autocommit,
-                                     expire_on_commit=expire_on_commit)
+    """Return the SQLAlchemy sessionmaker, creating it on first use."""
+    global _MAKER
+    if _MAKER is None:
+        engine = get_engine()
+        with _ENGINE_LOCK:
+            if _MAKER is None:
+                _MAKER = sa_orm.sessionmaker(
+                    bind=engine,
+                    autocommit=autocommit,
+                    expire_on_commit=expire_on_commit)
     return _MAKER
 
 
+DEFAULT_SHARD = 'default'
+
+# Points per shard on the hash ring; more spread tenants more evenly.
+_SHARD_VNODES = 100
+
+# Rows of a tenant copied per statement when moving it between shards.
+_MOVE_BATCH_SIZE = 500
+
+
+class Shard(object):
+    """A database storing the entities of a share of the tenants."""
+
+    def __init__(self, name, connection=None):
+        """
+        :param name: name tenants are placed on the shard by
+        :param connection: connection string, or None for sql_connection
+        """
+        self.name = name
+        self.connection = connection
+        self._engine = None
+        self._maker = None
+        self._lock = threading.Lock()
+
+    def get_engine(self):
+        """Return the shard's engine, creating it on first use."""
+        if self.connection is None:
+            return get_engine()
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    self._engine = _create_shard_engine(self.connection)
+        return self._engine
+
+    def get_maker(self):
+        """Return the shard's sessionmaker, creating it on first use."""
+        if self.connection is None:
+            return get_maker()
+        if self._maker is None:
+            engine = self.get_engine()
+            with self._lock:
+                if self._maker is None:
+                    self._maker = sa_orm.sessionmaker(bind=engine,
+                                                      autocommit=True,
+                                                      expire_on_commit=False)
+        return self._maker
+
+
+class TenantPlacement(object):
+    """The shard a tenant's entities are in, and if they are moving."""
+
+    def __init__(self, shard, moving=False):
+        self.shard = shard
+        self.moving = moving
+
+
+def _hash_key(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class ShardMap(object):
+    """
+    Maps tenants to shards.
+
+    A tenant is on the shard its keystone ID hashes to on a consistent hash
+    ring, so adding a shard only remaps a share of the tenants, unless the
+    tenant_shards table places it on another shard. Placements are cached
+    for ttl seconds.
+    """
+
+    def __init__(self, shards, ttl):
+        """
+        :param shards: list of Shards, the sql_connection one first
+        :param ttl: seconds a tenant's placement is cached for
+        """
+        self.shards = shards
+        self._shards = dict((shard.name, shard) for shard in shards)
+        ring = sorted((_hash_key('{0}-{1}'.format(shard.name, idx)),
+                       shard.name)
+                      for shard in shards for idx in xrange(_SHARD_VNODES))
+        self._ring_keys = [key for key, name in ring]
+        self._ring_names = [name for key, name in ring]
+        self._placements = cache.LRUCache(10000, ttl)
+
+    def get_shard(self, name):
+        try:
+            return self._shards[name]
+        except KeyError:
+            raise exception.UnknownShard(shard=name)
+
+    def hashed_shard(self, keystone_id):
+        """Return the shard keystone_id hashes to."""
+        idx = bisect.bisect(self._ring_keys, _hash_key(keystone_id))
+        return self._shards[self._ring_names[idx % len(self._ring_names)]]
+
+    def lookup(self, keystone_id):
+        """Return keystone_id's TenantPlacement, as cached if it was."""
+        placement = self._placements.get(keystone_id)
+        if placement is None:
+            placement = self.load(keystone_id)
+            self._placements.put(keystone_id, placement)
+        return placement
+
+    def load(self, keystone_id):
+        """Return keystone_id's TenantPlacement, as currently stored."""
+        table = models.TenantShard.__table__
+        row = get_engine().execute(
+            sa_sql.select([table.c.shard, table.c.moving])
+            .where(table.c.keystone_id == keystone_id)).first()
+        if row is None:
+            return TenantPlacement(self.hashed_shard(keystone_id))
+        return TenantPlacement(self.get_shard(row['shard']), row['moving'])
+
+    def invalidate(self, keystone_id):
+        self._placements.invalidate(keystone_id)
+
+
+def get_shard_map():
+    """Return the ShardMap, built from configuration on first use."""
+    global _SHARD_MAP
+    if _SHARD_MAP is None:
+        with _ENGINE_LOCK:
+            if _SHARD_MAP is None:
+                shards = [Shard(DEFAULT_SHARD)]
+                for entry in CONF.sql_shard_connection:
+                    name, sep, connection = entry.partition('=')
+                    shards.append(Shard(name.strip(), connection.strip()))
+                _SHARD_MAP = ShardMap(shards, CONF.sql_shard_map_ttl)
+    return _SHARD_MAP
+
+
+def _create_shard_engine(connection):
+    engine = _create_secondary_engine(connection)
+    sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                            _reject_moving_tenant_write)
+    if CONF.db_auto_create:
+        migration.db_sync(engine)
+    return engine
+
+
+def _lookup_placement(keystone_id):
+    """
+    Return the placement of keystone_id's entities, or None if all tenants
+    share sql_connection.
+    """
+    if not keystone_id or not CONF.sql_shard_connection:
+        return None
+    return get_shard_map().lookup(keystone_id)
+
+
+def _get_placement():
+    """Return the placement sessions are currently routed by, if any."""
+    session = _get_request_session()
+    if session is not None:
+        return session.placement
+    return getattr(local.weak_store, 'placement', None)
+
+
+@contextlib.contextmanager
+def _placement_scope(placement):
+    if placement is not None:
+        local.weak_store.placement = placement
+    try:
+        yield placement
+    finally:
+        if placement is not None:
+            del local.weak_store.placement
+
+
+def tenant_scope(keystone_id):
+    """
+    Context manager routing sessions begun outside of a request, such as
+    by workers, to keystone_id's shard.
+    """
+    return _placement_scope(_lookup_placement(keystone_id))
+
+
+def shard_scope(shard):
+    """Context manager routing sessions to the given Shard."""
+    return _placement_scope(TenantPlacement(shard))
+
+
+def _place_tenant(keystone_id, shard, moving=False):
+    """Record keystone_id's shard, unless it is the one it hashes to."""
+    shard_map = get_shard_map()
+    table = models.TenantShard.__table__
+    with get_engine().begin() as conn:
+        conn.execute(table.delete().where(table.c.keystone_id == keystone_id))
+        if moving or shard is not shard_map.hashed_shard(keystone_id):
+            now = timeutils.utcnow()
+            conn.execute(table.insert().values(
+                id=uuidutils.generate_uuid(), created_at=now,
+                updated_at=now, deleted=False, status=models.States.ACTIVE,
+                keystone_id=keystone_id, shard=shard.name, moving=moving))
+    shard_map.invalidate(keystone_id)
+
+
+def _in_batches(values):
+    for idx in xrange(0, len(values), _MOVE_BATCH_SIZE):
+        yield values[idx:idx + _MOVE_BATCH_SIZE]
+
+
+def _select_column(conn, column, where_column, values):
+    selected = []
+    for batch in _in_batches(values):
+        selected.extend(row[0] for row in conn.execute(
+            sa_sql.select([column]).where(where_column.in_(batch))))
+    return selected
+
+
+def _tenant_rows(conn, keystone_id):
+    """
+    Return (column, values) pairs that select keystone_id's rows, parent
+    tables ahead of the tables that reference them.
+    """
+    tenants = models.Tenant.__table__
+    tenant_usage = models.TenantUsage.__table__
+    tenant_secret = models.TenantSecret.__table__
+    secrets = models.Secret.__table__
+    datum = models.EncryptedDatum.__table__
+    orders = models.Order.__table__
+    idempotency_keys = models.IdempotencyKey.__table__
+
+    tenant_ids = _select_column(conn, tenants.c.id, tenants.c.keystone_id,
+                                [keystone_id])
+    secret_ids = _select_column(conn, tenant_secret.c.secret_id,
+                                tenant_secret.c.tenant_id, tenant_ids)
+    return [(tenants.c.id, tenant_ids),
+            (tenant_usage.c.tenant_id, tenant_ids),
+            (secrets.c.id, secret_ids),
+            (datum.c.secret_id, secret_ids),
+            (tenant_secret.c.tenant_id, tenant_ids),
+            (orders.c.tenant_id, tenant_ids),
+            (idempotency_keys.c.keystone_id, [keystone_id])]
+
+
+def _delete_rows(engine, tenant_rows):
+    with engine.begin() as conn:
+        for column, values in reversed(tenant_rows):
+            for batch in _in_batches(values):
+                conn.execute(column.table.delete().where(column.in_(batch)))
+
+
+def _copy_rows(source, target, tenant_rows):
+    counts = {}
+    with source.connect() as conn:
+        for column, values in tenant_rows:
+            table = column.table
+            counts[table.name] = 0
+            for batch in _in_batches(values):
+                rows = [dict(row) for row in conn.execute(
+                    table.select().where(column.in_(batch)))]
+                if rows:
+                    target.execute(table.insert(), rows)
+                counts[table.name] += len(rows)
+    return counts
+
+
+def move_tenant(keystone_id, shard_name, settle=None):
+    """
+    Move keystone_id's entities to the named shard, while the tenant's
+    requests continue to be served.
+
+    The tenant is first marked as moving, and once every process has seen
+    that its requests may read but not write (with a 503) while its rows
+    are copied. It is then placed on the new shard, and its rows on the old
+    one deleted once no process still routes its requests there.
+
+    :param settle: seconds processes take to notice the tenant's placement
+                   change, by default sql_shard_map_ttl
+    :returns: dict of the number of rows moved per table
+    """
+    shard_map = get_shard_map()
+    target = shard_map.get_shard(shard_name)
+    source = shard_map.load(keystone_id).shard
+    if source is target:
+        return {}
+    if settle is None:
+        settle = CONF.sql_shard_map_ttl
+
+    LOG.info(_("Moving tenant {0} from shard {1} to {2}").format(
+        keystone_id, source.name, target.name))
+    _place_tenant(keystone_id, source, moving=True)
+    time.sleep(settle)
+    try:
+        tenant_rows = _tenant_rows(source.get_engine(), keystone_id)
+        # Clear out anything an earlier, failed, move left behind.
+        _delete_rows(target.get_engine(), tenant_rows)
+        counts = _copy_rows(source.get_engine(), target.get_engine(),
+                            tenant_rows)
+    except Exception:
+        _place_tenant(keystone_id, source)
+        raise
+
+    _place_tenant(keystone_id, target)
+    time.sleep(settle)
+    _delete_rows(source.get_engine(), tenant_rows)
+    return counts
+
+
+def pin_tenants():
+    """
+    Place each tenant explicitly on the shard its entities are stored in,
+    where that is no longer the one its keystone ID hashes to, such as
+    after adding a shard. Run this before serving requests with the new
+    shard configuration, and move the tenants at leisure afterwards.
+
+    :returns: number of tenants pinned
+    """
+    shard_map = get_shard_map()
+    tenants = models.Tenant.__table__
+    pinned = 0
+    for shard in shard_map.shards:
+        rows = shard.get_engine().execute(
+            sa_sql.select([tenants.c.keystone_id]))
+        for keystone_id, in rows:
+            placement = shard_map.load(keystone_id)
+            if placement.shard is not shard and \
+                    placement.shard is shard_map.hashed_shard(keystone_id):
+                _place_tenant(keystone_id, shard)
+                pinned += 1
+    return pinned
+
+
+class InstrumentedQueuePool(sa_pool.QueuePool):
+    """
+    QueuePool that also counts checkouts and the time spent waiting for
+    them, whether for a free connection or for a new one to be opened.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(InstrumentedQueuePool, self)._do_get()
+        finally:
+            waited = time.time() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+
+
+def _get_pool_args(connection_dict):
+    """Return the create_engine() pool arguments for the database."""
+    # SQLite's default pools already suit it: one connection per thread
+    #   for in-memory databases, and no pooling for files.
+    if connection_dict.drivername.startswith('sqlite'):
+        return {}
+
+    return {'poolclass': InstrumentedQueuePool,
+            'pool_size': CONF.sql_pool_size,
+            'max_overflow': CONF.sql_max_overflow,
+            'pool_timeout': CONF.sql_pool_timeout}
+
+
+def ping_listener(dbapi_conn, connection_rec, connection_proxy):
+    """
+    Ensures that connections checked out of the pool are still alive.
+
+    A connection the database has dropped (for instance on restart, or
+    after MySQL's wait_timeout) is reported as a disconnect, so the pool
+    replaces it instead of handing it to a request that would then fail.
+    """
+    try:
+        cursor = dbapi_conn.cursor()
+        cursor.execute('SELECT 1')
+        cursor.close()
+    except Exception as err:
+        LOG.warning(_('Pooled database connection is stale: %s'), err)
+        raise sqlalchemy.exc.DisconnectionError(str(err))
+
+
+def get_pool_stats():
+    """
+    Return a dict of counters describing the engine's connection pool, or
+    None if the engine has not been created yet.
+    """
+    if not _ENGINE:
+        return None
+
+    pool = _ENGINE.pool
+    stats = {'pool': pool.__class__.__name__,
+             'circuit_breaker': 'open' if _BREAKER and _BREAKER.is_open
+                                else 'closed'}
+    if isinstance(pool, sa_pool.QueuePool):
+        stats.update({'size': pool.size(),
+                      'checked_in': pool.checkedin(),
+                      'checked_out': pool.checkedout(),
+                      'overflow': max(pool.overflow(), 0)})
+    if isinstance(pool, InstrumentedQueuePool):
+        with pool._stats_lock:
+            stats.update({'checkouts': pool.checkouts,
+                          'wait_time': pool.wait_time,
+                          'max_wait_time': pool.max_wait_time})
+    return stats
+
+
+def _attach(entity, session):
+    """
+    Return entity as attached to session, copying its state over if it was
+    read through another session (such as a read replica's).
+    """
+    other = sa_orm.object_session(entity)
+    if other is not None and other is not session:
+        return session.merge(entity)
+    return entity
+
+
+def _tombstones_query(model, deleted_before, session):
+    """Query the IDs of model's rows soft-deleted before deleted_before."""
+    return session.query(model.id)\
+        .filter(model.deleted == True)\
+        .filter(model.deleted_at < deleted_before)\
+        .order_by(model.deleted_at)
+
+
+def _add_usage(tenant_id, session, **deltas):
+    """
+    Add deltas (such as secrets=1) to the tenant's usage counts, creating
+    its usage row if need be.
+
+    Each count is changed relative to its current value, so that
+    concurrent changes to the tenant's usage are never lost.
+    """
+    table = models.TenantUsage.__table__
+    now = timeutils.utcnow()
+    values = dict((name, table.c[name] + delta)
+                  for name, delta in deltas.iteritems())
+    values['updated_at'] = now
+    update = table.update().where(table.c.tenant_id == tenant_id)\
+        .values(values)
+
+    if session.execute(update).rowcount:
+        return
+
+    insert = InsertIgnoringDuplicates(table, values={
+        'id': uuidutils.generate_uuid(),
+        'tenant_id': tenant_id,
+        'created_at': now,
+        'updated_at': now,
+        'deleted': False,
+        'status': models.States.ACTIVE,
+        'secrets': 0,
+        'orders': 0})
+    try:
+        session.execute(insert)
+    except sqlalchemy.exc.IntegrityError:
+        # Dialects without an insert-or-ignore form report a row added
+        #   concurrently instead; it is updated all the same.
+        LOG.debug("...tenant usage already exists")
+    session.execute(update)
+
+
+def _add_usage_by_tenant(tenant_counts, name, sign, session):
+    """Add sign times each (tenant_id, count) pair to the named count."""
+    # In tenant ID order, the order TenantUsageRepo.reconcile() locks usage
+    #   rows in, so that the two cannot deadlock.
+    for tenant_id, count in sorted(tenant_counts):
+        _add_usage(tenant_id, session, **{name: sign * count})
+
+
+def _delete_where_in(column, values, session):
+    """Hard-delete the rows whose column is one of values, in one DELETE."""
+    return session.query(column.class_).filter(column.in_(values))\
+        .delete(synchronize_session=False)
+
+
 def is_db_connection_error(args):
     """Return True if error in connecting to db."""
     # NOTE(adam_g): This is currently MySQL specific and needs to be extended
@@ -174,35 +921,251 @@ def is_db_connection_error(args):
     return False
 
 
-def wrap_db_error(f):
-    """Retry DB connection. Copied from nova and modified."""
+def _backoff(attempt):
+    """
+    Seconds to wait before retry number attempt (from 0): exponential
+    backoff, capped, with full jitter so that workers retrying together
+    spread their attempts out.
+    """
+    cap = min(_MAX_RETRY_INTERVAL, _RETRY_INTERVAL * 2 ** attempt)
+    return random.uniform(0, cap)
+
+
+class CircuitBreaker(object):
+    """
+    Process-wide breaker for database connections.
+
+    After threshold consecutive connection failures the breaker opens, and
+    connections then fail at once with ServiceUnavailable rather than
+    holding their thread in retries. Meanwhile a background thread probes
+    the database, with backoff, and closes the breaker once it is back.
+    """
+
+    def __init__(self, threshold, probe):
+        """
+        :param threshold: consecutive failures that open the breaker
+        :param probe: callable that raises if the database is unreachable
+        """
+        self.threshold = threshold
+        self.probe = probe
+        self.failures = 0
+        self.is_open = False
+        self._lock = threading.Lock()
+
+    def check(self):
+        """Raise ServiceUnavailable if the breaker is open."""
+        if self.is_open:
+            raise exception.ServiceUnavailable(retry=_MAX_RETRY_INTERVAL)
+
+    def record_success(self):
+        if self.failures:
+            with self._lock:
+                self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.is_open or self.failures < self.threshold:
+                return
+            self.is_open = True
+
+        LOG.error(_('Database unreachable, failing requests until it '
+                    'recovers'))
+        prober = threading.Thread(target=self._probe_until_closed,
+                                  name='db-circuit-breaker')
+        prober.daemon = True
+        prober.start()
+
+    def _probe_until_closed(self):
+        attempt = 0
+        while True:
+            time.sleep(_backoff(attempt))
+            attempt += 1
+            try:
+                self.probe()
+            except sqlalchemy.exc.OperationalError as e:
+                if is_db_connection_error(e.args[0]):
+                    continue
+                # Any other error means the database is at least up.
+                LOG.exception(_('Problem probing the database'))
+            except Exception:
+                LOG.exception(_('Problem probing the database'))
+                continue
+
+            with self._lock:
+                self.failures = 0
+                self.is_open = False
+            LOG.info(_('Database reachable again'))
+            return
+
+
+def _create_circuit_breaker(connect):
+    """Return a circuit breaker probing with connect, if one is enabled."""
+    if CONF.sql_circuit_breaker_threshold <= 0:
+        return None
+    return CircuitBreaker(CONF.sql_circuit_breaker_threshold,
+                          lambda: connect().close())
+
+
+def _guard_connections(engine):
+    """
+    Retry the engine's connections with backoff, failing them fast through
+    a circuit breaker of the engine's own once its database is known to be
+    down, so that one unreachable replica or shard trips only its breaker.
+
+    :returns: the engine's breaker, or None if breakers are disabled
+    """
+    connect = engine.connect
+    contextual_connect = engine.contextual_connect
+    breaker = _create_circuit_breaker(connect)
+    engine.connect = wrap_db_error(connect, breaker)
+    engine.contextual_connect = wrap_db_error(contextual_connect, breaker)
+    return breaker
+
+
+def wrap_db_error(f, breaker=None):
+    """
+    Retry DB connection, with capped exponential backoff and jitter.
+    Copied from nova and modified.
+
+    Failures are reported to the breaker, if given, and once it is open
+    ServiceUnavailable is raised rather than retrying further.
+    """
     def _wrap(*args, **kwargs):
-        try:
-            return f(*args, **kwargs)
-        except sqlalchemy.exc.OperationalError as e:
-            if not is_db_connection_error(e.args[0]):
-                raise
+        attempt = 0
+        while True:
+            if breaker:
+                breaker.check()
+            try:
+                result = f(*args, **kwargs)
+            except sqlalchemy.exc.OperationalError as e:
+                if not is_db_connection_error(e.args[0]):
+                    raise
+                if breaker:
+                    breaker.record_failure()
 
-            remaining_attempts = _MAX_RETRIES
-            while True:
+                remaining_attempts = _MAX_RETRIES - attempt
+                if remaining_attempts <= 0:
+                    raise
                 LOG.warning(_('SQL connection failed. %d attempts left.'),
                             remaining_attempts)
-                remaining_attempts -= 1
-                time.sleep(_RETRY_INTERVAL)
-                try:
-                    return f(*args, **kwargs)
-                except sqlalchemy.exc.OperationalError as e:
-                    if (remaining_attempts == 0 or not
-                            is_db_connection_error(e.args[0])):
-                        raise
-                except sqlalchemy.exc.DBAPIError:
-                    raise
-        except sqlalchemy.exc.DBAPIError:
-            raise
+                time.sleep(_backoff(attempt))
+                attempt += 1
+            else:
+                if breaker:
+                    breaker.record_success()
+                return result
     _wrap.func_name = f.func_name
     return _wrap
 
 
+class InsertIgnoringDuplicates(sa_sql.expression.Insert):
+    """
+    INSERT statement that silently skips a row violating a unique
+    constraint, rather than failing.
+    """
+
+
+@compiles(InsertIgnoringDuplicates)
+def _compile_insert_ignoring_duplicates(insert, compiler, **kw):
+    """Other dialects: a plain INSERT, so callers must handle IntegrityError"""
+    return compiler.visit_insert(insert, **kw)
+
+
+@compiles(InsertIgnoringDuplicates, 'postgresql')
+def _compile_insert_ignoring_duplicates_postgresql(insert, compiler, **kw):
+    return compiler.visit_insert(insert, **kw) + ' ON CONFLICT DO NOTHING'
+
+
+@compiles(InsertIgnoringDuplicates, 'mysql')
+def _compile_insert_ignoring_duplicates_mysql(insert, compiler, **kw):
+    return compiler.visit_insert(insert, **kw) + \
+        ' ON DUPLICATE KEY UPDATE id = id'
+
+
+@compiles(InsertIgnoringDuplicates, 'sqlite')
+def _compile_insert_ignoring_duplicates_sqlite(insert, compiler, **kw):
+    return compiler.visit_insert(insert, **kw).replace(
+        'INSERT', 'INSERT OR IGNORE', 1)
+
+
+# CachedQuery runs queries through Query internals, as of SQLAlchemy 0.7,
+#   that later releases change without notice.
+_CACHE_COMPILED_QUERIES = sqlalchemy.__version__.split('.')[:2] == ['0', '7']
+
+
+class CachedQuery(object):
+    """
+    An ORM query that is built and compiled to SQL only once, then run
+    repeatedly with different bind parameter values.
+
+    Building a Query and compiling it (including any eager joins) costs
+    far more than the lookup itself for the simple, hot lookups repositories
+    perform, so those are instead built once from a template with
+    sqlalchemy.sql.bindparam() placeholders. The compiled SQL is kept per
+    dialect, as the primary and read replicas may differ.
+
+    With SQLAlchemy releases other than 0.7, whose Query internals this
+    relies on, the template Query is run normally instead, compiling it
+    each time.
+    """
+
+    def __init__(self, build):
+        """
+        :param build: callable taking a session and returning the template
+                      Query, using bindparam() for all varying values. The
+                      session is used only to build the query.
+        """
+        self._query = build(sa_orm.Session())
+        self._compiled = weakref.WeakKeyDictionary()
+        if _CACHE_COMPILED_QUERIES:
+            self._context = self._query._compile_context()
+            self._mapper = self._query._mapper_zero()
+
+    def _compile(self, dialect):
+        # Racing threads may both compile, which is harmless.
+        compiled = self._compiled.get(dialect)
+        if compiled is None:
+            compiled = self._context.statement.compile(dialect=dialect)
+            self._compiled[dialect] = compiled
+        return compiled
+
+    def all(self, session, **params):
+        """Run the query in session, returning all the resulting entities."""
+        query = self._query.with_session(session)
+        if not _CACHE_COMPILED_QUERIES:
+            return query.params(**params).all()
+
+        # Mirror Query.__iter__(), with a fresh copy of the compile context
+        #   for this run.
+        context = copy.copy(self._context)
+        context.query = query
+        context.session = session
+        context.attributes = self._context.attributes.copy()
+
+        if session.autoflush:
+            session.flush()
+
+        conn = session.connection(mapper=self._mapper, close_with_result=True)
+        compiled = self._compile(conn.dialect)
+        return list(query.instances(conn.execute(compiled, **params),
+                                    context))
+
+    def one(self, session, **params):
+        """
+        Run the query in session, returning the single resulting entity.
+
+        :raises NoResultFound, MultipleResultsFound: as for Query.one()
+        """
+        entities = self.all(session, **params)
+        if not entities:
+            raise sa_orm.exc.NoResultFound("No row was found for one()")
+        if len(entities) > 1:
+            raise sa_orm.exc.MultipleResultsFound(
+                "Multiple rows were found for one()")
+        return entities[0]
+
+
 class BaseRepo(object):
     """
     Base repository for the barbican entities.
@@ -211,6 +1174,9 @@ class BaseRepo(object):
     specific functionality as needed.
     """
 
+    # Cached lookup queries, keyed by repository class and lookup.
+    _cached_queries = {}
+
     def __init__(self):
         LOG.debug("BaseRepo init...")
         configure_db()
@@ -219,15 +1185,33 @@ class BaseRepo(object):
         LOG.debug("Getting session...")
         return session or get_session()
 
+    def get_read_session(self, session=None):
+        """Return a session for reads that a replica may serve."""
+        return session or get_read_session()
+
+    def _get_cached_query(self, key, build):
+        """
+        Returns the CachedQuery for this repository's lookup named by key,
+        built (by the build callable) on first use.
+
+        The key must identify the query's shape, not its bound values.
+        """
+        cache_key = (self.__class__, key)
+        query = self._cached_queries.get(cache_key)
+        if query is None:
+            query = CachedQuery(build)
+            self._cached_queries[cache_key] = query
+        return query
+
     def find_by_name(self, name, suppress_exception=False, session=None):
-        session = self.get_session(session)
+        session = self.get_read_session(session)
 
         try:
-            LOG.debug("Starting find by name steps...")
-            query = self._do_build_query_by_name(name, session)
-            LOG.debug("...query = {0}".format(repr(query)))
-            entity = query.one()
-            LOG.debug("...post query.one()")
+            query = self._get_cached_query(
+                'find_by_name',
+                lambda session: self._do_build_query_by_name(
+                    sa_sql.bindparam('name'), session))
+            entity = query.one(session, name=name)
 
         except sa_orm.exc.NoResultFound:
             entity = None
@@ -238,18 +1222,31 @@ class BaseRepo(object):
         return entity
 
     def get(self, entity_id, force_show_deleted=False,
-            suppress_exception=False, session=None):
-        """Get an entity or raise if it does not exist."""
-        session = self.get_session(session)
+            suppress_exception=False, session=None, options=None):
+        """
+        Get an entity or raise if it does not exist.
 
-        try:
-            query = self._do_build_get_query(entity_id, session)
+        :param options: extra query options, such as to undefer columns.
+                        As these are part of the cached query's key, pass
+                        the same (constant) options object for each lookup.
+        """
+        session = self.get_read_session(session)
+
+        def build(session):
+            query = self._do_build_get_query(sa_sql.bindparam('entity_id'),
+                                             session)
+            if options:
+                query = query.options(*options)
 
             # filter out deleted entities if requested
             if not force_show_deleted:
                 query = query.filter_by(deleted=False)
+            return query
 
-            entity = query.one()
+        try:
+            query = self._get_cached_query(
+                ('get', force_show_deleted) + tuple(options or ()), build)
+            entity = query.one(session, entity_id=entity_id)
 
         except sa_orm.exc.NoResultFound:
             entity = None
@@ -259,12 +1256,37 @@ class BaseRepo(object):
 
         return entity
 
+    def get_last_modified(self, entity_id, session=None):
+        """
+        Returns when an entity was last modified, or None if it does not
+        exist (or is deleted).
+
+        Only timestamp columns are queried, so this is a cheap check ahead
+        of a full get() for conditional requests. The result matches the
+        entity's last_modified().
+        """
+        session = self.get_read_session(session)
+
+        query = self._do_build_last_modified_query(entity_id, session)
+        row = query.filter_by(deleted=False).first()
+        if not row:
+            return None
+        # Owned data's timestamps are None when the entity has none yet.
+        return max(value for value in row if value is not None)
+
     def create(self, values):
         """Create an entity from the values dictionary."""
         return self._update(None, values, False)
 
-    def create_from(self, entity):
-        """Sub-class hook: create from Tenant entity."""
+    def create_from(self, entity, session=None):
+        """
+        Sub-class hook: create from Tenant entity.
+
+        The entity itself is returned once written, rather than re-read:
+        its ID and timestamps are all generated client-side, so the flush
+        leaves it fully populated. Pass a session to write the entity as
+        part of a larger transaction already begun on it.
+        """
 
         if not entity:
             msg = "Must supply non-None {0}.".format(self._do_entity_name)
@@ -276,24 +1298,76 @@ class BaseRepo(object):
             raise exception.Invalid(msg)
 
         LOG.debug("Begin create from...")
-        session = get_session()
-        with session.begin():
+        session = self.get_session(session)
+        with session.begin(subtransactions=True):
 
             # Validate the attributes before we go any further. From my
             # (unknown Glance developer) investigation, the @validates
             # decorator does not validate
             # on new records, only on existing records, which is, well,
             # idiotic.
-            values = self._do_validate(entity.to_dict())
+            self._do_validate(entity.to_dict())
 
             try:
                 LOG.debug("Saving entity...")
                 entity.save(session=session)
             except sqlalchemy.exc.IntegrityError:
                 raise exception.Duplicate("Entity ID %s already exists!"
-                                          % values['id'])
+                                          % entity.id)
+
+            self._do_record_created([entity], session)
+
+        return entity
+
+    def create_batch(self, entities, session=None):
+        """
+        Creates new entities with a single batched INSERT statement.
+
+        Unlike create_from(), the entities are written with one
+        executemany() call against the entity's table rather than through
+        the ORM unit of work, and are not re-read afterwards. Pass in a
+        session with an active transaction to batch several entity types
+        into one transaction.
+
+        :param entities: list of new entities (i.e. with id=None)
+        :param session: optional session to execute the INSERT in
+        :returns: the entities, with their IDs and timestamps assigned
+        """
+        if not entities:
+            return entities
+
+        LOG.debug("Begin create batch of {0} {1}...".format(
+            len(entities), self._do_entity_name()))
+        now = timeutils.utcnow()
+        rows = []
+        for entity in entities:
+            if entity.id:
+                msg = "Must supply {0} with id=None(i.e. new entity).".format(
+                    self._do_entity_name())
+                raise exception.Invalid(msg)
+
+            entity.id = uuidutils.generate_uuid()
+            entity.created_at = entity.created_at or now
+            entity.updated_at = entity.updated_at or now
+            entity.deleted = entity.deleted or False
+            entity.status = entity.status or models.States.PENDING
+            self._do_validate(entity.to_dict())
+
+            rows.append(dict((column.name, getattr(entity, column.name))
+                             for column in entity.__table__.columns))
+
+        session = self.get_session(session)
+        with session.begin(subtransactions=True):
+            try:
+                session.execute(entities[0].__table__.insert(), rows)
+            except sqlalchemy.exc.IntegrityError:
+                raise exception.Duplicate("{0} batch contains an existing "
+                                          "entity!".format(
+                                              self._do_entity_name()))
+
+            self._do_record_created(entities, session)
 
-        return self.get(entity.id)
+        return entities
 
     def save(self, entity):
         """
@@ -302,7 +1376,8 @@ class BaseRepo(object):
         :raises NotFound if entity does not exist.
         """
         session = get_session()
-        with session.begin():
+        with session.begin(subtransactions=True):
+            entity = _attach(entity, session)
             entity.updated_at = timeutils.utcnow()
 
             # Validate the attributes before we go any further. From my
@@ -316,7 +1391,7 @@ class BaseRepo(object):
                 entity.save(session=session)
             except sqlalchemy.exc.IntegrityError:
                 raise exception.NotFound("Entity ID %s not found"
-                                         % entity_id)
+                                         % entity.id)
 
     def update(self, entity_id, values, purge_props=False):
         """
@@ -327,11 +1402,55 @@ class BaseRepo(object):
         return self._update(entity_id, values, purge_props)
 
     def delete_entity(self, entity):
-        """Remove the entity"""
+        """Soft-delete the entity"""
 
         session = get_session()
-        with session.begin():
+        with session.begin(subtransactions=True):
+            entity = _attach(entity, session)
+            was_deleted = entity.deleted
             entity.delete(session=session)
+            if not was_deleted:
+                self._do_record_deleted([entity.id], session)
+
+    def delete_entity_by_id(self, entity_id, session=None):
+        """
+        Soft-delete the entity with a single UPDATE, without reading it.
+
+        :raises NotFound if the entity does not exist (or is deleted).
+        """
+        session = self.get_session(session)
+
+        now = timeutils.utcnow()
+        with session.begin(subtransactions=True):
+            count = self._do_build_get_query(entity_id, session)\
+                .filter_by(deleted=False)\
+                .update({'deleted': True, 'deleted_at': now,
+                         'updated_at': now}, synchronize_session=False)
+            if count:
+                self._do_record_deleted([entity_id], session)
+        if not count:
+            raise exception.NotFound("No %s found with ID %s"
+                                     % (self._do_entity_name(), entity_id))
+
+    def purge_deleted(self, deleted_before, batch_size, session=None):
+        """
+        Hard-delete up to batch_size entities soft-deleted before
+        deleted_before, oldest first, in a single transaction.
+
+        :returns: the number of entities purged, which is less than
+                  batch_size once no more remain to be purged.
+        """
+        session = self.get_session(session)
+
+        with session.begin(subtransactions=True):
+            query = self._do_build_tombstones_query(deleted_before, session)
+            if query is None:
+                return 0
+
+            entity_ids = [row.id for row in query.limit(batch_size)]
+            if entity_ids:
+                self._do_purge(entity_ids, session)
+        return len(entity_ids)
 
     def _do_entity_name(self):
         """Sub-class hook: return entity name, such as for debugging."""
@@ -351,6 +1470,35 @@ class BaseRepo(object):
         """Sub-class hook: build a retrieve query."""
         return None
 
+    def _do_build_last_modified_query(self, entity_id, session):
+        """
+        Sub-class hook: build a query of the timestamp(s) that make up an
+        entity's last_modified().
+        """
+        return None
+
+    def _do_build_tombstones_query(self, deleted_before, session):
+        """
+        Sub-class hook: build a query of the IDs of entities soft-deleted
+        before deleted_before, or None if the entity is never purged.
+        """
+        return None
+
+    def _do_purge(self, entity_ids, session):
+        """Sub-class hook: hard-delete the given soft-deleted entities."""
+        pass
+
+    def _do_record_created(self, entities, session):
+        """Sub-class hook: count new entities in their tenants' usage."""
+        pass
+
+    def _do_record_deleted(self, entity_ids, session):
+        """
+        Sub-class hook: stop counting newly soft-deleted entities in their
+        tenants' usage.
+        """
+        pass
+
     def _do_convert_values(self, values):
         """
         Sub-class hook: convert text-based values to
@@ -389,7 +1537,7 @@ class BaseRepo(object):
                           find and update it
         """
         session = get_session()
-        with session.begin():
+        with session.begin(subtransactions=True):
 
             if entity_id:
                 entity_ref = self.get(entity_id, session=session)
@@ -422,7 +1570,7 @@ class BaseRepo(object):
                     raise exception.Duplicate("Entity ID %s already exists!"
                                               % values['id'])
 
-        return self.get(entity_ref.id)
+        return entity_ref
 
     def _update_values(self, entity_ref, values):
         for k in values:
@@ -453,17 +1601,47 @@ class TenantRepo(BaseRepo):
         """Sub-class hook: validate values."""
         pass
 
+    def create_or_get(self, keystone_id, session=None):
+        """
+        Returns the tenant for keystone_id, atomically creating it first if
+        it does not exist yet.
+
+        Relies on the unique index over keystone_id: concurrent callers may
+        all issue the insert, but only one row is ever created and every
+        caller then reads back that same row.
+        """
+        session = self.get_session(session)
+
+        now = timeutils.utcnow()
+        insert = InsertIgnoringDuplicates(models.Tenant.__table__, values={
+            'id': uuidutils.generate_uuid(),
+            'keystone_id': keystone_id,
+            'created_at': now,
+            'updated_at': now,
+            'deleted': False,
+            'status': models.States.ACTIVE})
+
+        LOG.debug("Upserting tenant for keystone-ID {0}...".format(
+            keystone_id))
+        try:
+            session.execute(insert)
+        except sqlalchemy.exc.IntegrityError:
+            # Dialects without an insert-or-ignore form report the
+            #   duplicate instead; the existing row is what we want.
+            LOG.debug("...tenant already exists")
+
+        return self.find_by_keystone_id(keystone_id, session=session)
+
     def find_by_keystone_id(self, keystone_id, suppress_exception=False,
                             session=None):
-        session = self.get_session(session)
+        session = self.get_read_session(session)
 
         try:
-            LOG.debug("Starting find by keystone_id steps...")
-            query = session.query(models.Tenant).filter_by(keystone_id=
-                                                           keystone_id)
-            LOG.debug("...query = {0}".format(repr(query)))
-            entity = query.one()
-            LOG.debug("...post query.one()")
+            query = self._get_cached_query(
+                'find_by_keystone_id',
+                lambda session: session.query(models.Tenant).filter_by(
+                    keystone_id=sa_sql.bindparam('keystone_id')))
+            entity = query.one(session, keystone_id=keystone_id)
 
         except sa_orm.exc.NoResultFound:
             entity = None
@@ -478,6 +1656,8 @@ class TenantRepo(BaseRepo):
 class SecretRepo(BaseRepo):
     """Repository for the Secret entity."""
 
+    _PAYLOAD_OPTIONS = (sa_orm.undefer('encrypted_data.cypher_text'),)
+
     def _do_entity_name(self):
         """Sub-class hook: return entity name, such as for debugging."""
         return "Secret"
@@ -493,10 +1673,164 @@ class SecretRepo(BaseRepo):
         """Sub-class hook: build a retrieve query."""
         return session.query(models.Secret).filter_by(id=entity_id)
 
+    def _do_build_tombstones_query(self, deleted_before, session):
+        """Sub-class hook: build a query of soft-deleted entity IDs."""
+        return _tombstones_query(models.Secret, deleted_before, session)
+
+    def _do_purge(self, entity_ids, session):
+        """
+        Sub-class hook: hard-delete soft-deleted secrets, along with their
+        encrypted data and tenant associations. Orders keep no reference
+        to their purged secret.
+        """
+        _delete_where_in(models.EncryptedDatum.secret_id, entity_ids, session)
+        _delete_where_in(models.TenantSecret.secret_id, entity_ids, session)
+        session.query(models.Order)\
+            .filter(models.Order.secret_id.in_(entity_ids))\
+            .update({'secret_id': None}, synchronize_session=False)
+        _delete_where_in(models.Secret.id, entity_ids, session)
+
+    def _do_record_deleted(self, entity_ids, session):
+        """Sub-class hook: discount secrets from their tenants' usage."""
+        tenant_id = models.TenantSecret.tenant_id
+        secret_id = models.TenantSecret.secret_id
+        _add_usage_by_tenant(
+            session.query(tenant_id,
+                          sa_sql.func.count(sa_sql.distinct(secret_id)))
+            .filter(secret_id.in_(entity_ids))
+            .group_by(tenant_id), 'secrets', -1, session)
+
+    def _do_build_last_modified_query(self, entity_id, session):
+        """Sub-class hook: build a last-modified timestamps query."""
+        datum_updated_at = sa_sql.select(
+            [sa_sql.func.max(models.EncryptedDatum.updated_at)]).where(
+                models.EncryptedDatum.secret_id == models.Secret.id)
+        return session.query(models.Secret.updated_at,
+                             datum_updated_at.as_scalar())\
+            .filter_by(id=entity_id)
+
     def _do_validate(self, values):
         """Sub-class hook: validate values."""
         pass
 
+    def get_with_payload(self, entity_id, suppress_exception=False,
+                         session=None):
+        """
+        Get a secret along with its encrypted data's payloads, which are
+        otherwise deferred, all in one query, ready for decryption.
+        """
+        return self.get(entity_id, suppress_exception=suppress_exception,
+                        session=session, options=self._PAYLOAD_OPTIONS)
+
+    def delete_expired(self, expired_before, batch_size, session=None):
+        """
+        Soft-delete up to batch_size secrets that expired before
+        expired_before, soonest expired first, in a single transaction.
+        purge_deleted() removes them in turn once their retention is up.
+
+        :returns: the number of secrets deleted, which is less than
+                  batch_size once no more expired secrets remain.
+        """
+        session = self.get_session(session)
+
+        now = timeutils.utcnow()
+        with session.begin(subtransactions=True):
+            entity_ids = [row.id for row in session.query(models.Secret.id)
+                          .filter(models.Secret.deleted == False)
+                          .filter(models.Secret.expiration < expired_before)
+                          .order_by(models.Secret.expiration)
+                          .limit(batch_size)]
+            if entity_ids:
+                session.query(models.Secret)\
+                    .filter(models.Secret.id.in_(entity_ids))\
+                    .filter(models.Secret.deleted == False)\
+                    .update({'deleted': True, 'deleted_at': now,
+                             'updated_at': now}, synchronize_session=False)
+                self._do_record_deleted(entity_ids, session)
+        return len(entity_ids)
+
+    def get_by_create_date(self, keystone_id, limit, after=None, before=None,
+                           session=None):
+        """
+        Returns a page of the tenant's secrets, ordered by creation date.
+
+        Paging is keyset-based: 'after' and 'before' are (created_at,
+        secret_id) markers taken from a previous page, so each page is a
+        single range scan over the tenant_secret index no matter how deep
+        the client has paged.
+
+        :param keystone_id: the Keystone ID of the tenant owning the secrets
+        :param limit: maximum number of secrets to return
+        :param after: return secrets created after this marker
+        :param before: return secrets created before this marker
+        :returns: tuple of (rows, more) where rows is a list of
+                  (secret, marker) tuples in ascending creation order, and
+                  more is True if further secrets exist in the paging
+                  direction.
+        """
+        session = self.get_read_session(session)
+
+        created_at = models.TenantSecret.created_at
+        secret_id = models.TenantSecret.secret_id
+
+        query = session.query(models.Secret, created_at)
+        query = query.join(models.TenantSecret,
+                           models.TenantSecret.secret_id == models.Secret.id)
+        query = query.join(models.Tenant,
+                           models.Tenant.id == models.TenantSecret.tenant_id)
+        query = query.filter(models.Tenant.keystone_id == keystone_id)
+        query = query.filter(models.Secret.deleted == False)
+
+        if before:
+            query = query.filter(sa_sql.or_(
+                created_at < before[0],
+                sa_sql.and_(created_at == before[0], secret_id < before[1])))
+            query = query.order_by(created_at.desc(), secret_id.desc())
+        else:
+            if after:
+                query = query.filter(sa_sql.or_(
+                    created_at > after[0],
+                    sa_sql.and_(created_at == after[0],
+                                secret_id > after[1])))
+            query = query.order_by(created_at, secret_id)
+
+        # Fetch one extra row to learn whether another page follows.
+        results = query.limit(limit + 1).all()
+        more = len(results) > limit
+        results = results[:limit]
+        if before:
+            results.reverse()
+
+        rows = [(secret, (created, secret.id)) for secret, created in results]
+        return rows, more
+
+    def get_by_ids(self, keystone_id, secret_ids, session=None):
+        """
+        Returns the tenant's secrets matching the given IDs, in one query.
+
+        Secrets that do not exist, are deleted, or belong to another tenant
+        are simply absent from the result.
+
+        :param keystone_id: the Keystone ID of the tenant owning the secrets
+        :param secret_ids: list of secret IDs to retrieve
+        :returns: dict of secret ID to secret entity
+        """
+        if not secret_ids:
+            return {}
+
+        session = self.get_read_session(session)
+
+        query = session.query(models.Secret)
+        query = query.join(models.TenantSecret,
+                           models.TenantSecret.secret_id == models.Secret.id)
+        query = query.join(models.Tenant,
+                           models.Tenant.id == models.TenantSecret.tenant_id)
+        query = query.filter(models.Tenant.keystone_id == keystone_id)
+        query = query.filter(models.Secret.id.in_(secret_ids))
+        query = query.filter(models.Secret.deleted == False)
+
+        return dict((secret.id, secret) for secret in query.all())
+
 
 class EncryptedDatumRepo(BaseRepo):
     """
@@ -520,6 +1854,15 @@ class EncryptedDatumRepo(BaseRepo):
         """Sub-class hook: build a retrieve query."""
         return session.query(models.EncryptedDatum).filter_by(id=entity_id)
 
+    def _do_build_tombstones_query(self, deleted_before, session):
+        """Sub-class hook: build a query of soft-deleted entity IDs."""
+        return _tombstones_query(models.EncryptedDatum, deleted_before,
+                                 session)
+
+    def _do_purge(self, entity_ids, session):
+        """Sub-class hook: hard-delete the given soft-deleted entities."""
+        _delete_where_in(models.EncryptedDatum.id, entity_ids, session)
+
     def _do_validate(self, values):
         """Sub-class hook: validate values."""
         pass
@@ -544,6 +1887,21 @@ class TenantSecretRepo(BaseRepo):
         """Sub-class hook: build a retrieve query."""
         return session.query(models.TenantSecret).filter_by(id=entity_id)
 
+    def _do_build_tombstones_query(self, deleted_before, session):
+        """Sub-class hook: build a query of soft-deleted entity IDs."""
+        return _tombstones_query(models.TenantSecret, deleted_before, session)
+
+    def _do_purge(self, entity_ids, session):
+        """Sub-class hook: hard-delete the given soft-deleted entities."""
+        _delete_where_in(models.TenantSecret.id, entity_ids, session)
+
+    def _do_record_created(self, entities, session):
+        """Sub-class hook: count new secrets in their tenants' usage."""
+        _add_usage_by_tenant(
+            collections.Counter(entity.tenant_id
+                                for entity in entities).iteritems(),
+            'secrets', 1, session)
+
     def _do_validate(self, values):
         """Sub-class hook: validate values."""
         pass
@@ -568,6 +1926,265 @@ class OrderRepo(BaseRepo):
         """Sub-class hook: build a retrieve query."""
         return session.query(models.Order).filter_by(id=entity_id)
 
+    def _do_build_last_modified_query(self, entity_id, session):
+        """Sub-class hook: build a last-modified timestamps query."""
+        return session.query(models.Order.updated_at).filter_by(id=entity_id)
+
+    def _do_build_tombstones_query(self, deleted_before, session):
+        """Sub-class hook: build a query of soft-deleted entity IDs."""
+        return _tombstones_query(models.Order, deleted_before, session)
+
+    def _do_purge(self, entity_ids, session):
+        """Sub-class hook: hard-delete the given soft-deleted entities."""
+        _delete_where_in(models.Order.id, entity_ids, session)
+
+    def _do_record_created(self, entities, session):
+        """Sub-class hook: count new orders in their tenants' usage."""
+        _add_usage_by_tenant(
+            collections.Counter(entity.tenant_id
+                                for entity in entities).iteritems(),
+            'orders', 1, session)
+
+    def _do_record_deleted(self, entity_ids, session):
+        """Sub-class hook: discount orders from their tenants' usage."""
+        tenant_id = models.Order.tenant_id
+        _add_usage_by_tenant(
+            session.query(tenant_id, sa_sql.func.count())
+            .filter(models.Order.id.in_(entity_ids))
+            .group_by(tenant_id), 'orders', -1, session)
+
+    def _do_validate(self, values):
+        """Sub-class hook: validate values."""
+        pass
+
+
+class IdempotencyKeyRepo(BaseRepo):
+    """Repository for the IdempotencyKey entity."""
+
+    def _do_entity_name(self):
+        """Sub-class hook: return entity name, such as for debugging."""
+        return "IdempotencyKey"
+
+    def _do_create_instance(self):
+        return models.IdempotencyKey()
+
+    def _do_build_query_by_name(self, name, session):
+        """Sub-class hook: find entity by name."""
+        raise TypeError(_("No support for retrieving by "
+                          "'name' an IdempotencyKey record."))
+
+    def _do_build_get_query(self, entity_id, session):
+        """Sub-class hook: build a retrieve query."""
+        return session.query(models.IdempotencyKey).filter_by(id=entity_id)
+
+    def _do_validate(self, values):
+        """Sub-class hook: validate values."""
+        pass
+
+    def _do_build_tombstones_query(self, deleted_before, session):
+        """Sub-class hook: build a query of the IDs of expired keys."""
+        return session.query(models.IdempotencyKey.id)\
+            .filter(models.IdempotencyKey.expires_at < deleted_before)\
+            .order_by(models.IdempotencyKey.expires_at)
+
+    def _do_purge(self, entity_ids, session):
+        """Sub-class hook: hard-delete the given expired keys."""
+        _delete_where_in(models.IdempotencyKey.id, entity_ids, session)
+
+    def find_by_key(self, keystone_id, resource, key, session=None):
+        """
+        Returns the unexpired idempotency key a tenant supplied when
+        creating the given kind of resource, or None if there is none.
+        The key is PENDING while the request that reserved it is running.
+        """
+        session = self.get_session(session)
+
+        return session.query(models.IdempotencyKey)\
+            .filter_by(keystone_id=keystone_id, resource=resource, key=key,
+                       deleted=False)\
+            .filter(models.IdempotencyKey.expires_at > timeutils.utcnow())\
+            .first()
+
+    def reserve(self, keystone_id, resource, key, expires_at):
+        """
+        Reserves a tenant's idempotency key for a request creating the
+        given kind of resource, until expires_at or until the request
+        completes or releases it. An expired key is replaced.
+
+        The reservation is committed at once, whatever becomes of the
+        current request's transaction, so that concurrent retries of the
+        request see it.
+
+        :returns: True if the key was reserved, or False if another
+                  request holds it
+        """
+        table = models.IdempotencyKey.__table__
+        match = (table.c.keystone_id == keystone_id) & \
+            (table.c.resource == resource) & (table.c.key == key)
+        now = timeutils.utcnow()
+        entry_id = uuidutils.generate_uuid()
+        insert = InsertIgnoringDuplicates(table, values={
+            'id': entry_id,
+            'created_at': now,
+            'updated_at': now,
+            'deleted': False,
+            'status': models.States.PENDING,
+            'keystone_id': keystone_id,
+            'resource': resource,
+            'key': key,
+            'expires_at': expires_at})
+
+        session = _get_independent_session()
+        try:
+            with session.begin():
+                session.execute(table.delete().where(
+                    match & (table.c.expires_at <= now)))
+                session.execute(insert)
+            # The insert may have been skipped rather than failed, so check
+            #   whose reservation was kept.
+            return entry_id == session.execute(
+                sa_sql.select([table.c.id], match)).scalar()
+        except sqlalchemy.exc.IntegrityError:
+            return False
+        finally:
+            session.close()
+
+    def complete(self, keystone_id, resource, key, location, response_body,
+                 expires_at, session=None):
+        """
+        Records the response to the request that reserved a tenant's
+        idempotency key, keeping it until expires_at. This is committed
+        along with the request's other work.
+        """
+        session = self.get_session(session)
+
+        session.query(models.IdempotencyKey)\
+            .filter_by(keystone_id=keystone_id, resource=resource, key=key,
+                       status=models.States.PENDING)\
+            .update({'status': models.States.ACTIVE,
+                     'location': location,
+                     'response_body': response_body,
+                     'expires_at': expires_at,
+                     'updated_at': timeutils.utcnow()},
+                    synchronize_session=False)
+
+    def release(self, keystone_id, resource, key):
+        """
+        Releases a tenant's idempotency key reserved by a request that
+        failed, so that the request may be retried. This is committed at
+        once, as the reservation was.
+        """
+        table = models.IdempotencyKey.__table__
+        session = _get_independent_session()
+        try:
+            session.execute(table.delete().where(
+                (table.c.keystone_id == keystone_id) &
+                (table.c.resource == resource) & (table.c.key == key) &
+                (table.c.status == models.States.PENDING)))
+        finally:
+            session.close()
+
+
+class TenantUsageRepo(BaseRepo):
+    """Repository for the TenantUsage entity."""
+
+    def _do_entity_name(self):
+        """Sub-class hook: return entity name, such as for debugging."""
+        return "TenantUsage"
+
+    def _do_create_instance(self):
+        return models.TenantUsage()
+
+    def _do_build_query_by_name(self, name, session):
+        """Sub-class hook: find entity by name."""
+        raise TypeError(_("No support for retrieving by "
+                          "'name' a TenantUsage record."))
+
+    def _do_build_get_query(self, entity_id, session):
+        """Sub-class hook: build a retrieve query."""
+        return session.query(models.TenantUsage).filter_by(id=entity_id)
+
     def _do_validate(self, values):
         """Sub-class hook: validate values."""
         pass
+
+    def find_by_keystone_id(self, keystone_id, session=None):
+        """
+        Returns the usage of the tenant with keystone_id, or None if the
+        tenant has never had a secret or order.
+        """
+        session = self.get_read_session(session)
+
+        return session.query(models.TenantUsage)\
+            .join(models.Tenant,
+                  models.Tenant.id == models.TenantUsage.tenant_id)\
+            .filter(models.Tenant.keystone_id == keystone_id)\
+            .first()
+
+    def reconcile(self, batch_size, after=None, session=None):
+        """
+        Recounts the live secrets and orders of up to batch_size tenants,
+        in tenant ID order from after, correcting any usage counts that
+        have drifted.
+
+        The tenants' usage rows are locked before the recount, so that a
+        secret or order created or deleted meanwhile is either included in
+        the recount, or applied to the usage only after the correction,
+        but never both. Corrections are applied relative to the stored
+        counts, which the lock keeps current.
+
+        :returns: tuple of (last tenant ID, number of tenants checked,
+                  number of tenants corrected); fewer than batch_size
+                  tenants are checked once no more remain.
+        """
+        session = self.get_session(session)
+
+        with session.begin(subtransactions=True):
+            query = session.query(models.Tenant.id)
+            if after:
+                query = query.filter(models.Tenant.id > after)
+            # A locking read, as a plain one would fix the snapshot that
+            #   databases such as MySQL recount from before the lock below.
+            tenant_ids = [row.id for row in
+                          query.order_by(models.Tenant.id).limit(batch_size)
+                          .with_lockmode('read')]
+            if not tenant_ids:
+                return after, 0, 0
+
+            stored = dict(
+                (row.tenant_id, (row.secrets, row.orders)) for row in
+                session.query(models.TenantUsage)
+                .filter(models.TenantUsage.tenant_id.in_(tenant_ids))
+                .order_by(models.TenantUsage.tenant_id)
+                .with_lockmode('update'))
+            secrets = dict(
+                session.query(models.TenantSecret.tenant_id,
+                              sa_sql.func.count(sa_sql.distinct(
+                                  models.TenantSecret.secret_id)))
+                .join(models.Secret,
+                      models.Secret.id == models.TenantSecret.secret_id)
+                .filter(models.TenantSecret.tenant_id.in_(tenant_ids))
+                .filter(models.Secret.deleted == False)
+                .group_by(models.TenantSecret.tenant_id))
+            orders = dict(
+                session.query(models.Order.tenant_id, sa_sql.func.count())
+                .filter(models.Order.tenant_id.in_(tenant_ids))
+                .filter(models.Order.deleted == False)
+                .group_by(models.Order.tenant_id))
+
+            corrected = 0
+            for tenant_id in tenant_ids:
+                actual = (secrets.get(tenant_id, 0), orders.get(tenant_id, 0))
+                recorded = stored.get(tenant_id, (0, 0))
+                if tenant_id in stored and actual == recorded:
+                    continue
+                if actual != recorded:
+                    LOG.warn(_("Correcting usage of tenant {0} from {1} to "
+                               "{2} (secrets, orders)").format(
+                                   tenant_id, recorded, actual))
+                    corrected += 1
+                _add_usage(tenant_id, session,
+                           secrets=actual[0] - recorded[0],
+                           orders=actual[1] - recorded[1])
+
+        return tenant_ids[-1], len(tenant_ids), corrected
@@ -16,10 +16,13 @@
 """
 Celery Queue Resources related objects and functions.
 """
+import datetime
+
 from celery import Celery
 
 from oslo.config import cfg
-from barbican.tasks.resources import BeginOrder
+from barbican.tasks.resources import (BeginOrder, PurgeDeleted,
+                                      ReconcileUsage, SweepExpired)
 from barbican.common import config, utils
 
 
@@ -47,15 +50,59 @@ celery = Celery(CONF.celery.project,
                 # backend='amqp://',
                 include=[CONF.celery.include])
 
+# Periodic tasks, run by a worker started with celery beat (-B).
+celery.conf.CELERYBEAT_SCHEDULE = {}
+if CONF.purge.interval > 0:
+    celery.conf.CELERYBEAT_SCHEDULE['purge-deleted'] = {
+        'task': 'barbican.queue.celery.resources.purge_deleted_wrapper',
+        'schedule': datetime.timedelta(seconds=CONF.purge.interval),
+    }
+if CONF.sweep.interval > 0:
+    celery.conf.CELERYBEAT_SCHEDULE['sweep-expired'] = {
+        'task': 'barbican.queue.celery.resources.sweep_expired_wrapper',
+        'schedule': datetime.timedelta(seconds=CONF.sweep.interval),
+    }
+if CONF.tenant_usage.interval > 0:
+    celery.conf.CELERYBEAT_SCHEDULE['reconcile-usage'] = {
+        'task': 'barbican.queue.celery.resources.reconcile_usage_wrapper',
+        'schedule': datetime.timedelta(seconds=CONF.tenant_usage.interval),
+    }
+
 
-def process_order(order_id):
+def process_order(order_id, keystone_id=None):
     """Process Order."""
-    return process_order_wrapper.delay(order_id)
+    return process_order_wrapper.delay(order_id, keystone_id)
 
 
 @celery.task
-def process_order_wrapper(order_id):
+def process_order_wrapper(order_id, keystone_id=None):
     """(Celery wrapped task) Process Order."""
     LOG.debug('Order id is {0}'.format(order_id))
     task = BeginOrder()
-    return task.process(order_id)
+    return task.process(order_id, keystone_id)
+
+
+def start_periodic_tasks():
+    """Periodic tasks are scheduled by celery beat instead."""
+    pass
+
+
+@celery.task
+def purge_deleted_wrapper():
+    """(Celery wrapped task) Purge deleted entities."""
+    task = PurgeDeleted()
+    return task.process()
+
+
+@celery.task
+def sweep_expired_wrapper():
+    """(Celery wrapped task) Delete expired secrets."""
+    task = SweepExpired()
+    return task.process()
+
+
+@celery.task
+def reconcile_usage_wrapper():
+    """(Celery wrapped task) Reconcile tenants' usage counts."""
+    task = ReconcileUsage()
+    return task.process()
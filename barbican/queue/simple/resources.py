@@ -14,20 +14,203 @@
 # limitations under the License.
 
 """
-Simple Queue Resources related objects and functions, making direct calls
-to the worker tasks.
+Simple Queue Resources related objects and functions, handing orders to a
+pool of in-process worker threads that make direct calls to the worker
+tasks, and running periodic tasks on in-process timer threads.
 """
+import atexit
+import Queue
+import threading
+
 from oslo.config import cfg
-from barbican.tasks.resources import BeginOrder
+from barbican.tasks.resources import (BeginOrder, PurgeDeleted,
+                                      ReconcileUsage, SweepExpired)
 from barbican.common import utils
+from barbican.openstack.common.gettextutils import _
 
 LOG = utils.getLogger(__name__)
 
+opt_group = cfg.OptGroup(name='simple_queue',
+                         title='Options for the in-process queue interface')
+
+simple_queue_opts = [
+    cfg.IntOpt('worker_threads', default=4,
+               help=_('Number of threads processing orders, or 0 to '
+                      'process orders within the request')),
+    cfg.IntOpt('max_queued_orders', default=100,
+               help=_('Maximum number of orders waiting for a worker '
+                      'thread before further orders are processed within '
+                      'the request')),
+]
+
 CONF = cfg.CONF
+CONF.register_group(opt_group)
+CONF.register_opts(simple_queue_opts, opt_group)
 
+_POOL = None
+_POOL_LOCK = threading.Lock()
+_PURGER = None
+_SWEEPER = None
+_RECONCILER = None
 
-def process_order(order_id):
-    """Process Order."""
+
+def _process_order(order_id, keystone_id=None):
     LOG.debug('Order id is {0}'.format(order_id))
     task = BeginOrder()
-    return task.process(order_id)
+    return task.process(order_id, keystone_id)
+
+
+def _purge_deleted():
+    task = PurgeDeleted()
+    return task.process()
+
+
+def _sweep_expired():
+    task = SweepExpired()
+    return task.process()
+
+
+def _reconcile_usage():
+    task = ReconcileUsage()
+    return task.process()
+
+
+class WorkerPool(object):
+    """
+    Bounded pool of daemon threads that run tasks off a queue.
+
+    Once the queue is full, submit() reports failure so the caller can
+    apply back-pressure rather than queuing without limit.
+    """
+
+    _STOP = object()
+
+    def __init__(self, num_threads, max_queued, target):
+        self.target = target
+        self._queue = Queue.Queue(max_queued)
+        self._threads = []
+        for idx in xrange(num_threads):
+            thread = threading.Thread(target=self._run,
+                                      name='order-worker-{0}'.format(idx))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, *args):
+        """Queue a call to target, returning False if the queue is full."""
+        try:
+            self._queue.put_nowait(args)
+        except Queue.Full:
+            return False
+        return True
+
+    def shutdown(self, timeout=None):
+        """Process any queued calls, then stop the worker threads."""
+        for _ in self._threads:
+            self._queue.put(self._STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while True:
+            args = self._queue.get()
+            if args is self._STOP:
+                return
+            try:
+                self.target(*args)
+            except Exception:
+                LOG.exception(_('Problem processing queued task'))
+
+
+class PeriodicTask(object):
+    """Daemon thread that calls target every interval seconds."""
+
+    def __init__(self, interval, target, name):
+        self.interval = interval
+        self.target = target
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop calling target, waiting for any call in progress."""
+        self._stopped.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.target()
+            except Exception:
+                LOG.exception(_('Problem running periodic task'))
+
+
+def get_worker_pool():
+    """
+    Returns the process-wide order worker pool, starting it on first use,
+    or None if orders are to be processed within the request.
+    """
+    global _POOL
+    if _POOL is None and CONF.simple_queue.worker_threads > 0:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = WorkerPool(CONF.simple_queue.worker_threads,
+                                   CONF.simple_queue.max_queued_orders,
+                                   _process_order)
+                atexit.register(shutdown)
+    return _POOL
+
+
+def shutdown(timeout=None):
+    """Drain queued orders and stop the worker pool, if it was started."""
+    global _POOL
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool:
+        pool.shutdown(timeout)
+
+
+def process_order(order_id, keystone_id=None):
+    """Process Order."""
+    pool = get_worker_pool()
+    if pool and pool.submit(order_id, keystone_id):
+        return None
+
+    if pool:
+        LOG.warn(_('Order queue is full, processing order {0} within the '
+                   'request').format(order_id))
+    return _process_order(order_id, keystone_id)
+
+
+def start_periodic_tasks():
+    """
+    Start purging deleted entities, sweeping expired secrets and
+    reconciling tenant usage periodically, if not already. Run by the
+    barbican-periodic-worker process, of which there should be only one.
+    """
+    global _PURGER, _SWEEPER, _RECONCILER
+    with _POOL_LOCK:
+        if _PURGER is None and CONF.purge.interval > 0:
+            _PURGER = PeriodicTask(CONF.purge.interval, _purge_deleted,
+                                   'purge-deleted')
+            atexit.register(stop_periodic_tasks)
+        if _SWEEPER is None and CONF.sweep.interval > 0:
+            _SWEEPER = PeriodicTask(CONF.sweep.interval, _sweep_expired,
+                                    'sweep-expired')
+            atexit.register(stop_periodic_tasks)
+        if _RECONCILER is None and CONF.tenant_usage.interval > 0:
+            _RECONCILER = PeriodicTask(CONF.tenant_usage.interval,
+                                       _reconcile_usage, 'reconcile-usage')
+            atexit.register(stop_periodic_tasks)
+
+
+def stop_periodic_tasks(timeout=None):
+    """Stop the periodic tasks, if they were started."""
+    global _PURGER, _SWEEPER, _RECONCILER
+    with _POOL_LOCK:
+        tasks = [task for task in (_PURGER, _SWEEPER, _RECONCILER) if task]
+        _PURGER = _SWEEPER = _RECONCILER = None
+    for task in tasks:
+        task.stop(timeout)
@@ -16,16 +16,84 @@
 """
 Task resources for the Barbican API.
 """
+import datetime
 from time import sleep
+
+from oslo.config import cfg
+
 from barbican.crypto.extension_manager import CryptoExtensionManager
+from barbican.model import repositories
 from barbican.model.repositories import (OrderRepo, TenantRepo, SecretRepo,
-                                         TenantSecretRepo, EncryptedDatumRepo)
+                                         TenantSecretRepo, EncryptedDatumRepo,
+                                         IdempotencyKeyRepo, TenantUsageRepo)
 from barbican.model.models import States
-from barbican.common.resources import create_secret, get_or_create_tenant
+from barbican.common.resources import create_secret, get_tenant
 from barbican.common import utils
+from barbican.openstack.common.gettextutils import _
+from barbican.openstack.common import timeutils
 
 LOG = utils.getLogger(__name__)
 
+opt_group = cfg.OptGroup(name='purge',
+                         title='Options for purging deleted entities')
+
+purge_opts = [
+    cfg.IntOpt('interval', default=3600,
+               help=_('Seconds between purges of deleted entities, or 0 '
+                      'to disable periodic purging')),
+    cfg.IntOpt('retention', default=86400,
+               help=_('Seconds a deleted entity is kept before it may be '
+                      'purged')),
+    cfg.IntOpt('batch_size', default=500,
+               help=_('Maximum number of entities purged per transaction')),
+    cfg.FloatOpt('batch_delay', default=1.0,
+                 help=_('Seconds to pause between batches, to limit the '
+                        'load purging puts on the database')),
+    cfg.IntOpt('max_batches', default=100,
+               help=_('Maximum number of batches purged from each table '
+                      'of each shard per run')),
+]
+
+sweep_opt_group = cfg.OptGroup(name='sweep',
+                               title='Options for sweeping expired secrets')
+
+sweep_opts = [
+    cfg.IntOpt('interval', default=600,
+               help=_('Seconds between sweeps for expired secrets, or 0 '
+                      'to disable periodic sweeping')),
+    cfg.IntOpt('batch_size', default=500,
+               help=_('Maximum number of secrets deleted per transaction')),
+    cfg.FloatOpt('max_rate', default=100.0,
+                 help=_('Maximum number of expired secrets deleted per '
+                        'second, or 0 for no limit')),
+    cfg.IntOpt('max_batches', default=100,
+               help=_('Maximum number of batches deleted per shard per '
+                      'sweep')),
+]
+
+usage_opt_group = cfg.OptGroup(name='tenant_usage',
+                               title='Options for reconciling tenant usage')
+
+usage_opts = [
+    cfg.IntOpt('interval', default=86400,
+               help=_('Seconds between recounts of every tenant\'s usage, '
+                      'or 0 to disable periodic reconciliation')),
+    cfg.IntOpt('batch_size', default=100,
+               help=_('Maximum number of tenants recounted per '
+                      'transaction')),
+    cfg.FloatOpt('batch_delay', default=1.0,
+                 help=_('Seconds to pause between batches, to limit the '
+                        'load reconciling puts on the database')),
+]
+
+CONF = cfg.CONF
+CONF.register_group(opt_group)
+CONF.register_opts(purge_opts, opt_group)
+CONF.register_group(sweep_opt_group)
+CONF.register_opts(sweep_opts, sweep_opt_group)
+CONF.register_group(usage_opt_group)
+CONF.register_opts(usage_opts, usage_opt_group)
+
 
 class BeginOrder(object):
     """Handles beginning processing an Order"""
@@ -44,17 +112,22 @@ class BeginOrder(object):
                                # other crypto_mgr instance.
         )
 
-    def process(self, order_id):
-        """Process the beginning of an Order."""
+    def process(self, order_id, keystone_id=None):
+        """
+        Process the beginning of an Order.
+
+        :param keystone_id: the ordering tenant, whose shard the order is in
+        """
         LOG.debug("Processing Order with ID = {0}".format(order_id))
 
-        # Retrieve the order.
-        order = self.order_repo.get(entity_id=order_id)
-        self._handle_order(order)
+        with repositories.tenant_scope(keystone_id):
+            # Retrieve the order.
+            order = self.order_repo.get(entity_id=order_id)
+            self._handle_order(order)
 
-        # Indicate we are done with Order processing
-        order.status = States.ACTIVE
-        self.order_repo.save(order)
+            # Indicate we are done with Order processing
+            order.status = States.ACTIVE
+            self.order_repo.save(order)
 
         return None
 
@@ -71,7 +144,7 @@ class BeginOrder(object):
         secret_info = order_info['secret']
 
         # Create Secret
-        tenant = get_or_create_tenant(order.tenant_id, self.tenant_repo)
+        tenant = get_tenant(order.tenant_id, self.tenant_repo)
         new_secret = create_secret(secret_info, tenant,
                                    self.crypto_manager, self.secret_repo,
                                    self.tenant_secret_repo, self.datum_repo,
@@ -79,3 +152,135 @@ class BeginOrder(object):
         order.secret_id = new_secret.id
 
         LOG.debug("...done creating order's secret.")
+
+
+class PurgeDeleted(object):
+    """
+    Handles purging soft-deleted entities, and expired idempotency keys,
+    in bounded batches with a pause between each, so the database is never
+    asked to remove a large backlog of tombstones in one go.
+    """
+
+    def __init__(self, secret_repo=None, tenant_secret_repo=None,
+                 datum_repo=None, order_repo=None, idempotency_repo=None):
+        LOG.debug('Creating PurgeDeleted task processor')
+        # Secrets are purged ahead of orders, which may reference them.
+        self.repos = [('encrypted_data', datum_repo or EncryptedDatumRepo()),
+                      ('tenant_secret',
+                       tenant_secret_repo or TenantSecretRepo()),
+                      ('secrets', secret_repo or SecretRepo()),
+                      ('orders', order_repo or OrderRepo()),
+                      ('idempotency_keys',
+                       idempotency_repo or IdempotencyKeyRepo())]
+
+    def process(self):
+        """
+        Purge entities deleted more than the retention period ago, from
+        each database shard in turn.
+
+        :returns: dict of the number of entities purged per table
+        """
+        deleted_before = timeutils.utcnow() - datetime.timedelta(
+            seconds=CONF.purge.retention)
+
+        counts = dict((name, 0) for name, repo in self.repos)
+        for shard in repositories.get_shard_map().shards:
+            with repositories.shard_scope(shard):
+                self._purge_shard(deleted_before, counts)
+
+        LOG.info(_('Purged deleted entities: {0}').format(counts))
+        return counts
+
+    def _purge_shard(self, deleted_before, counts):
+        batch_size = CONF.purge.batch_size
+        batches = 0
+        # Each table has its own budget of batches, so that a backlog in
+        #   one table cannot keep the tables after it from being purged.
+        for name, repo in self.repos:
+            for idx in xrange(CONF.purge.max_batches):
+                if batches:
+                    sleep(CONF.purge.batch_delay)
+                batches += 1
+
+                purged = repo.purge_deleted(deleted_before, batch_size)
+                counts[name] += purged
+                if purged < batch_size:
+                    break
+
+
+class SweepExpired(object):
+    """
+    Handles deleting secrets once they expire, in bounded batches at a
+    limited rate. Expired secrets are soft-deleted, so that PurgeDeleted
+    then removes them from the tables.
+    """
+
+    def __init__(self, secret_repo=None):
+        LOG.debug('Creating SweepExpired task processor')
+        self.secret_repo = secret_repo or SecretRepo()
+
+    def process(self):
+        """
+        Delete secrets that have expired, from each database shard in turn.
+
+        :returns: dict of the numbers of secrets deleted and of batches
+        """
+        expired_before = timeutils.utcnow()
+
+        counts = {'secrets': 0, 'batches': 0}
+        for shard in repositories.get_shard_map().shards:
+            with repositories.shard_scope(shard):
+                self._sweep_shard(expired_before, counts)
+
+        LOG.info(_('Deleted expired secrets: {0}').format(counts))
+        return counts
+
+    def _sweep_shard(self, expired_before, counts):
+        batch_size = CONF.sweep.batch_size
+        for idx in xrange(CONF.sweep.max_batches):
+            deleted = self.secret_repo.delete_expired(expired_before,
+                                                      batch_size)
+            counts['secrets'] += deleted
+            counts['batches'] += 1
+            if deleted < batch_size:
+                break
+            if CONF.sweep.max_rate > 0:
+                sleep(deleted / CONF.sweep.max_rate)
+
+
+class ReconcileUsage(object):
+    """
+    Handles recounting every tenant's live secrets and orders, in bounded
+    batches with a pause between each, to correct any drift in the usage
+    counts kept by the create and delete paths.
+    """
+
+    def __init__(self, usage_repo=None):
+        LOG.debug('Creating ReconcileUsage task processor')
+        self.usage_repo = usage_repo or TenantUsageRepo()
+
+    def process(self):
+        """
+        Reconcile the usage of every tenant, on each database shard in turn.
+
+        :returns: dict of the numbers of tenants checked and corrected
+        """
+        counts = {'tenants': 0, 'corrected': 0}
+        for shard in repositories.get_shard_map().shards:
+            with repositories.shard_scope(shard):
+                self._reconcile_shard(counts)
+
+        LOG.info(_('Reconciled tenant usage: {0}').format(counts))
+        return counts
+
+    def _reconcile_shard(self, counts):
+        batch_size = CONF.tenant_usage.batch_size
+        last_id = None
+        while True:
+            last_id, checked, corrected = self.usage_repo.reconcile(
+                batch_size, after=last_id)
+            counts['tenants'] += checked
+            counts['corrected'] += corrected
+            if checked < batch_size:
+                break
+            sleep(CONF.tenant_usage.batch_delay)
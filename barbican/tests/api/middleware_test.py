@@ -14,14 +14,19 @@
 # limitations under the License.
 
 import unittest
-from mock import MagicMock
+from mock import MagicMock, patch
+import webob
+
+from barbican.api.middleware.session import RequestSessionFilter
 from barbican.api.middleware.simple import SimpleFilter
+from barbican.common import exception
 
 
 def suite():
     suite = unittest.TestSuite()
 
     suite.addTest(WhenTestingSimpleMiddleware())
+    suite.addTest(WhenTestingRequestSessionMiddleware())
 
     return suite
 
@@ -37,5 +42,65 @@ class WhenTestingSimpleMiddleware(unittest.TestCase):
         self.middle.process_request(self.req)
 
 
+@patch('barbican.api.middleware.session.repositories')
+class WhenTestingRequestSessionMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        self.status = '202 Accepted'
+        self.middle = RequestSessionFilter(self._app)
+        self.req = webob.Request.blank('/v1/tenant1234/secrets')
+
+    def _app(self, environ, start_response):
+        start_response(self.status, [])
+        return ['']
+
+    def test_should_commit_session_after_request(self, mock_repos):
+        response = self.req.get_response(self.middle)
+
+        self.assertEqual(202, response.status_int)
+        mock_repos.begin_request_session.assert_called_once_with(
+            client_id='tenant1234')
+        mock_repos.end_request_session.assert_called_once_with(
+            mock_repos.begin_request_session.return_value, commit=True)
+
+    def test_should_route_admin_requests_by_tenant_in_path(self, mock_repos):
+        for path, client_id in (('/v1/admin/usage/tenant1234', 'tenant1234'),
+                                ('/v1/admin/db-pool', None)):
+            mock_repos.reset_mock()
+
+            webob.Request.blank(path).get_response(self.middle)
+
+            mock_repos.begin_request_session.assert_called_once_with(
+                client_id=client_id)
+
+    def test_should_roll_back_session_after_server_error(self, mock_repos):
+        self.status = '500 Internal Server Error'
+
+        self.req.get_response(self.middle)
+
+        mock_repos.end_request_session.assert_called_once_with(
+            mock_repos.begin_request_session.return_value, commit=False)
+
+    def test_should_roll_back_session_when_app_raises(self, mock_repos):
+        self.middle = RequestSessionFilter(MagicMock(side_effect=ValueError))
+
+        with self.assertRaises(ValueError):
+            self.req.get_response(self.middle)
+
+        mock_repos.end_request_session.assert_called_once_with(
+            mock_repos.begin_request_session.return_value, commit=False)
+
+    def test_should_fail_fast_when_database_unavailable(self, mock_repos):
+        self.middle = RequestSessionFilter(MagicMock(
+            side_effect=exception.ServiceUnavailable(retry=10)))
+
+        response = self.req.get_response(self.middle)
+
+        self.assertEqual(503, response.status_int)
+        self.assertEqual('10', response.headers['Retry-After'])
+        mock_repos.end_request_session.assert_called_once_with(
+            mock_repos.begin_request_session.return_value, commit=False)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -13,20 +13,38 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from mock import MagicMock
+from mock import MagicMock, patch
 import falcon
 import json
+import os
+import tempfile
+import threading
 import unittest
 
-from datetime import datetime
-from barbican.api.resources import (VersionResource,
-                                    SecretsResource, SecretResource,
-                                    OrdersResource, OrderResource)
-from barbican.crypto.extension_manager import CryptoExtensionManager
+from datetime import datetime, timedelta
+from barbican.api import policy
+from barbican.api.resources import (VersionResource, DatabasePoolResource,
+                                    TenantUsageResource,
+                                    SecretsResource, SecretsBatchResource,
+                                    SecretResource,
+                                    OrdersResource, OrderResource,
+                                    entity_etag,
+                                    encode_paging_cursor,
+                                    decode_paging_cursor)
+from barbican.crypto.extension_manager import (
+    CryptoExtensionManager,
+    CryptoMimeTypeNotSupportedException
+)
 from barbican.model.models import (Secret, Tenant, TenantSecret,
-                                   Order, EncryptedDatum)
+                                   TenantUsage, Order, EncryptedDatum,
+                                   States)
 from barbican.common import config
 from barbican.common import exception
+from barbican.common import resources as common_resources
+from barbican.common.resources import (get_idempotency_cache,
+                                       get_tenant_cache)
+from barbican.model import repositories
+from barbican.tests.model.test_repositories import teardown_in_memory_db
 from barbican.openstack.common import jsonutils
 
 
@@ -34,7 +52,12 @@ def suite():
     suite = unittest.TestSuite()
 
     suite.addTest(WhenTestingVersionResource())
+    suite.addTest(WhenGettingDatabasePoolStatsUsingDatabasePoolResource())
+    suite.addTest(WhenGettingTenantUsageUsingTenantUsageResource())
     suite.addTest(WhenCreatingSecretsUsingSecretsResource())
+    suite.addTest(WhenGettingSecretsListUsingSecretsResource())
+    suite.addTest(WhenCreatingSecretsUsingSecretsBatchResource())
+    suite.addTest(WhenGettingSecretsUsingSecretsBatchResource())
     suite.addTest(WhenGettingOrDeletingSecretUsingSecretResource())
     suite.addTest(WhenCreatingOrdersUsingOrdersResource())
     suite.addTest(WhenGettingOrDeletingOrderUsingOrderResource())
@@ -63,9 +86,93 @@ class WhenTestingVersionResource(unittest.TestCase):
         self.assertEqual('current', parsed_body['v1'])
 
 
+POLICY_FILE = os.path.join(os.path.dirname(__file__), '..', '..', '..',
+                           'etc', 'barbican', 'policy.json')
+
+
+class WhenGettingDatabasePoolStatsUsingDatabasePoolResource(
+        unittest.TestCase):
+
+    def setUp(self):
+        self.headers = {'X-Roles': 'admin,member'}
+        self.req = MagicMock()
+        self.req.get_header.side_effect = self.headers.get
+        self.resp = MagicMock()
+
+    def _get(self, policy_file):
+        with patch.object(policy.Enforcer, '_find_policy_file',
+                          return_value=policy_file):
+            resource = DatabasePoolResource(policy.Enforcer())
+        resource.on_get(self.req, self.resp)
+
+    def test_should_return_pool_stats_to_admin(self):
+        for policy_file in (POLICY_FILE, None):
+            self._get(policy_file)
+
+            self.assertEqual(falcon.HTTP_200, self.resp.status)
+            self.assertIn('db_pool', json.loads(self.resp.body))
+
+    def test_should_reject_non_admin(self):
+        for roles in ('member', None):
+            self.headers['X-Roles'] = roles
+            for policy_file in (POLICY_FILE, None):
+                with self.assertRaises(falcon.HTTPError) as cm:
+                    self._get(policy_file)
+
+                self.assertEqual(falcon.HTTP_403, cm.exception.status)
+
+
+class WhenGettingTenantUsageUsingTenantUsageResource(unittest.TestCase):
+
+    def setUp(self):
+        self.req = MagicMock()
+        self.resp = MagicMock()
+        self.usage_repo = MagicMock()
+        self.resource = TenantUsageResource(self.usage_repo, MagicMock())
+
+    def test_should_return_usage_counts(self):
+        usage = TenantUsage()
+        usage.secrets = 3
+        usage.orders = 1
+        self.usage_repo.find_by_keystone_id.return_value = usage
+
+        self.resource.on_get(self.req, self.resp, 'keystone1234')
+
+        self.assertEqual(falcon.HTTP_200, self.resp.status)
+        self.assertEqual({'tenant_id': 'keystone1234', 'secrets': 3,
+                          'orders': 1}, json.loads(self.resp.body))
+        self.usage_repo.find_by_keystone_id.assert_called_once_with(
+            'keystone1234')
+
+    def test_should_return_zeros_for_tenant_without_usage(self):
+        self.usage_repo.find_by_keystone_id.return_value = None
+
+        self.resource.on_get(self.req, self.resp, 'keystone1234')
+
+        self.assertEqual({'tenant_id': 'keystone1234', 'secrets': 0,
+                          'orders': 0}, json.loads(self.resp.body))
+
+    def test_should_reject_non_admin(self):
+        self.req.get_header.side_effect = {'X-Roles': 'member'}.get
+        for policy_file in (POLICY_FILE, None):
+            with patch.object(policy.Enforcer, '_find_policy_file',
+                              return_value=policy_file):
+                resource = TenantUsageResource(self.usage_repo,
+                                               policy.Enforcer())
+
+            with self.assertRaises(falcon.HTTPError) as cm:
+                resource.on_get(self.req, self.resp, 'keystone1234')
+
+            self.assertEqual(falcon.HTTP_403, cm.exception.status)
+        self.assertFalse(self.usage_repo.find_by_keystone_id.called)
+
+
 class WhenCreatingSecretsUsingSecretsResource(unittest.TestCase):
 
     def setUp(self):
+        get_tenant_cache().clear()
+        get_idempotency_cache().clear()
+
         self.name = 'name'
         self.plain_text = 'not-encrypted'
         self.mime_type = 'text/plain'
@@ -87,7 +194,7 @@ class WhenCreatingSecretsUsingSecretsResource(unittest.TestCase):
         self.tenant.id = self.tenant_id
         self.tenant.keystone_id = self.keystone_id
         self.tenant_repo = MagicMock()
-        self.tenant_repo.get.return_value = self.tenant
+        self.tenant_repo.find_by_keystone_id.return_value = self.tenant
 
         self.secret_repo = MagicMock()
         self.secret_repo.create_from.return_value = None
@@ -99,11 +206,16 @@ class WhenCreatingSecretsUsingSecretsResource(unittest.TestCase):
         self.datum_repo = MagicMock()
         self.datum_repo.create_from.return_value = None
 
+        self.idempotency_repo = MagicMock()
+        self.idempotency_repo.find_by_key.return_value = None
+
         self.stream = MagicMock()
         self.stream.read.return_value = self.json
 
+        self.headers = {}
         self.req = MagicMock()
         self.req.stream = self.stream
+        self.req.get_header.side_effect = self.headers.get
 
         self.resp = MagicMock()
         self.crypto_mgr = CryptoExtensionManager(
@@ -117,7 +229,8 @@ class WhenCreatingSecretsUsingSecretsResource(unittest.TestCase):
                                         self.tenant_repo,
                                         self.secret_repo,
                                         self.tenant_secret_repo,
-                                        self.datum_repo)
+                                        self.datum_repo,
+                                        self.idempotency_repo)
 
     def test_should_add_new_secret(self):
         self.resource.on_post(self.req, self.resp, self.tenant_id)
@@ -145,10 +258,15 @@ class WhenCreatingSecretsUsingSecretsResource(unittest.TestCase):
         self.assertIsNotNone(datum.kek_metadata)
 
     def test_should_add_new_secret_tenant_not_exist(self):
-        self.tenant_repo.get.return_value = None
+        self.tenant_repo.find_by_keystone_id.return_value = None
+        new_tenant = Tenant()
+        new_tenant.keystone_id = self.tenant_id
+        self.tenant_repo.create_or_get.return_value = new_tenant
 
         self.resource.on_post(self.req, self.resp, self.tenant_id)
 
+        self.tenant_repo.create_or_get.assert_called_once_with(self.tenant_id)
+
         args, kwargs = self.secret_repo.create_from.call_args
         secret = args[0]
         assert isinstance(secret, Secret)
@@ -187,10 +305,418 @@ class WhenCreatingSecretsUsingSecretsResource(unittest.TestCase):
 
         assert not self.datum_repo.create_from.called
 
+    def test_should_record_response_for_idempotency_key(self):
+        self.headers['Idempotency-Key'] = 'key1234'
+
+        self.resource.on_post(self.req, self.resp, self.tenant_id)
+
+        self.idempotency_repo.find_by_key.assert_called_once_with(
+            self.tenant_id, 'secrets', 'key1234')
+        args, kwargs = self.idempotency_repo.reserve.call_args
+        self.assertEqual((self.tenant_id, 'secrets', 'key1234'), args[:3])
+        args, kwargs = self.idempotency_repo.complete.call_args
+        self.assertEqual((self.tenant_id, 'secrets', 'key1234'), args[:3])
+        self.assertEqual(self.resp.body, args[4])
+        self.assertFalse(self.idempotency_repo.release.called)
+
+    def test_should_replay_response_for_repeated_idempotency_key(self):
+        self.headers['Idempotency-Key'] = 'key1234'
+        entry = MagicMock()
+        entry.location = '/tenant/secrets/idsecret1'
+        entry.response_body = '{"secret_ref": "original"}'
+        entry.expires_at = datetime.utcnow() + timedelta(hours=1)
+        entry.status = States.ACTIVE
+        self.idempotency_repo.find_by_key.return_value = entry
+
+        self.resource.on_post(self.req, self.resp, self.tenant_id)
+
+        self.assertEqual(falcon.HTTP_202, self.resp.status)
+        self.assertEqual(entry.response_body, self.resp.body)
+        self.resp.set_header.assert_called_once_with('Location',
+                                                     entry.location)
+        self.assertFalse(self.idempotency_repo.reserve.called)
+        self.assertFalse(self.secret_repo.create_from.called)
+        self.assertFalse(self.datum_repo.create_from.called)
+        self.assertFalse(self.stream.read.called)
+
+    def test_should_reject_retry_while_original_in_progress(self):
+        self.headers['Idempotency-Key'] = 'key1234'
+        entry = MagicMock()
+        entry.status = States.PENDING
+        self.idempotency_repo.find_by_key.return_value = entry
+        self.idempotency_repo.reserve.return_value = False
+
+        with self.assertRaises(falcon.HTTPError) as cm:
+            self.resource.on_post(self.req, self.resp, self.tenant_id)
+
+        self.assertEqual(falcon.HTTP_409, cm.exception.status)
+        self.assertFalse(self.secret_repo.create_from.called)
+        self.assertFalse(self.idempotency_repo.release.called)
+
+    def test_should_release_idempotency_key_when_create_fails(self):
+        self.headers['Idempotency-Key'] = 'key1234'
+        self.secret_repo.create_from.side_effect = ValueError()
+
+        with self.assertRaises(ValueError):
+            self.resource.on_post(self.req, self.resp, self.tenant_id)
+
+        self.idempotency_repo.release.assert_called_once_with(
+            self.tenant_id, 'secrets', 'key1234')
+        self.assertFalse(self.idempotency_repo.complete.called)
+
+
+class WhenRetryingSecretCreationMidRequest(unittest.TestCase):
+    """
+    Retries a create request while the original is still running, against
+    a database file, so that the requests' sessions have connections of
+    their own as they would in production.
+    """
+
+    def setUp(self):
+        get_tenant_cache().clear()
+        get_idempotency_cache().clear()
+        fd, self.db_path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        repositories.CONF.set_override('sql_connection',
+                                       'sqlite:///' + self.db_path)
+        repositories._ENGINE = None
+        repositories._MAKER = None
+        repositories.configure_db()
+        repositories.TenantRepo().create_or_get('keystone1234')
+
+        self.crypto_mgr = CryptoExtensionManager(
+            'barbican.test.crypto.extension', ['test_crypto'])
+        self.resource = SecretsResource(self.crypto_mgr, MagicMock())
+        self.responses = []
+
+    def tearDown(self):
+        teardown_in_memory_db()
+        os.remove(self.db_path)
+
+    def _post(self):
+        req = MagicMock()
+        req.stream.read.return_value = json.dumps(
+            {'name': 'name1234', 'mime_type': 'text/plain',
+             'plain_text': 'not-encrypted'})
+        req.get_header.side_effect = {'Idempotency-Key': 'key1234'}.get
+        resp = MagicMock()
+        session = repositories.begin_request_session('keystone1234')
+        try:
+            self.resource.on_post(req, resp, 'keystone1234')
+        except falcon.HTTPError as e:
+            repositories.end_request_session(session, commit=False)
+            self.responses.append((e.status, None))
+        else:
+            repositories.end_request_session(session)
+            self.responses.append((resp.status, resp.body))
+
+    def _create_secret_after_retry(self, *args, **kwargs):
+        retry = threading.Thread(target=self._post)
+        retry.start()
+        retry.join()
+        return common_resources.create_secret(*args, **kwargs)
+
+    def test_should_reject_retry_made_while_original_running(self):
+        with patch('barbican.api.resources.create_secret',
+                   side_effect=self._create_secret_after_retry):
+            self._post()
+        self._post()
+
+        retried, original, replayed = self.responses
+        self.assertEqual((falcon.HTTP_409, None), retried)
+        self.assertEqual(falcon.HTTP_202, original[0])
+        self.assertEqual(original, replayed)
+        self.assertEqual(1, repositories.get_engine().execute(
+            'SELECT COUNT(*) FROM secrets').scalar())
+
+
+class WhenGettingSecretsListUsingSecretsResource(unittest.TestCase):
+
+    def setUp(self):
+        self.tenant_id = 'keystone1234'
+        self.name = 'name1234'
+        self.mime_type = 'text/plain'
+        self.created = datetime(2013, 6, 1, 12, 30, 15, 123456)
+
+        self.num_secrets = 3
+        self.rows = []
+        for idx in xrange(self.num_secrets):
+            secret = Secret({'name': self.name,
+                             'mime_type': self.mime_type})
+            secret.id = 'idsecret{0}'.format(idx)
+            secret.encrypted_data = []
+            self.rows.append((secret, (self.created, secret.id)))
+
+        self.secret_repo = MagicMock()
+        self.secret_repo.get_by_create_date.return_value = (self.rows, True)
+
+        self.params = {}
+        self.req = MagicMock()
+        self.req.get_param.side_effect = self.params.get
+        self.resp = MagicMock()
+        self.policy = MagicMock()
+
+        self.resource = SecretsResource(MagicMock(),
+                                        self.policy,
+                                        MagicMock(),
+                                        self.secret_repo,
+                                        MagicMock(),
+                                        MagicMock(),
+                                        MagicMock())
+
+    def test_should_get_first_page(self):
+        self.params['limit'] = '3'
+
+        self.resource.on_get(self.req, self.resp, self.tenant_id)
+
+        self.secret_repo.get_by_create_date.assert_called_once_with(
+            self.tenant_id, 3, after=None, before=None)
+        self.assertEqual(falcon.HTTP_200, self.resp.status)
+
+        resp_body = jsonutils.loads(self.resp.body)
+        self.assertEqual(self.num_secrets, len(resp_body['secrets']))
+        self.assertTrue(resp_body['secrets'][0]['secret_ref'].endswith(
+            'secrets/idsecret0'))
+        self.assertTrue('next' in resp_body)
+        self.assertFalse('previous' in resp_body)
+
+    def test_should_page_forward_from_next_cursor(self):
+        cursor = encode_paging_cursor((self.created, 'idsecret9'))
+        self.params['next'] = cursor
+        self.secret_repo.get_by_create_date.return_value = (self.rows, False)
+
+        self.resource.on_get(self.req, self.resp, self.tenant_id)
+
+        self.secret_repo.get_by_create_date.assert_called_once_with(
+            self.tenant_id, 10, after=(self.created, 'idsecret9'),
+            before=None)
+
+        resp_body = jsonutils.loads(self.resp.body)
+        self.assertFalse('next' in resp_body)
+        self.assertTrue('previous' in resp_body)
+
+    def test_should_page_backward_from_previous_cursor(self):
+        cursor = encode_paging_cursor((self.created, 'idsecret9'))
+        self.params['previous'] = cursor
+        self.secret_repo.get_by_create_date.return_value = (self.rows, False)
+
+        self.resource.on_get(self.req, self.resp, self.tenant_id)
+
+        self.secret_repo.get_by_create_date.assert_called_once_with(
+            self.tenant_id, 10, after=None,
+            before=(self.created, 'idsecret9'))
+
+        resp_body = jsonutils.loads(self.resp.body)
+        self.assertTrue('next' in resp_body)
+        self.assertFalse('previous' in resp_body)
+
+    def test_should_clamp_limit_to_maximum(self):
+        self.params['limit'] = '100000'
+
+        self.resource.on_get(self.req, self.resp, self.tenant_id)
+
+        args, kwargs = self.secret_repo.get_by_create_date.call_args
+        self.assertEqual(100, args[1])
+
+    def test_should_fail_for_bad_limit(self):
+        self.params['limit'] = 'abc'
+
+        with self.assertRaises(falcon.HTTPError) as cm:
+            self.resource.on_get(self.req, self.resp, self.tenant_id)
+
+        self.assertEqual(falcon.HTTP_400, cm.exception.status)
+
+    def test_should_fail_for_bad_cursor(self):
+        self.params['next'] = 'not-a-cursor'
+
+        with self.assertRaises(falcon.HTTPError) as cm:
+            self.resource.on_get(self.req, self.resp, self.tenant_id)
+
+        self.assertEqual(falcon.HTTP_400, cm.exception.status)
+
+    def test_should_round_trip_paging_cursor(self):
+        marker = (self.created, 'idsecret0')
+        self.assertEqual(marker,
+                         decode_paging_cursor(encode_paging_cursor(marker)))
+
+
+class WhenCreatingSecretsUsingSecretsBatchResource(unittest.TestCase):
+
+    def setUp(self):
+        get_tenant_cache().clear()
+
+        self.mime_type = 'text/plain'
+        self.num_secrets = 3
+        self.secret_reqs = [{'name': 'name{0}'.format(idx),
+                             'mime_type': self.mime_type,
+                             'plain_text': 'not-encrypted'}
+                            for idx in xrange(self.num_secrets)]
+        self.json = json.dumps({'secrets': self.secret_reqs})
+
+        self.tenant_id = 'tenantid1234'
+        self.tenant = Tenant()
+        self.tenant.id = self.tenant_id
+        self.tenant_repo = MagicMock()
+        self.tenant_repo.find_by_keystone_id.return_value = self.tenant
+
+        self.session = MagicMock()
+        self.secret_repo = MagicMock()
+        self.secret_repo.get_session.return_value = self.session
+        self.secret_repo.create_batch.side_effect = self._assign_ids
+
+        self.tenant_secret_repo = MagicMock()
+        self.datum_repo = MagicMock()
+
+        self.stream = MagicMock()
+        self.stream.read.return_value = self.json
+
+        self.req = MagicMock()
+        self.req.stream = self.stream
+
+        self.resp = MagicMock()
+        self.crypto_mgr = CryptoExtensionManager(
+            'barbican.test.crypto.extension',
+            ['test_crypto']
+        )
+        self.policy = MagicMock()
+
+        self.resource = SecretsBatchResource(self.crypto_mgr,
+                                             self.policy,
+                                             self.tenant_repo,
+                                             self.secret_repo,
+                                             self.tenant_secret_repo,
+                                             self.datum_repo)
+
+    def test_should_add_new_secrets_in_one_transaction(self):
+        self.resource.on_post(self.req, self.resp, self.tenant_id)
+
+        self.assertEqual(falcon.HTTP_202, self.resp.status)
+        self.session.begin.assert_called_once_with(subtransactions=True)
+
+        args, kwargs = self.secret_repo.create_batch.call_args
+        secrets = args[0]
+        self.assertEqual(self.num_secrets, len(secrets))
+        self.assertEqual(['name0', 'name1', 'name2'],
+                         [secret.name for secret in secrets])
+        self.assertEqual(self.session, kwargs['session'])
+
+        args, kwargs = self.tenant_secret_repo.create_batch.call_args
+        self.assertEqual([secret.id for secret in secrets],
+                         [assoc.secret_id for assoc in args[0]])
+        self.assertEqual(self.session, kwargs['session'])
+
+        args, kwargs = self.datum_repo.create_batch.call_args
+        self.assertEqual([secret.id for secret in secrets],
+                         [datum.secret_id for datum in args[0]])
+        self.assertEqual(self.session, kwargs['session'])
+
+        resp_body = jsonutils.loads(self.resp.body)
+        self.assertEqual(self.num_secrets, len(resp_body['secret_refs']))
+        self.assertTrue(resp_body['secret_refs'][0].endswith(
+            'secrets/{0}'.format(secrets[0].id)))
+
+    def test_should_fail_for_empty_batch(self):
+        self.stream.read.return_value = json.dumps({'secrets': []})
+
+        with self.assertRaises(falcon.HTTPError) as cm:
+            self.resource.on_post(self.req, self.resp, self.tenant_id)
+
+        self.assertEqual(falcon.HTTP_400, cm.exception.status)
+        self.assertFalse(self.secret_repo.create_batch.called)
+
+    def test_should_fail_for_secret_missing_mime_type(self):
+        del self.secret_reqs[1]['mime_type']
+        self.stream.read.return_value = json.dumps(
+            {'secrets': self.secret_reqs})
+
+        with self.assertRaises(falcon.HTTPError) as cm:
+            self.resource.on_post(self.req, self.resp, self.tenant_id)
+
+        self.assertEqual(falcon.HTTP_400, cm.exception.status)
+        self.assertFalse(self.secret_repo.create_batch.called)
+
+    def test_should_fail_for_secret_that_cannot_be_encrypted(self):
+        encrypt = self.crypto_mgr.encrypt
+
+        def _encrypt(plain_text, secret, tenant):
+            if secret.name == 'name1':
+                raise CryptoMimeTypeNotSupportedException(secret.mime_type)
+            return encrypt(plain_text, secret, tenant)
+
+        with patch.object(self.crypto_mgr, 'encrypt', side_effect=_encrypt):
+            with self.assertRaises(falcon.HTTPError) as cm:
+                self.resource.on_post(self.req, self.resp, self.tenant_id)
+
+        self.assertEqual(falcon.HTTP_400, cm.exception.status)
+        self.assertIn('Secret 1 of the batch', cm.exception.title)
+        self.assertFalse(self.secret_repo.create_batch.called)
+        self.assertFalse(self.tenant_secret_repo.create_batch.called)
+        self.assertFalse(self.datum_repo.create_batch.called)
+
+    def _assign_ids(self, entities, session=None):
+        for idx, entity in enumerate(entities):
+            entity.id = 'idsecret{0}'.format(idx)
+        return entities
+
+
+class WhenGettingSecretsUsingSecretsBatchResource(unittest.TestCase):
+
+    def setUp(self):
+        self.tenant_id = 'keystone1234'
+        self.mime_type = 'text/plain'
+
+        self.secret = Secret({'name': 'name1234',
+                              'mime_type': self.mime_type})
+        self.secret.id = 'idsecret1'
+        self.secret.encrypted_data = []
+
+        self.secret_repo = MagicMock()
+        self.secret_repo.get_by_ids.return_value = {self.secret.id:
+                                                    self.secret}
+
+        self.params = {'ids': 'idsecret1,idmissing,idsecret1'}
+        self.req = MagicMock()
+        self.req.get_param.side_effect = self.params.get
+        self.resp = MagicMock()
+        self.policy = MagicMock()
+
+        self.resource = SecretsBatchResource(MagicMock(),
+                                             self.policy,
+                                             MagicMock(),
+                                             self.secret_repo,
+                                             MagicMock(),
+                                             MagicMock())
+
+    def test_should_get_secrets_with_one_lookup(self):
+        self.resource.on_get(self.req, self.resp, self.tenant_id)
+
+        self.secret_repo.get_by_ids.assert_called_once_with(
+            self.tenant_id, ['idsecret1', 'idmissing'])
+        self.assertEqual(falcon.HTTP_200, self.resp.status)
+
+        resp_body = jsonutils.loads(self.resp.body)
+        found, missing = resp_body['secrets']
+        self.assertEqual('name1234', found['name'])
+        self.assertTrue(found['secret_ref'].endswith('secrets/idsecret1'))
+        self.assertFalse('not_found' in found)
+        self.assertTrue(missing['not_found'])
+        self.assertTrue(missing['secret_ref'].endswith('secrets/idmissing'))
+
+    def test_should_fail_for_no_ids(self):
+        self.params['ids'] = ' , '
+
+        with self.assertRaises(falcon.HTTPError) as cm:
+            self.resource.on_get(self.req, self.resp, self.tenant_id)
+
+        self.assertEqual(falcon.HTTP_400, cm.exception.status)
+        self.assertFalse(self.secret_repo.get_by_ids.called)
+
 
 class WhenGettingPuttingOrDeletingSecretUsingSecretResource(unittest.TestCase):
 
     def setUp(self):
+        get_tenant_cache().clear()
+
         self.tenant_id = 'tenant1234'
         self.name = 'name1234'
         self.mime_type = 'text/plain'
@@ -220,20 +746,20 @@ class WhenGettingPuttingOrDeletingSecretUsingSecretResource(unittest.TestCase):
         self.tenant = Tenant()
         self.tenant.id = self.tenant_id
         self.tenant_repo = MagicMock()
-        self.tenant_repo.get.return_value = self.tenant
+        self.tenant_repo.find_by_keystone_id.return_value = self.tenant
 
         self.secret_repo = MagicMock()
         self.secret_repo.get.return_value = self.secret
-        self.secret_repo.delete_entity.return_value = None
-
-        self.tenant_secret_repo = MagicMock()
-        self.tenant_secret_repo.create_from.return_value = None
+        self.secret_repo.get_with_payload.return_value = self.secret
+        self.secret_repo.delete_entity_by_id.return_value = None
 
         self.datum_repo = MagicMock()
         self.datum_repo.create_from.return_value = None
 
         self.req = MagicMock()
         self.req.accept = 'application/json'
+        self.req.if_none_match = None
+        self.req.if_modified_since = None
         self.resp = MagicMock()
         self.crypto_mgr = CryptoExtensionManager(
             'barbican.test.crypto.extension',
@@ -244,7 +770,6 @@ class WhenGettingPuttingOrDeletingSecretUsingSecretResource(unittest.TestCase):
                                        self.policy,
                                        self.tenant_repo,
                                        self.secret_repo,
-                                       self.tenant_secret_repo,
                                        self.datum_repo)
 
     def test_should_get_secret_as_json(self):
@@ -261,20 +786,91 @@ class WhenGettingPuttingOrDeletingSecretUsingSecretResource(unittest.TestCase):
         self.assertTrue(self.datum.mime_type in
                         resp_body['content_types'].itervalues())
 
-    def test_should_get_secret_as_plain(self):
-        self.req.accept = 'text/plain'
+    def test_should_get_secret_as_json_with_validators(self):
+        self.secret.updated_at = datetime(2013, 6, 1, 12, 30, 15, 123456)
 
         self.resource.on_get(self.req, self.resp, self.tenant_id,
                              self.secret.id)
 
+        self.resp.set_header.assert_any_call(
+            'ETag', entity_etag(self.secret.id, self.secret.updated_at))
+        self.resp.set_header.assert_any_call(
+            'Last-Modified', 'Sat, 01 Jun 2013 12:30:15 GMT')
+
+    def test_should_return_304_for_matching_etag(self):
+        updated_at = datetime(2013, 6, 1, 12, 30, 15, 123456)
+        self.secret_repo.get_last_modified.return_value = updated_at
+        self.req.if_none_match = '"other", {0}'.format(
+            entity_etag(self.secret.id, updated_at))
+
+        self.resource.on_get(self.req, self.resp, self.tenant_id,
+                             self.secret.id)
+
+        self.secret_repo.get_last_modified.assert_called_once_with(
+            self.secret.id)
+        self.assertEquals(self.resp.status, falcon.HTTP_304)
+        self.assertFalse(self.secret_repo.get.called)
+
+    def test_should_return_200_for_stale_etag(self):
+        updated_at = datetime(2013, 6, 1, 12, 30, 15, 123456)
+        self.secret_repo.get_last_modified.return_value = updated_at
+        self.req.if_none_match = '"stale"'
+
+        self.resource.on_get(self.req, self.resp, self.tenant_id,
+                             self.secret.id)
+
+        self.assertEquals(self.resp.status, falcon.HTTP_200)
         self.secret_repo.get.assert_called_once_with(entity_id=self.secret.id,
                                                      suppress_exception=True)
 
+    def test_should_return_304_if_not_modified_since(self):
+        self.secret_repo.get_last_modified.return_value = datetime(
+            2013, 6, 1, 12, 30, 15, 123456)
+        self.req.if_modified_since = 'Sat, 01 Jun 2013 12:30:15 GMT'
+
+        self.resource.on_get(self.req, self.resp, self.tenant_id,
+                             self.secret.id)
+
+        self.assertEquals(self.resp.status, falcon.HTTP_304)
+        self.assertFalse(self.secret_repo.get.called)
+
+    def test_should_return_200_if_modified_since(self):
+        self.secret_repo.get_last_modified.return_value = datetime(
+            2013, 6, 1, 12, 30, 16)
+        self.req.if_modified_since = 'Sat, 01 Jun 2013 12:30:15 GMT'
+
+        self.resource.on_get(self.req, self.resp, self.tenant_id,
+                             self.secret.id)
+
+        self.assertEquals(self.resp.status, falcon.HTTP_200)
+
+    def test_should_get_secret_as_plain(self):
+        self.req.accept = 'text/plain'
+
+        self.resource.on_get(self.req, self.resp, self.tenant_id,
+                             self.secret.id)
+
+        self.secret_repo.get_with_payload.assert_called_once_with(
+            entity_id=self.secret.id, suppress_exception=True)
+        self.assertFalse(self.secret_repo.get.called)
+
         self.assertEquals(self.resp.status, falcon.HTTP_200)
 
         resp_body = self.resp.body
         assert resp_body
 
+    def test_should_stream_secret_as_plain_from_chunks(self):
+        self.req.accept = 'text/plain'
+        chunks = iter(['plain-', 'data'])
+        self.crypto_mgr.decrypt = MagicMock(return_value=chunks)
+
+        self.resource.on_get(self.req, self.resp, self.tenant_id,
+                             self.secret.id)
+
+        self.assertEquals(self.resp.status, falcon.HTTP_200)
+        self.assertIs(chunks, self.resp.stream)
+        self.assertEqual('plain-data', ''.join(self.resp.stream))
+
     def test_should_put_secret_as_plain(self):
         self._setup_for_puts()
 
@@ -288,6 +884,19 @@ class WhenGettingPuttingOrDeletingSecretUsingSecretResource(unittest.TestCase):
         assert self.mime_type == datum.mime_type
         assert datum.kek_metadata is not None
 
+    def test_should_put_secret_for_tenant_entity(self):
+        self._setup_for_puts()
+
+        with patch.object(self.crypto_mgr, 'encrypt',
+                          wraps=self.crypto_mgr.encrypt) as encrypt:
+            self.resource.on_put(self.req, self.resp, self.tenant_id,
+                                 self.secret.id)
+
+        args, kwargs = encrypt.call_args
+        self.assertIs(self.tenant, args[2])
+        self.tenant_repo.find_by_keystone_id.assert_called_once_with(
+            self.tenant_id, suppress_exception=True)
+
     def test_should_fail_put_secret_as_json(self):
         self._setup_for_puts()
 
@@ -328,6 +937,33 @@ class WhenGettingPuttingOrDeletingSecretUsingSecretResource(unittest.TestCase):
         exception = cm.exception
         assert falcon.HTTP_400 == exception.status
 
+    def test_should_fail_put_secret_content_length_too_large(self):
+        self._setup_for_puts()
+        self.req.content_length = 1024 * 1024 * 1024
+
+        with self.assertRaises(falcon.HTTPError) as cm:
+            self.resource.on_put(self.req, self.resp, self.tenant_id,
+                                 self.secret.id)
+
+        exception = cm.exception
+        assert falcon.HTTP_413 == exception.status
+        assert not self.secret_repo.get.called
+        assert not self.stream.read.called
+
+    def test_should_fail_put_secret_too_large_without_content_length(self):
+        self._setup_for_puts()
+        self.req.content_length = None
+
+        # Stream never runs dry, so the read must stop at the limit.
+        self.stream.read.side_effect = lambda size: 'x' * size
+        with self.assertRaises(falcon.HTTPError) as cm:
+            self.resource.on_put(self.req, self.resp, self.tenant_id,
+                                 self.secret.id)
+
+        exception = cm.exception
+        assert falcon.HTTP_413 == exception.status
+        assert not self.datum_repo.create_from.called
+
     def test_should_fail_put_secret_with_existing_datum(self):
         self._setup_for_puts()
 
@@ -345,8 +981,8 @@ class WhenGettingPuttingOrDeletingSecretUsingSecretResource(unittest.TestCase):
         self.resource.on_delete(self.req, self.resp, self.tenant_id,
                                 self.secret.id)
 
-        self.secret_repo.get.assert_called_once_with(entity_id=self.secret.id)
-        self.secret_repo.delete_entity.assert_called_once_with(self.secret)
+        self.secret_repo.delete_entity_by_id.assert_called_once_with(
+            entity_id=self.secret.id)
 
     def test_should_throw_exception_for_get_when_secret_not_found(self):
         self.secret_repo.get.side_effect = exception.NotFound(
@@ -357,8 +993,8 @@ class WhenGettingPuttingOrDeletingSecretUsingSecretResource(unittest.TestCase):
                                  self.secret.id)
 
     def test_should_throw_exception_for_delete_when_secret_not_found(self):
-        self.secret_repo.get.side_effect = exception.NotFound(
-            "Test not found exception")
+        self.secret_repo.delete_entity_by_id.side_effect = \
+            exception.NotFound("Test not found exception")
 
         with self.assertRaises(exception.NotFound):
             self.resource.on_delete(self.req, self.resp, self.tenant_id,
@@ -377,11 +1013,15 @@ class WhenGettingPuttingOrDeletingSecretUsingSecretResource(unittest.TestCase):
         self.stream = MagicMock()
         self.stream.read.return_value = self.plain_text
         self.req.stream = self.stream
+        self.req.content_length = len(self.plain_text)
 
 
 class WhenCreatingOrdersUsingOrdersResource(unittest.TestCase):
 
     def setUp(self):
+        get_tenant_cache().clear()
+        get_idempotency_cache().clear()
+
         self.secret_name = 'name'
         self.secret_mime_type = 'type'
         self.secret_algorithm = "algo"
@@ -396,7 +1036,7 @@ class WhenCreatingOrdersUsingOrdersResource(unittest.TestCase):
         self.tenant.keystone_id = self.tenant_keystone_id
 
         self.tenant_repo = MagicMock()
-        self.tenant_repo.get.return_value = self.tenant
+        self.tenant_repo.find_by_keystone_id.return_value = self.tenant
 
         self.order_repo = MagicMock()
         self.order_repo.create_from.return_value = None
@@ -414,23 +1054,48 @@ class WhenCreatingOrdersUsingOrdersResource(unittest.TestCase):
         self.json = json.dumps(order_req)
         self.stream.read.return_value = self.json
 
+        self.idempotency_repo = MagicMock()
+        self.idempotency_repo.find_by_key.return_value = None
+
+        self.headers = {}
         self.req = MagicMock()
         self.req.stream = self.stream
+        self.req.get_header.side_effect = self.headers.get
 
         self.resp = MagicMock()
         self.policy = MagicMock()
         self.resource = OrdersResource(self.tenant_repo, self.order_repo,
-                                       self.queue_resource, self.policy)
+                                       self.queue_resource, self.policy,
+                                       self.idempotency_repo)
 
     def test_should_add_new_order(self):
         self.resource.on_post(self.req, self.resp, self.tenant_keystone_id)
 
-        self.queue_resource.process_order.assert_called_once_with(order_id=
-                                                                  None)
+        self.queue_resource.process_order.assert_called_once_with(
+            order_id=None, keystone_id=self.tenant_keystone_id)
 
         args, kwargs = self.order_repo.create_from.call_args
         assert isinstance(args[0], Order)
 
+    def test_should_not_reprocess_order_for_repeated_idempotency_key(self):
+        self.headers['Idempotency-Key'] = 'key1234'
+
+        self.resource.on_post(self.req, self.resp, self.tenant_keystone_id)
+        self.resource.on_post(self.req, self.resp, self.tenant_keystone_id)
+
+        self.assertEqual(1, self.order_repo.create_from.call_count)
+        self.assertEqual(1, self.queue_resource.process_order.call_count)
+        self.assertEqual(falcon.HTTP_202, self.resp.status)
+
+    def test_should_reject_overlong_idempotency_key(self):
+        self.headers['Idempotency-Key'] = 'k' * 256
+
+        with self.assertRaises(falcon.HTTPError):
+            self.resource.on_post(self.req, self.resp,
+                                  self.tenant_keystone_id)
+
+        self.assertFalse(self.order_repo.create_from.called)
+
 
 class WhenGettingOrDeletingOrderUsingOrderResource(unittest.TestCase):
 
@@ -444,9 +1109,11 @@ class WhenGettingOrDeletingOrderUsingOrderResource(unittest.TestCase):
 
         self.order_repo = MagicMock()
         self.order_repo.get.return_value = self.order
-        self.order_repo.delete_entity.return_value = None
+        self.order_repo.delete_entity_by_id.return_value = None
 
         self.req = MagicMock()
+        self.req.if_none_match = None
+        self.req.if_modified_since = None
         self.resp = MagicMock()
         self.policy = MagicMock()
 
@@ -458,12 +1125,23 @@ class WhenGettingOrDeletingOrderUsingOrderResource(unittest.TestCase):
 
         self.order_repo.get.assert_called_once_with(entity_id=self.order.id)
 
+    def test_should_return_304_for_unchanged_order(self):
+        updated_at = datetime(2013, 6, 1, 12, 30, 15)
+        self.order_repo.get_last_modified.return_value = updated_at
+        self.req.if_none_match = entity_etag(self.order.id, updated_at)
+
+        self.resource.on_get(self.req, self.resp, self.tenant_keystone_id,
+                             self.order.id)
+
+        self.assertEqual(falcon.HTTP_304, self.resp.status)
+        self.assertFalse(self.order_repo.get.called)
+
     def test_should_delete_order(self):
         self.resource.on_delete(self.req, self.resp, self.tenant_keystone_id,
                                 self.order.id)
 
-        self.order_repo.get.assert_called_once_with(entity_id=self.order.id)
-        self.order_repo.delete_entity.assert_called_once_with(self.order)
+        self.order_repo.delete_entity_by_id.assert_called_once_with(
+            entity_id=self.order.id)
 
     def test_should_throw_exception_for_get_when_order_not_found(self):
         self.order_repo.get.side_effect = exception.NotFound(
@@ -474,8 +1152,8 @@ class WhenGettingOrDeletingOrderUsingOrderResource(unittest.TestCase):
                                  self.order.id)
 
     def test_should_throw_exception_for_delete_when_order_not_found(self):
-        self.order_repo.get.side_effect = exception.NotFound(
-            "Test not found exception")
+        self.order_repo.delete_entity_by_id.side_effect = \
+            exception.NotFound("Test not found exception")
 
         with self.assertRaises(exception.NotFound):
             self.resource.on_delete(self.req, self.resp,
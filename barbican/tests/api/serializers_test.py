@@ -0,0 +1,122 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from datetime import datetime
+from barbican.api.serializers import OrderSerializer, SecretSerializer
+from barbican.common import utils
+from barbican.crypto.mime_types import augment_fields_with_content_types
+from barbican.model.models import EncryptedDatum, Order, Secret
+from barbican.openstack.common import jsonutils
+
+
+def _json_handler(obj):
+    return obj.isoformat() if hasattr(obj, 'isoformat') else obj
+
+
+class WhenSerializingSecrets(unittest.TestCase):
+
+    def setUp(self):
+        self.tenant_id = 'keystone1234'
+        self.secret = Secret({'name': 'name1234',
+                              'mime_type': 'text/plain',
+                              'expiration': datetime(2014, 1, 1),
+                              'algorithm': 'AES',
+                              'bit_length': 256,
+                              'cypher_type': 'CBC'})
+        self.secret.id = 'idsecret1'
+        self.secret.created_at = datetime(2013, 6, 1, 12, 30, 15, 123456)
+        self.secret.updated_at = datetime(2013, 6, 2, 8, 0, 0)
+
+        datum = EncryptedDatum()
+        datum.mime_type = 'text/plain'
+        self.secret.encrypted_data = [datum]
+
+        self.serializer = SecretSerializer(self.tenant_id)
+
+    def test_should_match_generic_field_conversion(self):
+        fields = augment_fields_with_content_types(self.secret)
+        fields['secret_ref'] = utils.hostname_for_refs(
+            tenant_id=self.tenant_id, resource='secrets/idsecret1')
+        expected = jsonutils.loads(jsonutils.dumps(fields,
+                                                   default=_json_handler))
+
+        actual = jsonutils.loads(self.serializer.to_json(self.secret))
+
+        self.assertEqual(expected, actual)
+
+    def test_should_take_content_types_from_last_supported_datum(self):
+        for mime_type in ('application/aes', 'bogus/type'):
+            datum = EncryptedDatum()
+            datum.mime_type = mime_type
+            self.secret.encrypted_data.append(datum)
+
+        fields = self.serializer.to_dict(self.secret)
+
+        self.assertEqual({'default': 'application/aes'},
+                         fields['content_types'])
+
+    def test_should_omit_ref_when_asked(self):
+        fields = self.serializer.to_dict(self.secret, include_ref=False)
+
+        self.assertFalse('secret_ref' in fields)
+
+    def test_should_include_deleted_fields(self):
+        self.secret.deleted = True
+        self.secret.deleted_at = datetime(2013, 6, 3)
+
+        fields = self.serializer.to_dict(self.secret)
+
+        self.assertTrue(fields['is_deleted'])
+        self.assertEqual('2013-06-03T00:00:00', fields['deleted'])
+
+
+class WhenSerializingOrders(unittest.TestCase):
+
+    def setUp(self):
+        self.tenant_id = 'keystone1234'
+        self.order = Order()
+        self.order.id = 'idorder1'
+        self.order.status = 'ACTIVE'
+        self.order.secret_name = 'name1234'
+        self.order.secret_mime_type = 'text/plain'
+        self.order.secret_expiration = datetime(2014, 1, 1)
+        self.order.secret_id = 'idsecret1'
+
+        self.serializer = OrderSerializer(self.tenant_id)
+
+    def test_should_serialize_order(self):
+        fields = jsonutils.loads(self.serializer.to_json(self.order))
+
+        self.assertEqual('ACTIVE', fields['status'])
+        self.assertEqual('name1234', fields['secret']['name'])
+        self.assertEqual('2014-01-01T00:00:00',
+                         fields['secret']['expiration'])
+        self.assertEqual(utils.hostname_for_refs(
+            tenant_id=self.tenant_id, resource='secrets/idsecret1'),
+            fields['secret_ref'])
+        self.assertFalse('secret_id' in fields)
+
+    def test_should_serialize_placeholder_ref_without_secret(self):
+        self.order.secret_id = None
+
+        fields = self.serializer.to_dict(self.order)
+
+        self.assertTrue(fields['secret_ref'].endswith('secrets/????'))
+
+
+if __name__ == '__main__':
+    unittest.main()
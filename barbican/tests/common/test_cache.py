@@ -0,0 +1,75 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import unittest
+
+from mock import patch
+
+from barbican.common.cache import LRUCache
+
+
+class WhenUsingLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = LRUCache(max_size=2, ttl=60)
+
+    def test_should_return_cached_value(self):
+        self.cache.put('key', 'value')
+
+        self.assertEqual('value', self.cache.get('key'))
+        self.assertEqual(1, self.cache.stats()['hits'])
+
+    def test_should_count_miss(self):
+        self.assertIsNone(self.cache.get('missing'))
+        self.assertEqual(1, self.cache.stats()['misses'])
+
+    def test_should_evict_least_recently_used(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(3, self.cache.get('c'))
+        self.assertEqual(1, self.cache.stats()['evictions'])
+
+    def test_should_expire_after_ttl(self):
+        self.cache.put('key', 'value')
+
+        with patch.object(time, 'time', return_value=time.time() + 61):
+            self.assertIsNone(self.cache.get('key'))
+
+    def test_should_not_cache_when_disabled(self):
+        cache = LRUCache(max_size=0, ttl=60)
+        cache.put('key', 'value')
+
+        self.assertIsNone(cache.get('key'))
+
+    def test_should_invalidate_and_clear(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+
+        self.cache.invalidate('a')
+        self.assertIsNone(self.cache.get('a'))
+
+        self.cache.clear()
+        self.assertEqual({'size': 0, 'max_size': 2, 'hits': 0,
+                          'misses': 0, 'evictions': 0}, self.cache.stats())
+
+
+if __name__ == '__main__':
+    unittest.main()
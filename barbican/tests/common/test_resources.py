@@ -0,0 +1,264 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+
+from mock import MagicMock, patch
+import sqlalchemy
+
+from barbican.common import exception
+from barbican.common import resources
+from barbican.common.resources import (create_encrypted_datum,
+                                       create_secret, create_secrets,
+                                       get_idempotency_cache,
+                                       get_or_create_tenant,
+                                       get_tenant, get_tenant_cache)
+from barbican.crypto.extension_manager import (
+    CryptoMimeTypeNotSupportedException
+)
+from barbican.model.models import EncryptedDatum, Tenant
+from barbican.model import repositories
+from barbican.tests.model.test_repositories import (setup_in_memory_db,
+                                                    teardown_in_memory_db)
+
+
+class WhenResolvingTenants(unittest.TestCase):
+
+    def setUp(self):
+        get_tenant_cache().clear()
+
+        self.keystone_id = 'keystone1234'
+        self.tenant = Tenant()
+        self.tenant.id = 'tenantid1234'
+        self.tenant.keystone_id = self.keystone_id
+
+        self.tenant_repo = MagicMock()
+        self.tenant_repo.find_by_keystone_id.return_value = self.tenant
+        self.tenant_repo.get.return_value = self.tenant
+
+    def test_should_find_tenant_once_by_keystone_id(self):
+        for _ in xrange(3):
+            tenant = get_or_create_tenant(self.keystone_id, self.tenant_repo)
+            self.assertIs(self.tenant, tenant)
+
+        self.tenant_repo.find_by_keystone_id.assert_called_once_with(
+            self.keystone_id, suppress_exception=True)
+        self.assertEqual(2, get_tenant_cache().stats()['hits'])
+
+    def test_should_create_and_cache_new_tenant(self):
+        self.tenant_repo.find_by_keystone_id.return_value = None
+        self.tenant_repo.create_or_get.return_value = self.tenant
+
+        tenant = get_or_create_tenant(self.keystone_id, self.tenant_repo)
+        self.assertIs(self.tenant, tenant)
+        self.assertIs(tenant, get_or_create_tenant(self.keystone_id,
+                                                   self.tenant_repo))
+
+        self.tenant_repo.create_or_get.assert_called_once_with(
+            self.keystone_id)
+        self.assertIs(tenant, get_tenant(self.tenant.id, self.tenant_repo))
+        self.assertFalse(self.tenant_repo.get.called)
+
+    def test_should_get_tenant_once_by_id(self):
+        get_tenant(self.tenant.id, self.tenant_repo)
+        get_tenant(self.tenant.id, self.tenant_repo)
+
+        self.tenant_repo.get.assert_called_once_with(self.tenant.id)
+        self.assertIs(self.tenant, get_or_create_tenant(self.keystone_id,
+                                                        self.tenant_repo))
+        self.assertFalse(self.tenant_repo.find_by_keystone_id.called)
+
+
+class WhenCachingTenantsCreatedByRequests(unittest.TestCase):
+
+    def setUp(self):
+        setup_in_memory_db()
+        get_tenant_cache().clear()
+        self.tenant_repo = repositories.TenantRepo()
+        self.session = repositories.begin_request_session()
+
+    def tearDown(self):
+        repositories.end_request_session(self.session, commit=False)
+        teardown_in_memory_db()
+
+    def test_should_cache_new_tenant_once_committed(self):
+        tenant = get_or_create_tenant('keystone1234', self.tenant_repo)
+        self.assertIsNone(get_tenant_cache().get(('id', tenant.id)))
+
+        repositories.end_request_session(self.session)
+
+        self.assertIs(tenant, get_tenant_cache().get(('id', tenant.id)))
+
+    def test_should_not_cache_new_tenant_when_rolled_back(self):
+        tenant_id = get_or_create_tenant('keystone1234',
+                                         self.tenant_repo).id
+
+        repositories.end_request_session(self.session, commit=False)
+
+        self.assertIsNone(get_tenant_cache().get(('id', tenant_id)))
+        self.assertIsNone(get_tenant_cache().get(('keystone_id',
+                                                  'keystone1234')))
+
+
+class WhenCreatingCachesConcurrently(unittest.TestCase):
+
+    def setUp(self):
+        self.tenant_cache = resources._TENANT_CACHE
+        self.idempotency_cache = resources._IDEMPOTENCY_CACHE
+        resources._TENANT_CACHE = None
+        resources._IDEMPOTENCY_CACHE = None
+        self.caches = []
+
+        lru_cache = resources.cache.LRUCache
+
+        def slow_lru_cache(*args, **kwargs):
+            # Widen the window in which racing threads could each
+            #   decide that no cache exists yet.
+            time.sleep(0.05)
+            new_cache = lru_cache(*args, **kwargs)
+            self.caches.append(new_cache)
+            return new_cache
+
+        self.patcher = patch.object(resources.cache, 'LRUCache',
+                                    side_effect=slow_lru_cache)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        resources._TENANT_CACHE = self.tenant_cache
+        resources._IDEMPOTENCY_CACHE = self.idempotency_cache
+
+    def _race(self, get_cache):
+        start = threading.Event()
+        seen = []
+
+        def worker():
+            start.wait()
+            seen.append(get_cache())
+
+        threads = [threading.Thread(target=worker) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        return seen
+
+    def test_should_create_one_tenant_cache(self):
+        seen = self._race(get_tenant_cache)
+
+        self.assertEqual(1, len(self.caches))
+        self.assertEqual(20, len(seen))
+        self.assertEqual(set([id(self.caches[0])]), set(map(id, seen)))
+
+    def test_should_create_one_idempotency_cache(self):
+        seen = self._race(get_idempotency_cache)
+
+        self.assertEqual(1, len(self.caches))
+        self.assertEqual(20, len(seen))
+        self.assertEqual(set([id(self.caches[0])]), set(map(id, seen)))
+
+
+class WhenCreatingSecrets(unittest.TestCase):
+
+    def setUp(self):
+        setup_in_memory_db()
+        self.tenant = repositories.TenantRepo().create_or_get('keystone1234')
+        self.secret_repo = repositories.SecretRepo()
+        self.tenant_secret_repo = repositories.TenantSecretRepo()
+        self.datum_repo = repositories.EncryptedDatumRepo()
+
+        self.datum = EncryptedDatum()
+        self.datum.mime_type = 'text/plain'
+        self.datum.cypher_text = 'cypher_text'
+        self.crypto_manager = MagicMock()
+        self.crypto_manager.encrypt.return_value = self.datum
+
+        self.data = {'name': 'name1234',
+                     'mime_type': 'text/plain',
+                     'plain_text': 'not-encrypted'}
+
+    def tearDown(self):
+        teardown_in_memory_db()
+
+    def _count(self, table):
+        return repositories.get_engine().execute(
+            'SELECT COUNT(*) FROM {0}'.format(table)).scalar()
+
+    def test_should_create_secret_in_one_transaction(self):
+        commits = []
+        sqlalchemy.event.listen(repositories.get_engine(), 'commit',
+                                commits.append)
+
+        secret = create_secret(self.data, self.tenant, self.crypto_manager,
+                               self.secret_repo, self.tenant_secret_repo,
+                               self.datum_repo)
+
+        self.assertEqual(1, len(commits))
+        self.assertEqual(secret.id, self.datum.secret_id)
+        self.assertEqual(1, self._count('secrets'))
+        self.assertEqual(1, self._count('tenant_secret'))
+        self.assertEqual(1, self._count('encrypted_data'))
+
+    def test_should_not_leave_partial_secret_behind(self):
+        self.datum_repo.create_from = MagicMock(
+            side_effect=exception.Duplicate())
+
+        with self.assertRaises(exception.Duplicate):
+            create_secret(self.data, self.tenant, self.crypto_manager,
+                          self.secret_repo, self.tenant_secret_repo,
+                          self.datum_repo)
+
+        self.assertEqual(0, self._count('secrets'))
+        self.assertEqual(0, self._count('tenant_secret'))
+
+    def test_should_store_no_batch_secrets_if_one_cannot_be_encrypted(self):
+        self.crypto_manager.encrypt.side_effect = [
+            self.datum, CryptoMimeTypeNotSupportedException('text/plain')]
+
+        with self.assertRaises(exception.InvalidSecretBatchItem) as cm:
+            create_secrets([self.data, dict(self.data)], self.tenant,
+                           self.crypto_manager, self.secret_repo,
+                           self.tenant_secret_repo, self.datum_repo)
+
+        self.assertIn('Secret 1 of the batch', str(cm.exception))
+        self.assertEqual(0, self._count('secrets'))
+        self.assertEqual(0, self._count('tenant_secret'))
+        self.assertEqual(0, self._count('encrypted_data'))
+
+    def test_should_add_data_without_another_association(self):
+        del self.data['plain_text']
+        secret = create_secret(self.data, self.tenant, self.crypto_manager,
+                               self.secret_repo, self.tenant_secret_repo,
+                               self.datum_repo)
+        secret = self.secret_repo.get(entity_id=secret.id)
+
+        create_encrypted_datum(secret, 'not-encrypted', self.tenant,
+                               self.crypto_manager, self.datum_repo)
+
+        self.crypto_manager.encrypt.assert_called_once_with(
+            'not-encrypted', secret, self.tenant)
+        self.assertEqual(1, self._count('tenant_secret'))
+        self.assertEqual(1, self._count('encrypted_data'))
+        usage = repositories.TenantUsageRepo().find_by_keystone_id(
+            'keystone1234')
+        self.assertEqual(1, usage.secrets)
+        self.assertEqual(1, self._count('tenant_usage'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+
+from mock import MagicMock
+import sqlalchemy
+from sqlalchemy.dialects import mysql
+import unittest
+
+from barbican.common import exception
+from barbican.db.sqlalchemy import migration
+from barbican.model import models
+
+
+def _lookup_indexes():
+    module = migration._get_repository().version(1).script().module
+    return module.INDEXES
+
+
+class WhenMigratingDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine('sqlite://')
+
+    def _index_names(self, table_name):
+        return migration.get_index_names(self.engine, table_name)
+
+    def _assert_indexed(self, indexed=True):
+        for table_name, name, columns, unique in _lookup_indexes():
+            self.assertEqual(indexed, name in self._index_names(table_name))
+
+    def test_should_create_empty_database_at_latest_version(self):
+        version = migration.db_sync(self.engine)
+
+        self.assertEqual(migration.latest_version(), version)
+        self.assertEqual(version, migration.db_version(self.engine))
+        self._assert_indexed()
+
+    def test_should_upgrade_database_predating_migrations(self):
+        models.register_models(self.engine)
+        for table_name, name, columns, unique in _lookup_indexes():
+            self.engine.execute('DROP INDEX {0}'.format(name))
+        self._assert_indexed(False)
+
+        migration.db_sync(self.engine)
+
+        self.assertEqual(migration.latest_version(),
+                         migration.db_version(self.engine))
+        self._assert_indexed()
+
+    def test_should_merge_duplicate_tenants_before_indexing(self):
+        models.register_models(self.engine)
+        for table_name, name, columns, unique in _lookup_indexes():
+            self.engine.execute('DROP INDEX {0}'.format(name))
+        row = {'updated_at': datetime.datetime(2013, 1, 1), 'deleted': False,
+               'status': 'ACTIVE'}
+        for tenant_id, keystone_id, day in (('newer', 'keystone1', 2),
+                                            ('oldest', 'keystone1', 1),
+                                            ('other', 'keystone2', 1)):
+            self.engine.execute(models.Tenant.__table__.insert().values(
+                id=tenant_id, keystone_id=keystone_id,
+                created_at=datetime.datetime(2013, 1, day), **row))
+        for tenant_id in ('newer', 'oldest', 'other'):
+            self.engine.execute(models.TenantSecret.__table__.insert().values(
+                id='assoc-' + tenant_id, tenant_id=tenant_id,
+                secret_id='secret-' + tenant_id, created_at=row['updated_at'],
+                **row))
+            self.engine.execute(models.Order.__table__.insert().values(
+                id='order-' + tenant_id, tenant_id=tenant_id,
+                created_at=row['updated_at'], **row))
+
+        migration.db_sync(self.engine, 1)
+
+        tenants = dict(self.engine.execute(
+            'SELECT id, keystone_id FROM tenants').fetchall())
+        self.assertEqual({'oldest': 'keystone1', 'other': 'keystone2'},
+                         tenants)
+        for table in ('tenant_secret', 'orders'):
+            tenant_ids = dict(self.engine.execute(
+                'SELECT id, tenant_id FROM {0}'.format(table)).fetchall())
+            self.assertEqual(['oldest', 'oldest', 'other'],
+                             sorted(tenant_ids.values()))
+        self.assertIn('ix_tenants_keystone_id', self._index_names('tenants'))
+
+    def test_should_downgrade_and_upgrade(self):
+        migration.db_sync(self.engine)
+
+        self.assertEqual(0, migration.db_sync(self.engine, 0))
+        self._assert_indexed(False)
+
+        migration.db_sync(self.engine)
+        self._assert_indexed()
+
+    def test_should_add_and_drop_tenant_shards_table(self):
+        migration.db_sync(self.engine, 1)
+        self.assertNotIn('tenant_shards', self.engine.table_names())
+
+        migration.db_sync(self.engine, 2)
+        self.assertIn('tenant_shards', self.engine.table_names())
+        self.assertIn('ix_tenant_shards_keystone_id',
+                      self._index_names('tenant_shards'))
+
+    def test_should_clear_defaulted_expirations(self):
+        migration.db_sync(self.engine, 2)
+        created_at = datetime.datetime(2013, 1, 1)
+        for secret_id, expiration in (
+                ('defaulted', created_at + datetime.timedelta(
+                    microseconds=10)),
+                ('expiring', datetime.datetime(2014, 1, 1)),
+                ('never', None)):
+            self.engine.execute(models.Secret.__table__.insert().values(
+                id=secret_id, created_at=created_at, updated_at=created_at,
+                deleted=False, status='ACTIVE', mime_type='text/plain',
+                expiration=expiration))
+        self.assertNotIn('ix_secrets_expiration',
+                         self._index_names('secrets'))
+
+        migration.db_sync(self.engine, 3)
+
+        expirations = dict(self.engine.execute(
+            'SELECT id, expiration FROM secrets').fetchall())
+        self.assertIsNone(expirations['defaulted'])
+        self.assertIsNotNone(expirations['expiring'])
+        self.assertIsNone(expirations['never'])
+        self.assertIn('ix_secrets_expiration', self._index_names('secrets'))
+
+    def test_should_add_tenant_usage_counted_from_existing_rows(self):
+        migration.db_sync(self.engine, 3)
+        now = datetime.datetime(2013, 1, 1)
+        row = {'created_at': now, 'updated_at': now, 'deleted': False,
+               'status': 'ACTIVE'}
+        for tenant_id in ('tenant1', 'tenant2'):
+            self.engine.execute(models.Tenant.__table__.insert().values(
+                id=tenant_id, keystone_id='keystone-' + tenant_id, **row))
+        for secret_id, deleted in (('live', False), ('deleted', True)):
+            self.engine.execute(models.Secret.__table__.insert().values(
+                dict(row, id=secret_id, deleted=deleted,
+                     mime_type='text/plain')))
+            self.engine.execute(models.TenantSecret.__table__.insert().values(
+                id='assoc-' + secret_id, tenant_id='tenant1',
+                secret_id=secret_id, **row))
+        self.engine.execute(models.Order.__table__.insert().values(
+            id='order1', tenant_id='tenant1', **row))
+
+        migration.db_sync(self.engine, 4)
+
+        usage = dict((row[0], tuple(row[1:])) for row in self.engine.execute(
+            'SELECT tenant_id, secrets, orders FROM tenant_usage'))
+        self.assertEqual({'tenant1': (1, 1), 'tenant2': (0, 0)}, usage)
+        self.assertIn('ix_tenant_usage_tenant_id',
+                      self._index_names('tenant_usage'))
+
+        migration.db_sync(self.engine, 3)
+        self.assertNotIn('tenant_usage', self.engine.table_names())
+
+    def test_should_do_nothing_when_up_to_date(self):
+        migration.db_sync(self.engine)
+
+        self.assertEqual(migration.latest_version(),
+                         migration.db_sync(self.engine))
+
+    def test_should_raise_if_not_under_control(self):
+        with self.assertRaises(exception.DatabaseMigrationError):
+            migration.db_version(self.engine)
+
+    def test_should_raise_if_already_under_control(self):
+        migration.version_control(self.engine)
+
+        with self.assertRaises(exception.DatabaseMigrationError):
+            migration.version_control(self.engine)
+
+
+class WhenCreatingIndexesOnline(unittest.TestCase):
+
+    def setUp(self):
+        table = models.Secret.__table__
+        self.index = sqlalchemy.Index('ix_test', table.c.name)
+
+    def test_should_create_in_place_on_mysql(self):
+        engine = MagicMock()
+        engine.name = 'mysql'
+        engine.dialect = mysql.dialect()
+
+        migration.create_index_online(engine, self.index)
+
+        args, kwargs = engine.execute.call_args
+        self.assertEqual('CREATE INDEX ix_test ON secrets (name) '
+                         'ALGORITHM=INPLACE LOCK=NONE', args[0].text)
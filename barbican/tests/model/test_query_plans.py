@@ -0,0 +1,163 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+
+from barbican.model import models
+from barbican.model import repositories
+from barbican.openstack.common import timeutils
+from barbican.tests.model.test_repositories import (StatementRecorder,
+                                                    create_secret,
+                                                    new_order,
+                                                    new_tenant_secret,
+                                                    setup_in_memory_db,
+                                                    teardown_in_memory_db)
+
+
+class WhenExplainingRepositoryQueries(unittest.TestCase):
+    """
+    Checks SQLite's EXPLAIN QUERY PLAN for each repository query, to make
+    sure none has to scan a whole table (or index) to find its rows.
+    """
+
+    def setUp(self):
+        setup_in_memory_db()
+        self.engine = repositories.get_engine()
+
+        self.tenant_repo = repositories.TenantRepo()
+        self.secret_repo = repositories.SecretRepo()
+        self.datum_repo = repositories.EncryptedDatumRepo()
+        self.tenant_secret_repo = repositories.TenantSecretRepo()
+        self.order_repo = repositories.OrderRepo()
+        self.idempotency_repo = repositories.IdempotencyKeyRepo()
+        self.usage_repo = repositories.TenantUsageRepo()
+
+        self.tenant = self.tenant_repo.create_or_get('keystone1234')
+        self.secret = create_secret()
+        self.assoc = new_tenant_secret(self.tenant, self.secret)
+        self.tenant_secret_repo.create_from(self.assoc)
+        self.datum = models.EncryptedDatum()
+        self.datum.secret_id = self.secret.id
+        self.datum_repo.create_from(self.datum)
+        self.order = self.order_repo.create_from(new_order(self.tenant))
+
+        self.marker = (self.assoc.created_at, self.secret.id)
+        self.deleted_before = timeutils.utcnow() - datetime.timedelta(
+            seconds=60)
+
+        self.recorder = StatementRecorder()
+
+    def tearDown(self):
+        teardown_in_memory_db()
+
+    def _scans_table(self, detail):
+        """Whether a plan step scans a table, rather than a subquery."""
+        words = detail.split()
+        if words[0] != 'SCAN':
+            return False
+        # Older SQLite versions report 'SCAN TABLE <name>'.
+        name = words[2] if words[1] == 'TABLE' else words[1]
+        return not name.startswith('anon_')
+
+    def _assert_uses_indexes(self, lookup, *args, **kwargs):
+        self.recorder.clear()
+        lookup(*args, **kwargs)
+        statements = zip(self.recorder.statements, self.recorder.parameters)
+
+        explained = 0
+        for statement, parameters in statements:
+            if statement.split()[0] not in ('SELECT', 'UPDATE', 'DELETE'):
+                continue
+            plan = self.engine.execute('EXPLAIN QUERY PLAN ' + statement,
+                                       parameters).fetchall()
+            for row in plan:
+                self.assertFalse(self._scans_table(row['detail']),
+                                 '{0}\n{1}'.format(statement, row['detail']))
+            explained += 1
+        self.assertTrue(explained)
+
+    def test_tenant_lookups(self):
+        self._assert_uses_indexes(self.tenant_repo.get, self.tenant.id)
+        self._assert_uses_indexes(self.tenant_repo.find_by_keystone_id,
+                                  'keystone1234')
+        self._assert_uses_indexes(self.tenant_repo.create_or_get,
+                                  'keystone1234')
+
+    def test_secret_lookups(self):
+        self._assert_uses_indexes(self.secret_repo.get, self.secret.id)
+        self._assert_uses_indexes(self.secret_repo.get_with_payload,
+                                  self.secret.id)
+        self._assert_uses_indexes(self.secret_repo.find_by_name, 'name1234')
+        self._assert_uses_indexes(self.secret_repo.get_last_modified,
+                                  self.secret.id)
+        metadata_only = self.secret_repo.create_from(models.Secret(
+            {'name': 'name5678', 'mime_type': 'text/plain'}))
+        self._assert_uses_indexes(self.secret_repo.get_last_modified,
+                                  metadata_only.id)
+        self._assert_uses_indexes(self.secret_repo.get_by_ids,
+                                  'keystone1234', [self.secret.id])
+
+    def test_secret_listing(self):
+        self._assert_uses_indexes(self.secret_repo.get_by_create_date,
+                                  'keystone1234', 10)
+        self._assert_uses_indexes(self.secret_repo.get_by_create_date,
+                                  'keystone1234', 10, after=self.marker)
+        self._assert_uses_indexes(self.secret_repo.get_by_create_date,
+                                  'keystone1234', 10, before=self.marker)
+
+    def test_secret_delete_and_purge(self):
+        self._assert_uses_indexes(self.secret_repo.delete_entity_by_id,
+                                  self.secret.id)
+        self._assert_uses_indexes(self.secret_repo.purge_deleted,
+                                  timeutils.utcnow() + datetime.timedelta(
+                                      seconds=1), 10)
+
+    def test_secret_expiry(self):
+        self._assert_uses_indexes(self.secret_repo.delete_expired,
+                                  timeutils.utcnow(), 10)
+
+    def test_secret_data_lookups(self):
+        self._assert_uses_indexes(self.datum_repo.get, self.datum.id)
+        self._assert_uses_indexes(self.datum_repo.purge_deleted,
+                                  self.deleted_before, 10)
+        self._assert_uses_indexes(self.tenant_secret_repo.get, self.assoc.id)
+        self._assert_uses_indexes(self.tenant_secret_repo.purge_deleted,
+                                  self.deleted_before, 10)
+
+    def test_order_lookups(self):
+        self._assert_uses_indexes(self.order_repo.get, self.order.id)
+        self._assert_uses_indexes(self.order_repo.get_last_modified,
+                                  self.order.id)
+        self._assert_uses_indexes(self.order_repo.delete_entity_by_id,
+                                  self.order.id)
+        self._assert_uses_indexes(self.order_repo.purge_deleted,
+                                  timeutils.utcnow() + datetime.timedelta(
+                                      seconds=1), 10)
+
+    def test_tenant_usage_lookups(self):
+        self._assert_uses_indexes(self.usage_repo.find_by_keystone_id,
+                                  'keystone1234')
+
+    def test_idempotency_key_lookups(self):
+        self._assert_uses_indexes(self.idempotency_repo.find_by_key,
+                                  'keystone1234', 'secrets', 'key1234')
+        self._assert_uses_indexes(self.idempotency_repo.complete,
+                                  'keystone1234', 'secrets', 'key1234',
+                                  '/location', '{}', timeutils.utcnow())
+        self._assert_uses_indexes(self.idempotency_repo.release,
+                                  'keystone1234', 'secrets', 'key1234')
+        self._assert_uses_indexes(self.idempotency_repo.purge_deleted,
+                                  self.deleted_before, 10)
@@ -0,0 +1,1189 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import itertools
+import sqlite3
+import threading
+import time
+import unittest
+
+from mock import MagicMock, patch
+import sqlalchemy
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+from barbican.common import exception
+from barbican.model import models
+from barbican.model import repositories
+from barbican.openstack.common import timeutils
+
+
+def setup_in_memory_db():
+    """Point the repositories at a fresh, empty in-memory SQLite database."""
+    repositories.CONF.set_override('sql_connection', 'sqlite://')
+    repositories._ENGINE = None
+    repositories._MAKER = None
+    repositories.configure_db()
+
+
+def teardown_in_memory_db():
+    repositories.CONF.clear_override('sql_connection')
+    repositories.CONF.clear_override('sql_read_connection')
+    repositories.CONF.clear_override('sql_shard_connection')
+    repositories._ENGINE = None
+    repositories._MAKER = None
+    repositories._READ_MAKERS = None
+    repositories._RECENT_WRITERS = None
+    repositories._SHARD_MAP = None
+
+
+class StatementRecorder(object):
+    """
+    Records the SQL statements run on the repositories' engine, and their
+    parameters, until teardown_in_memory_db() discards the engine.
+    """
+
+    def __init__(self):
+        self.statements = []
+        self.parameters = []
+        sqlalchemy.event.listen(repositories.get_engine(),
+                                'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, *args):
+        self.statements.append(statement)
+        self.parameters.append(parameters)
+
+    def clear(self):
+        del self.statements[:]
+        del self.parameters[:]
+
+
+def new_order(tenant):
+    """Return a new, unsaved order for tenant."""
+    order = models.Order()
+    order.tenant_id = tenant.id
+    order.secret_name = 'name1234'
+    return order
+
+
+def new_tenant_secret(tenant, secret):
+    """Return a new, unsaved association of secret with tenant."""
+    assoc = models.TenantSecret()
+    assoc.tenant_id = tenant.id
+    assoc.secret_id = secret.id
+    return assoc
+
+
+def create_secret(tenant=None, expires_in=None):
+    """
+    Store a new secret, associated with tenant if given, and expiring
+    expires_in seconds from now if given.
+    """
+    expiration = None
+    if expires_in is not None:
+        expiration = timeutils.utcnow() + datetime.timedelta(
+            seconds=expires_in)
+    secret = repositories.SecretRepo().create_from(models.Secret(
+        {'name': 'name1234', 'mime_type': 'text/plain',
+         'expiration': expiration}))
+    if tenant is not None:
+        repositories.TenantSecretRepo().create_from(
+            new_tenant_secret(tenant, secret))
+    return secret
+
+
+class WhenUpsertingTenants(unittest.TestCase):
+
+    def setUp(self):
+        setup_in_memory_db()
+        self.repo = repositories.TenantRepo()
+        self.keystone_id = 'keystone1234'
+
+    def tearDown(self):
+        teardown_in_memory_db()
+
+    def test_should_create_tenant(self):
+        tenant = self.repo.create_or_get(self.keystone_id)
+
+        self.assertIsNotNone(tenant.id)
+        self.assertEqual(self.keystone_id, tenant.keystone_id)
+        self.assertEqual(models.States.ACTIVE, tenant.status)
+
+    def test_should_create_tenant_only_once(self):
+        first = self.repo.create_or_get(self.keystone_id)
+        second = self.repo.create_or_get(self.keystone_id)
+
+        self.assertEqual(first.id, second.id)
+        engine = repositories.get_engine()
+        self.assertEqual(1, engine.execute(
+            'SELECT COUNT(*) FROM tenants').scalar())
+
+    def test_should_reject_duplicate_keystone_id(self):
+        self.repo.create_or_get(self.keystone_id)
+
+        tenant = models.Tenant()
+        tenant.keystone_id = self.keystone_id
+        tenant.status = models.States.ACTIVE
+        with self.assertRaises(exception.Duplicate):
+            self.repo.create_from(tenant)
+
+
+class WhenCreatingEntities(unittest.TestCase):
+
+    def setUp(self):
+        setup_in_memory_db()
+        self.tenant_repo = repositories.TenantRepo()
+        self.order_repo = repositories.OrderRepo()
+        self.tenant = self.tenant_repo.create_or_get('keystone1234')
+
+        self.recorder = StatementRecorder()
+        self.statements = self.recorder.statements
+
+    def tearDown(self):
+        teardown_in_memory_db()
+
+    def test_should_create_with_single_insert(self):
+        self.order_repo.create_from(new_order(self.tenant))
+        self.recorder.clear()
+        order = new_order(self.tenant)
+
+        created = self.order_repo.create_from(order)
+
+        self.assertIs(order, created)
+        self.assertEqual(2, len(self.statements))
+        self.assertTrue(self.statements[0].startswith('INSERT INTO orders'))
+        self.assertTrue(self.statements[1].startswith('UPDATE tenant_usage'))
+
+    def test_should_return_persisted_values(self):
+        created = self.order_repo.create_from(new_order(self.tenant))
+
+        stored = self.order_repo.get(created.id)
+        self.assertEqual(stored.created_at, created.created_at)
+        self.assertEqual(models.States.PENDING, created.status)
+        self.assertFalse(created.deleted)
+
+    def test_should_update_without_rereading(self):
+        created = self.order_repo.create_from(new_order(self.tenant))
+        self.recorder.clear()
+
+        updated = self.order_repo.update(created.id,
+                                         {'secret_name': 'other1234'})
+
+        self.assertEqual('other1234', updated.secret_name)
+        self.assertEqual(['SELECT', 'UPDATE'],
+                         [statement.split()[0]
+                          for statement in self.statements])
+
+
+class WhenLoadingSecretPayloads(unittest.TestCase):
+
+    def setUp(self):
+        setup_in_memory_db()
+        self.secret_repo = repositories.SecretRepo()
+        self.datum_repo = repositories.EncryptedDatumRepo()
+
+        self.secret = self.secret_repo.create_from(models.Secret(
+            {'name': 'name1234', 'mime_type': 'text/plain'}))
+        datum = models.EncryptedDatum()
+        datum.mime_type = 'text/plain'
+        datum.secret_id = self.secret.id
+        datum.cypher_text = 'cypher_text1234'
+        datum.kek_metadata = 'kek_metadata1234'
+        self.datum_repo.create_from(datum)
+
+        self.statements = StatementRecorder().statements
+
+    def tearDown(self):
+        teardown_in_memory_db()
+
+    def test_should_not_load_payload_for_metadata(self):
+        secret = self.secret_repo.get(self.secret.id)
+
+        datum = secret.encrypted_data[0]
+        self.assertEqual('text/plain', datum.mime_type)
+        self.assertNotIn('cypher_text', datum.__dict__)
+        self.assertEqual(1, len(self.statements))
+        self.assertNotIn('cypher_text', self.statements[0])
+
+    def test_should_load_payload_in_one_query(self):
+        secret = self.secret_repo.get_with_payload(self.secret.id)
+
+        datum = secret.encrypted_data[0]
+        self.assertEqual('cypher_text1234', datum.__dict__['cypher_text'])
+        self.assertEqual(1, len(self.statements))
+
+
+class WhenGettingLastModified(unittest.TestCase):
+
+    def setUp(self):
+        setup_in_memory_db()
+        self.secret_repo = repositories.SecretRepo()
+        self.secret = self.secret_repo.create_from(models.Secret(
+            {'name': 'name1234', 'mime_type': 'text/plain'}))
+
+    def tearDown(self):
+        teardown_in_memory_db()
+
+    def test_should_get_last_modified_of_secret_without_data(self):
+        last_modified = self.secret_repo.get_last_modified(self.secret.id)
+
+        self.assertEqual(self.secret.updated_at, last_modified)
+        self.assertEqual(self.secret_repo.get(self.secret.id)
+                         .last_modified(), last_modified)
+
+    def test_should_include_data_added_later(self):
+        datum = models.EncryptedDatum()
+        datum.secret_id = self.secret.id
+        datum.cypher_text = 'cypher_text1234'
+        repositories.EncryptedDatumRepo().create_from(datum)
+
+        last_modified = self.secret_repo.get_last_modified(self.secret.id)
+
+        self.assertEqual(datum.updated_at, last_modified)
+        self.assertTrue(last_modified >= self.secret.updated_at)
+
+    def test_should_not_find_deleted_secret(self):
+        self.secret_repo.delete_entity_by_id(self.secret.id)
+
+        self.assertIsNone(self.secret_repo.get_last_modified(self.secret.id))
+
+
+class WhenCachingLookupQueries(unittest.TestCase):
+
+    def setUp(self):
+        setup_in_memory_db()
+        self.repo = repositories.TenantRepo()
+        self.tenant = self.repo.create_or_get('keystone1234')
+        self.other = self.repo.create_or_get('keystone5678')
+
+    def tearDown(self):
+        teardown_in_memory_db()
+
+    def _cached_get(self):
+        return self.repo._cached_queries[(repositories.TenantRepo,
+                                          ('get', False))]
+
+    def test_should_bind_lookup_values(self):
+        self.assertEqual(self.tenant.id,
+                         self.repo.find_by_keystone_id('keystone1234').id)
+        self.assertEqual(self.other.id,
+                         self.repo.find_by_keystone_id('keystone5678').id)
+        self.assertIsNone(self.repo.find_by_keystone_id(
+            'keystone9999', suppress_exception=True))
+
+    def test_should_compile_lookup_once(self):
+        dialect = repositories.get_engine().dialect
+        self.repo.get(self.tenant.id)
+        compiled = self._cached_get()._compiled[dialect]
+
+        self.assertEqual(self.other.id, self.repo.get(self.other.id).id)
+        self.assertIs(compiled, self._cached_get()._compiled[dialect])
+
+    def test_should_raise_not_found(self):
+        with self.assertRaises(exception.NotFound):
+            self.repo.get('bogus_id')
+
+    def test_should_run_queries_normally_with_other_sqlalchemy(self):
+        with patch.object(repositories, '_CACHE_COMPILED_QUERIES', False):
+            with patch.dict(repositories.BaseRepo._cached_queries,
+                            clear=True):
+                self.assertEqual(self.tenant.id,
+                                 self.repo.get(self.tenant.id).id)
+                self.assertEqual(self.other.id, self.repo.find_by_keystone_id(
+                    'keystone5678').id)
+                with self.assertRaises(exception.NotFound):
+                    self.repo.get('bogus_id')
+                self.assertEqual(0, len(self._cached_get()._compiled))
+
+
+class WhenDeletingAndPurgingSecrets(unittest.TestCase):
+
+    def setUp(self):
+        setup_in_memory_db()
+        self.secret_repo = repositories.SecretRepo()
+        self.order_repo = repositories.OrderRepo()
+        self.tenant = repositories.TenantRepo().create_or_get('keystone1234')
+
+        self.secret = create_secret(self.tenant)
+        datum = models.EncryptedDatum()
+        datum.secret_id = self.secret.id
+        datum.cypher_text = 'cypher_text1234'
+        repositories.EncryptedDatumRepo().create_from(datum)
+
+        self.order = new_order(self.tenant)
+        self.order.secret_id = self.secret.id
+        self.order_repo.create_from(self.order)
+
+        self.engine = repositories.get_engine()
+        self.statements = StatementRecorder().statements
+
+    def tearDown(self):
+        teardown_in_memory_db()
+
+    def _count(self, table):
+        return self.engine.execute(
+            'SELECT COUNT(*) FROM {0}'.format(table)).scalar()
+
+    def _purge_all(self):
+        return self.secret_repo.purge_deleted(
+            timeutils.utcnow() + datetime.timedelta(seconds=1), 10)
+
+    def test_should_soft_delete_with_single_update(self):
+        self.secret_repo.delete_entity_by_id(self.secret.id)
+
+        self.assertEqual(3, len(self.statements))
+        self.assertTrue(self.statements[0].startswith('UPDATE secrets'))
+        self.assertTrue(self.statements[2].startswith('UPDATE tenant_usage'))
+        self.assertIsNone(self.secret_repo.get(self.secret.id,
+                                               suppress_exception=True))
+        deleted = self.secret_repo.get(self.secret.id,
+                                       force_show_deleted=True)
+        self.assertTrue(deleted.deleted)
+        self.assertIsNotNone(deleted.deleted_at)
+
+    def test_should_raise_deleting_missing_secret(self):
+        self.secret_repo.delete_entity_by_id(self.secret.id)
+
+        with self.assertRaises(exception.NotFound):
+            self.secret_repo.delete_entity_by_id(self.secret.id)
+
+    def test_should_soft_delete_entity(self):
+        self.order_repo.delete_entity(self.order)
+
+        self.assertEqual(1, self._count('orders'))
+        self.assertIsNone(self.order_repo.get(self.order.id,
+                                              suppress_exception=True))
+
+    def test_should_purge_secret_and_its_rows(self):
+        self.secret_repo.delete_entity_by_id(self.secret.id)
+
+        self.assertEqual(1, self._purge_all())
+
+        self.assertEqual(0, self._count('secrets'))
+        self.assertEqual(0, self._count('encrypted_data'))
+        self.assertEqual(0, self._count('tenant_secret'))
+        self.assertIsNone(self.order_repo.get(self.order.id).secret_id)
+
+    def test_should_keep_live_and_recently_deleted_secrets(self):
+        self.assertEqual(0, self._purge_all())
+
+        self.secret_repo.delete_entity_by_id(self.secret.id)
+        self.assertEqual(0, self.secret_repo.purge_deleted(
+            timeutils.utcnow() - datetime.timedelta(seconds=60), 10))
+        self.assertEqual(1, self._count('secrets'))
+
+    def test_should_purge_in_batches(self):
+        for idx in xrange(3):
+            self.order_repo.delete_entity(self.order_repo.create_from(
+                new_order(self.tenant)))
+        deleted_before = timeutils.utcnow() + datetime.timedelta(seconds=1)
+
+        self.assertEqual(2, self.order_repo.purge_deleted(deleted_before, 2))
+        self.assertEqual(1, self.order_repo.purge_deleted(deleted_before, 2))
+        self.assertEqual(1, self._count('orders'))
+
+    def test_should_not_expire_secret_without_expiration(self):
+        self.assertIsNone(self.secret_repo.get(self.secret.id).expiration)
+
+        self.assertEqual(0, self.secret_repo.delete_expired(
+            timeutils.utcnow(), 10))
+
+    def test_should_delete_expired_secrets(self):
+        expired = create_secret(expires_in=-60)
+        live = create_secret(expires_in=60)
+
+        self.assertEqual(1, self.secret_repo.delete_expired(
+            timeutils.utcnow(), 10))
+
+        self.assertIsNone(self.secret_repo.get(expired.id,
+                                               suppress_exception=True))
+        self.assertIsNotNone(self.secret_repo.get(live.id))
+        self.assertEqual(1, self._purge_all())
+
+    def test_should_delete_expired_in_batches(self):
+        for idx in xrange(3):
+            create_secret(expires_in=-60 - idx)
+
+        self.assertEqual(2, self.secret_repo.delete_expired(
+            timeutils.utcnow(), 2))
+        self.assertEqual(1, self.secret_repo.delete_expired(
+            timeutils.utcnow(), 2))
+        self.assertEqual(0, self.secret_repo.delete_expired(
+            timeutils.utcnow(), 2))
+
+
+class WhenUsingRequestSessions(unittest.TestCase):
+
+    def setUp(self):
+        setup_in_memory_db()
+        self.tenant_repo = repositories.TenantRepo()
+        self.order_repo = repositories.OrderRepo()
+        self.session = repositories.begin_request_session()
+
+    def tearDown(self):
+        repositories.end_request_session(self.session, commit=False)
+        teardown_in_memory_db()
+
+    def _count_tenants(self):
+        return repositories.get_engine().execute(
+            'SELECT COUNT(*) FROM tenants').scalar()
+
+    def test_should_share_session_between_repositories(self):
+        self.assertIs(self.session, self.tenant_repo.get_session())
+        self.assertIs(self.session, self.order_repo.get_session())
+
+    def test_should_commit_once_at_end_of_request(self):
+        tenant = self.tenant_repo.create_or_get('keystone1234')
+        order = models.Order()
+        order.tenant_id = tenant.id
+        self.order_repo.create_from(order)
+        self.assertTrue(self.session.transaction is not None)
+
+        repositories.end_request_session(self.session)
+
+        self.assertEqual(1, self._count_tenants())
+        self.assertIsNone(repositories._get_request_session())
+        self.assertIsNot(self.session, repositories.get_session())
+
+    def test_should_discard_work_when_rolled_back(self):
+        self.tenant_repo.create_or_get('keystone1234')
+
+        repositories.end_request_session(self.session, commit=False)
+
+        self.assertEqual(0, self._count_tenants())
+
+    def test_should_call_commit_hooks_only_once_committed(self):
+        hook = MagicMock()
+        repositories.after_request_commit(hook, 'arg1234')
+        self.assertFalse(hook.called)
+
+        repositories.commit_request_session()
+        hook.assert_called_once_with('arg1234')
+
+        repositories.end_request_session(self.session)
+        self.assertEqual(1, hook.call_count)
+
+    def test_should_drop_commit_hooks_when_rolled_back(self):
+        hook = MagicMock()
+        repositories.after_request_commit(hook)
+
+        repositories.end_request_session(self.session, commit=False)
+
+        self.assertFalse(hook.called)
+
+    def test_should_call_commit_hook_at_once_outside_requests(self):
+        repositories.end_request_session(self.session, commit=False)
+        hook = MagicMock()
+
+        repositories.after_request_commit(hook)
+
+        hook.assert_called_once_with()
+
+
+class WhenReadingFromReplicas(unittest.TestCase):
+
+    def setUp(self):
+        # The "replica" is a second, empty, in-memory database, so reads
+        #   that reach it find nothing.
+        repositories.CONF.set_override('sql_read_connection', ['sqlite://'])
+        setup_in_memory_db()
+        self.repo = repositories.TenantRepo()
+        self.tenant = self.repo.create_or_get('keystone1234')
+        models.register_models(
+            repositories._get_read_makers()[0]().bind)
+
+    def tearDown(self):
+        teardown_in_memory_db()
+
+    def _find_in_request(self, client_id=None):
+        session = repositories.begin_request_session(client_id=client_id)
+        try:
+            return self.repo.find_by_keystone_id('keystone1234',
+                                                 suppress_exception=True)
+        finally:
+            repositories.end_request_session(session)
+
+    def test_should_read_from_replica_within_request(self):
+        self.assertIsNone(self._find_in_request())
+
+    def test_should_read_from_primary_outside_request(self):
+        self.assertEqual(self.tenant.id, self.repo.find_by_keystone_id(
+            'keystone1234').id)
+
+    def test_should_read_from_primary_after_request_writes(self):
+        session = repositories.begin_request_session()
+        try:
+            self.repo.create_or_get('keystone5678')
+            self.assertIsNotNone(self.repo.find_by_keystone_id(
+                'keystone1234', suppress_exception=True))
+        finally:
+            repositories.end_request_session(session)
+
+    def test_should_read_own_writes_from_primary_in_later_requests(self):
+        session = repositories.begin_request_session(client_id='tenant1')
+        self.repo.create_or_get('keystone5678')
+        repositories.end_request_session(session)
+
+        self.assertIsNotNone(self._find_in_request(client_id='tenant1'))
+        self.assertIsNone(self._find_in_request(client_id='tenant2'))
+
+    def test_should_save_entity_read_from_replica(self):
+        tenant = self.repo.get(self.tenant.id)
+        session = repositories.begin_request_session()
+        try:
+            replica_tenant = repositories.get_read_session().merge(tenant)
+            replica_tenant.status = models.States.PENDING
+            self.repo.save(replica_tenant)
+        finally:
+            repositories.end_request_session(session)
+
+        self.assertEqual(models.States.PENDING,
+                         self.repo.get(self.tenant.id).status)
+
+
+class WhenShardingTenants(unittest.TestCase):
+
+    def setUp(self):
+        # The "other" shard is a second in-memory database.
+        repositories.CONF.set_override('sql_shard_connection',
+                                       ['other=sqlite://'])
+        setup_in_memory_db()
+        self.shard_map = repositories.get_shard_map()
+        self.default, self.other = self.shard_map.shards
+        self.on_default = self._keystone_id_on(self.default)
+        self.on_other = self._keystone_id_on(self.other)
+        self.repo = repositories.TenantRepo()
+
+    def tearDown(self):
+        teardown_in_memory_db()
+
+    def _keystone_id_on(self, shard):
+        for idx in itertools.count():
+            keystone_id = 'keystone{0}'.format(idx)
+            if self.shard_map.hashed_shard(keystone_id) is shard:
+                return keystone_id
+
+    def _count(self, shard, table_name):
+        return shard.get_engine().execute(
+            'SELECT COUNT(*) FROM {0}'.format(table_name)).scalar()
+
+    def _create_tenant_with_secret(self, keystone_id):
+        with repositories.tenant_scope(keystone_id):
+            tenant = self.repo.create_or_get(keystone_id)
+            secret = repositories.SecretRepo().create_from(models.Secret(
+                {'name': 'name1234', 'mime_type': 'text/plain'}))
+            tenant_secret = models.TenantSecret()
+            tenant_secret.tenant_id = tenant.id
+            tenant_secret.secret_id = secret.id
+            repositories.TenantSecretRepo().create_from(tenant_secret)
+            datum = models.EncryptedDatum()
+            datum.secret_id = secret.id
+            datum.cypher_text = 'cypher_text1234'
+            repositories.EncryptedDatumRepo().create_from(datum)
+
+    def test_should_spread_tenants_consistently(self):
+        names = ['a', 'b', 'c']
+        two = repositories.ShardMap(
+            [repositories.Shard(name, 'sqlite://') for name in names[:2]], 0)
+        three = repositories.ShardMap(
+            [repositories.Shard(name, 'sqlite://') for name in names], 0)
+        keystone_ids = ['keystone{0}'.format(idx) for idx in xrange(1000)]
+
+        before = [two.hashed_shard(key).name for key in keystone_ids]
+        after = [three.hashed_shard(key).name for key in keystone_ids]
+
+        self.assertTrue(before.count('a') > 300)
+        self.assertTrue(before.count('b') > 300)
+        moved = [name for old, name in zip(before, after) if old != name]
+        self.assertEqual(set(['c']), set(moved))
+        self.assertTrue(len(moved) < 500)
+
+    def test_should_route_request_to_tenant_shard(self):
+        session = repositories.begin_request_session(client_id=self.on_other)
+        self.repo.create_or_get(self.on_other)
+        repositories.end_request_session(session)
+
+        self.assertEqual(1, self._count(self.other, 'tenants'))
+        self.assertEqual(0, self._count(self.default, 'tenants'))
+
+    def test_should_route_worker_to_tenant_shard(self):
+        with repositories.tenant_scope(self.on_other):
+            self.repo.create_or_get(self.on_other)
+        self.repo.create_or_get(self.on_default)
+
+        self.assertEqual(1, self._count(self.other, 'tenants'))
+        self.assertEqual(1, self._count(self.default, 'tenants'))
+
+    def test_should_move_tenant_between_shards(self):
+        self._create_tenant_with_secret(self.on_default)
+
+        counts = repositories.move_tenant(self.on_default, 'other', settle=0)
+
+        self.assertEqual(1, counts['tenants'])
+        self.assertEqual(1, counts['encrypted_data'])
+        for table_name in ('tenants', 'tenant_usage', 'secrets',
+                           'tenant_secret', 'encrypted_data'):
+            self.assertEqual(1, self._count(self.other, table_name))
+            self.assertEqual(0, self._count(self.default, table_name))
+        self.assertIs(self.other,
+                      self.shard_map.lookup(self.on_default).shard)
+        with repositories.tenant_scope(self.on_default):
+            self.assertIsNotNone(self.repo.find_by_keystone_id(
+                self.on_default))
+
+    def test_should_drop_placement_when_moved_back(self):
+        self._create_tenant_with_secret(self.on_default)
+
+        repositories.move_tenant(self.on_default, 'other', settle=0)
+        repositories.move_tenant(self.on_default, 'default', settle=0)
+
+        self.assertEqual(0, self._count(self.default, 'tenant_shards'))
+        self.assertEqual(1, self._count(self.default, 'tenants'))
+        self.assertEqual(0, self._count(self.other, 'tenants'))
+
+    def test_should_only_read_while_moving(self):
+        self.repo.create_or_get(self.on_default)
+        repositories._place_tenant(self.on_default, self.default,
+                                   moving=True)
+
+        session = repositories.begin_request_session(
+            client_id=self.on_default)
+        try:
+            self.assertIsNotNone(self.repo.find_by_keystone_id(
+                self.on_default))
+            with self.assertRaises(exception.ServiceUnavailable):
+                self.repo.create_or_get(self.on_other)
+        finally:
+            repositories.end_request_session(session, commit=False)
+
+    def test_should_pin_tenants_stored_off_their_hashed_shard(self):
+        with repositories.shard_scope(self.default):
+            self.repo.create_or_get(self.on_other)
+            self.repo.create_or_get(self.on_default)
+
+        self.assertEqual(1, repositories.pin_tenants())
+        self.assertIs(self.default,
+                      self.shard_map.lookup(self.on_other).shard)
+        self.assertEqual(0, repositories.pin_tenants())
+
+    def test_should_reject_unknown_shard(self):
+        with self.assertRaises(exception.UnknownShard):
+            repositories.move_tenant(self.on_default, 'unknown', settle=0)
+
+
+class WhenFindingIdempotencyKeys(unittest.TestCase):
+
+    def setUp(self):
+        setup_in_memory_db()
+        self.repo = repositories.IdempotencyKeyRepo()
+
+    def tearDown(self):
+        teardown_in_memory_db()
+
+    def _create_key(self, key, expires_in):
+        entry = models.IdempotencyKey()
+        entry.keystone_id = 'keystone1234'
+        entry.resource = 'secrets'
+        entry.key = key
+        entry.response_body = '{}'
+        entry.expires_at = timeutils.utcnow() + datetime.timedelta(
+            seconds=expires_in)
+        self.repo.create_from(entry)
+
+    def test_should_find_unexpired_key(self):
+        self._create_key('key1234', 60)
+
+        entry = self.repo.find_by_key('keystone1234', 'secrets', 'key1234')
+
+        self.assertEqual('{}', entry.response_body)
+        self.assertIsNone(self.repo.find_by_key('keystone1234', 'orders',
+                                                'key1234'))
+
+    def test_should_not_find_expired_key(self):
+        self._create_key('key1234', -60)
+
+        self.assertIsNone(self.repo.find_by_key('keystone1234', 'secrets',
+                                                'key1234'))
+
+    def test_should_reject_duplicate_key(self):
+        self._create_key('key1234', 60)
+
+        with self.assertRaises(exception.Duplicate):
+            self._create_key('key1234', 60)
+
+    def _reserve(self, key='key1234', expires_in=60):
+        return self.repo.reserve('keystone1234', 'secrets', key,
+                                 timeutils.utcnow() + datetime.timedelta(
+                                     seconds=expires_in))
+
+    def test_should_reserve_key_once(self):
+        self.assertTrue(self._reserve())
+        self.assertFalse(self._reserve())
+
+        entry = self.repo.find_by_key('keystone1234', 'secrets', 'key1234')
+        self.assertEqual(models.States.PENDING, entry.status)
+
+    def test_should_keep_reservation_when_request_rolls_back(self):
+        session = repositories.begin_request_session('keystone1234')
+        self.assertTrue(self._reserve())
+        repositories.end_request_session(session, commit=False)
+
+        self.assertFalse(self._reserve())
+
+    def test_should_record_response_with_request(self):
+        self._reserve()
+        session = repositories.begin_request_session('keystone1234')
+        self.repo.complete('keystone1234', 'secrets', 'key1234',
+                           '/location', '{}', timeutils.utcnow() +
+                           datetime.timedelta(seconds=60))
+        repositories.end_request_session(session)
+
+        entry = self.repo.find_by_key('keystone1234', 'secrets', 'key1234')
+        self.assertEqual(models.States.ACTIVE, entry.status)
+        self.assertEqual('/location', entry.location)
+        self.assertFalse(self._reserve())
+
+    def test_should_release_pending_key_only(self):
+        self._reserve()
+        self.repo.release('keystone1234', 'secrets', 'key1234')
+        self.assertTrue(self._reserve())
+
+        self.repo.complete('keystone1234', 'secrets', 'key1234',
+                           '/location', '{}', timeutils.utcnow() +
+                           datetime.timedelta(seconds=60))
+        self.repo.release('keystone1234', 'secrets', 'key1234')
+        self.assertFalse(self._reserve())
+
+    def test_should_reuse_expired_key(self):
+        self._create_key('key1234', -60)
+
+        self.assertTrue(self._reserve())
+
+    def test_should_purge_expired_keys(self):
+        self._create_key('expired', -60)
+        self._create_key('live', 60)
+
+        self.assertEqual(1, self.repo.purge_deleted(timeutils.utcnow(), 10))
+
+        self.assertEqual(1, repositories.get_engine().execute(
+            'SELECT COUNT(*) FROM idempotency_keys').scalar())
+
+
+class WhenCountingTenantUsage(unittest.TestCase):
+
+    def setUp(self):
+        setup_in_memory_db()
+        self.secret_repo = repositories.SecretRepo()
+        self.tenant_secret_repo = repositories.TenantSecretRepo()
+        self.order_repo = repositories.OrderRepo()
+        self.usage_repo = repositories.TenantUsageRepo()
+        self.tenant = repositories.TenantRepo().create_or_get('keystone1234')
+
+    def tearDown(self):
+        teardown_in_memory_db()
+
+    def _usage(self, keystone_id='keystone1234'):
+        usage = self.usage_repo.find_by_keystone_id(keystone_id)
+        return (usage.secrets, usage.orders) if usage else None
+
+    def _new_secret(self, expires_in=None):
+        return create_secret(self.tenant, expires_in)
+
+    def _new_order(self):
+        return self.order_repo.create_from(new_order(self.tenant))
+
+    def test_should_have_no_usage_for_new_tenant(self):
+        self.assertIsNone(self._usage())
+
+    def test_should_count_created_secrets_and_orders(self):
+        self._new_secret()
+        self._new_order()
+        secrets = [models.Secret({'name': 'name1234',
+                                  'mime_type': 'text/plain'})
+                   for idx in xrange(2)]
+        self.secret_repo.create_batch(secrets)
+        self.tenant_secret_repo.create_batch(
+            [new_tenant_secret(self.tenant, secret) for secret in secrets])
+
+        self.assertEqual((3, 1), self._usage())
+
+    def test_should_not_count_rolled_back_creates(self):
+        self._new_order()
+        session = repositories.get_session()
+
+        with self.assertRaises(ValueError):
+            with session.begin():
+                self.order_repo.create_from(new_order(self.tenant),
+                                            session=session)
+                raise ValueError()
+
+        self.assertEqual((0, 1), self._usage())
+
+    def test_should_discount_deleted_secrets_and_orders(self):
+        secret = self._new_secret()
+        self._new_secret()
+        order = self._new_order()
+
+        self.secret_repo.delete_entity_by_id(secret.id)
+        self.order_repo.delete_entity(order)
+        self.order_repo.delete_entity(order)
+
+        self.assertEqual((1, 0), self._usage())
+
+    def test_should_discount_expired_secrets(self):
+        self._new_secret(-60)
+        self._new_secret(60)
+
+        self.secret_repo.delete_expired(timeutils.utcnow(), 10)
+
+        self.assertEqual((1, 0), self._usage())
+
+    def test_should_reconcile_drifted_usage(self):
+        self._new_secret()
+        self._new_order()
+        other = repositories.TenantRepo().create_or_get('keystone5678')
+        engine = repositories.get_engine()
+        engine.execute('UPDATE tenant_usage SET secrets = 5')
+
+        last_id, checked, corrected = self.usage_repo.reconcile(1)
+        last_id, more, more_corrected = self.usage_repo.reconcile(
+            1, after=last_id)
+        self.assertEqual(0, self.usage_repo.reconcile(1, after=last_id)[1])
+
+        self.assertEqual(2, checked + more)
+        self.assertEqual(1, corrected + more_corrected)
+        self.assertEqual((1, 1), self._usage())
+        self.assertEqual((0, 0), self._usage(other.keystone_id))
+
+    def test_should_lock_usage_rows_before_recounting(self):
+        self._new_secret()
+        with_lockmode = sqlalchemy.orm.Query.with_lockmode
+        locked = []
+
+        def _with_lockmode(query, mode):
+            locked.append(with_lockmode(query, mode))
+            return locked[-1]
+
+        recorder = StatementRecorder()
+        with patch.object(sqlalchemy.orm.Query, 'with_lockmode',
+                          autospec=True, side_effect=_with_lockmode):
+            self.usage_repo.reconcile(10)
+
+        tenants, usage = [str(query.statement.compile(
+            dialect=mysql.dialect())) for query in locked]
+        self.assertIn('FROM tenants', tenants)
+        self.assertTrue(tenants.endswith('LOCK IN SHARE MODE'))
+        self.assertIn('FROM tenant_usage', usage)
+        self.assertTrue(usage.endswith('FOR UPDATE'))
+
+        selects = [statement for statement in recorder.statements
+                   if statement.startswith('SELECT')]
+        self.assertIn('FROM tenants', selects[0])
+        self.assertIn('FROM tenant_usage', selects[1])
+        self.assertEqual(4, len(selects))
+
+
+class WhenPoolingConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = repositories.InstrumentedQueuePool(
+            lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=1,
+            timeout=1)
+
+    def tearDown(self):
+        repositories._ENGINE = None
+
+    def test_should_count_checkouts(self):
+        first = self.pool.connect()
+        second = self.pool.connect()
+        second.close()
+
+        self.assertEqual(2, self.pool.checkouts)
+        self.assertEqual(1, self.pool.checkedout())
+        self.assertTrue(self.pool.max_wait_time >= 0.0)
+        first.close()
+
+    def test_should_report_pool_stats(self):
+        repositories._ENGINE = sqlalchemy.create_engine(
+            'sqlite://', pool=self.pool)
+        conn = repositories._ENGINE.connect()
+
+        stats = repositories.get_pool_stats()
+
+        self.assertEqual('InstrumentedQueuePool', stats['pool'])
+        self.assertEqual(1, stats['checked_out'])
+        self.assertEqual(1, stats['checkouts'])
+        conn.close()
+
+    def test_should_only_use_queue_pool_for_server_databases(self):
+        url = sqlalchemy.engine.url.make_url('mysql://user@localhost/db')
+        self.assertEqual(repositories.InstrumentedQueuePool,
+                         repositories._get_pool_args(url)['poolclass'])
+
+        url = sqlalchemy.engine.url.make_url('sqlite://')
+        self.assertEqual({}, repositories._get_pool_args(url))
+
+    def test_should_report_stale_connection_as_disconnect(self):
+        dbapi_conn = MagicMock()
+        dbapi_conn.cursor.return_value.execute.side_effect = \
+            sqlite3.OperationalError('server has gone away')
+
+        with self.assertRaises(sqlalchemy.exc.DisconnectionError):
+            repositories.ping_listener(dbapi_conn, None, None)
+
+
+class WhenInitializingConcurrently(unittest.TestCase):
+
+    def setUp(self):
+        repositories.CONF.set_override('sql_connection', 'sqlite://')
+        repositories._ENGINE = None
+        repositories._MAKER = None
+        self.engines = []
+
+        create_engine = sqlalchemy.create_engine
+
+        def slow_create_engine(*args, **kwargs):
+            # Widen the window in which racing threads could each
+            #   decide that no engine exists yet.
+            time.sleep(0.05)
+            engine = create_engine(*args, **kwargs)
+            self.engines.append(engine)
+            return engine
+
+        self.patcher = patch('sqlalchemy.create_engine',
+                             side_effect=slow_create_engine)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        teardown_in_memory_db()
+
+    def test_should_create_one_engine_and_pool(self):
+        start = threading.Event()
+        seen = []
+        errors = []
+
+        def worker():
+            start.wait()
+            try:
+                repositories.TenantRepo()
+                seen.append((repositories.get_engine(),
+                             repositories.get_maker()))
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=worker) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
+        self.assertEqual(1, len(self.engines))
+        self.assertEqual(20, len(seen))
+        self.assertEqual(set([(self.engines[0], repositories._MAKER)]),
+                         set(seen))
+        self.assertEqual(1, len(set(engine.pool for engine, _ in seen)))
+
+    def test_should_not_reinitialize_on_repo_construction(self):
+        repositories.configure_db()
+        engine = repositories._ENGINE
+
+        with patch.object(repositories, 'setup_db_env') as setup_db_env:
+            repositories.SecretRepo()
+            repositories.OrderRepo()
+
+        self.assertFalse(setup_db_env.called)
+        self.assertIs(engine, repositories._ENGINE)
+        self.assertEqual(1, len(self.engines))
+
+
+def _connection_error():
+    return sqlalchemy.exc.OperationalError(
+        'SELECT 1', {}, Exception('(2003) Cannot connect'))
+
+
+class WhenRetryingDatabaseConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (repositories._MAX_RETRIES, repositories._RETRY_INTERVAL,
+                      repositories._MAX_RETRY_INTERVAL)
+        repositories._MAX_RETRIES = 3
+        repositories._RETRY_INTERVAL = 1
+        repositories._MAX_RETRY_INTERVAL = 10
+
+        self.connect = MagicMock()
+        self.connect.func_name = 'connect'
+
+        sleep_patcher = patch('barbican.model.repositories.time.sleep')
+        self.sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def tearDown(self):
+        (repositories._MAX_RETRIES, repositories._RETRY_INTERVAL,
+         repositories._MAX_RETRY_INTERVAL) = self.saved
+
+    def _wait_until_closed(self, breaker):
+        for idx in xrange(500):
+            if not breaker.is_open:
+                return
+            time.sleep(0.01)
+        self.fail('Circuit breaker did not close')
+
+    @patch('barbican.model.repositories.random.uniform',
+           side_effect=lambda low, high: high)
+    def test_should_back_off_exponentially_up_to_cap(self, mock_uniform):
+        self.assertEqual([1, 2, 4, 8, 10, 10],
+                         [repositories._backoff(attempt)
+                          for attempt in xrange(6)])
+
+    def test_should_retry_connection_errors(self):
+        self.connect.side_effect = [_connection_error(), 'connection']
+
+        connect = repositories.wrap_db_error(self.connect)
+
+        self.assertEqual('connection', connect())
+        self.assertEqual(1, self.sleep.call_count)
+
+    def test_should_give_up_after_max_retries(self):
+        self.connect.side_effect = _connection_error()
+
+        connect = repositories.wrap_db_error(self.connect)
+
+        with self.assertRaises(sqlalchemy.exc.OperationalError):
+            connect()
+        self.assertEqual(4, self.connect.call_count)
+
+    def test_should_not_retry_other_errors(self):
+        self.connect.side_effect = sqlalchemy.exc.OperationalError(
+            'SELECT 1', {}, Exception('no such table'))
+
+        connect = repositories.wrap_db_error(self.connect)
+
+        with self.assertRaises(sqlalchemy.exc.OperationalError):
+            connect()
+        self.assertEqual(1, self.connect.call_count)
+
+    def test_should_fail_fast_once_breaker_opens(self):
+        recovered = threading.Event()
+        breaker = repositories.CircuitBreaker(2, recovered.wait)
+        self.connect.side_effect = _connection_error()
+        connect = repositories.wrap_db_error(self.connect, breaker)
+
+        with self.assertRaises(exception.ServiceUnavailable):
+            connect()
+        self.assertEqual(2, self.connect.call_count)
+        self.assertTrue(breaker.is_open)
+
+        with self.assertRaises(exception.ServiceUnavailable):
+            connect()
+        self.assertEqual(2, self.connect.call_count)
+
+        recovered.set()
+        self._wait_until_closed(breaker)
+
+    def test_should_close_breaker_once_probe_succeeds(self):
+        tripped = threading.Event()
+        outcomes = [_connection_error(), None]
+
+        def probe():
+            tripped.wait()
+            outcome = outcomes.pop(0)
+            if outcome:
+                raise outcome
+
+        probe = MagicMock(side_effect=probe)
+        breaker = repositories.CircuitBreaker(1, probe)
+        self.connect.side_effect = [_connection_error(), 'connection']
+        connect = repositories.wrap_db_error(self.connect, breaker)
+
+        with self.assertRaises(exception.ServiceUnavailable):
+            connect()
+
+        tripped.set()
+        self._wait_until_closed(breaker)
+        self.assertEqual(2, probe.call_count)
+        self.assertEqual('connection', connect())
+
+    def test_should_reset_failures_after_success(self):
+        breaker = repositories.CircuitBreaker(2, MagicMock())
+        self.connect.side_effect = [_connection_error(), 'connection',
+                                    _connection_error(), 'connection']
+        connect = repositories.wrap_db_error(self.connect, breaker)
+
+        connect()
+        connect()
+
+        self.assertFalse(breaker.is_open)
+        self.assertEqual(0, breaker.failures)
+
+    def test_should_guard_engine_connections(self):
+        setup_in_memory_db()
+        self.addCleanup(teardown_in_memory_db)
+
+        self.assertEqual('closed',
+                         repositories.get_pool_stats()['circuit_breaker'])
+        self.assertIn('contextual_connect',
+                      repositories.get_engine().__dict__)
+
+    def test_should_fail_fast_on_unreachable_secondary_engine(self):
+        engine = repositories._create_secondary_engine('sqlite://')
+        # The breaker's prober connects through raw_connection().
+        with patch.object(engine.pool, 'connect',
+                          side_effect=_connection_error()) as pool_connect:
+            with patch.object(engine, 'raw_connection',
+                              side_effect=_connection_error()):
+                with self.assertRaises(exception.ServiceUnavailable):
+                    engine.contextual_connect()
+                with self.assertRaises(exception.ServiceUnavailable):
+                    engine.contextual_connect()
+        self.assertEqual(3, pool_connect.call_count)
+
+        # The breaker's prober finds the database up again.
+        for idx in xrange(500):
+            try:
+                engine.contextual_connect().close()
+                return
+            except exception.ServiceUnavailable:
+                threading.Event().wait(0.01)
+        self.fail('Circuit breaker did not close')
+
+
+class WhenCompilingInsertIgnoringDuplicates(unittest.TestCase):
+
+    def setUp(self):
+        self.insert = repositories.InsertIgnoringDuplicates(
+            models.Tenant.__table__, values={'id': 'id1',
+                                             'keystone_id': 'keystone1234'})
+
+    def _compile(self, dialect):
+        return str(self.insert.compile(dialect=dialect))
+
+    def test_should_ignore_on_sqlite(self):
+        self.assertTrue(self._compile(sqlite.dialect()).startswith(
+            'INSERT OR IGNORE INTO tenants'))
+
+    def test_should_ignore_on_mysql(self):
+        self.assertTrue(self._compile(mysql.dialect()).endswith(
+            'ON DUPLICATE KEY UPDATE id = id'))
+
+    def test_should_ignore_on_postgresql(self):
+        self.assertTrue(self._compile(postgresql.dialect()).endswith(
+            'ON CONFLICT DO NOTHING'))
+
+
+if __name__ == '__main__':
+    unittest.main()
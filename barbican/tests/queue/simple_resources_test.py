@@ -0,0 +1,193 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import MagicMock, patch
+import threading
+import time
+import unittest
+
+from barbican.queue.simple import resources
+
+
+class WhenUsingWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.target = MagicMock()
+        self.release = threading.Event()
+
+    def test_should_run_submitted_tasks(self):
+        pool = resources.WorkerPool(2, 10, self.target)
+
+        self.assertTrue(pool.submit('order1'))
+        self.assertTrue(pool.submit('order2'))
+        pool.shutdown()
+
+        self.assertEqual(2, self.target.call_count)
+        self.target.assert_any_call('order1')
+        self.target.assert_any_call('order2')
+
+    def test_should_refuse_tasks_when_queue_full(self):
+        started = threading.Event()
+
+        def _block(order_id):
+            started.set()
+            self.release.wait()
+        self.target.side_effect = _block
+        pool = resources.WorkerPool(1, 1, self.target)
+        pool.submit('busy')
+        started.wait()
+
+        self.assertTrue(pool.submit('queued'))
+        self.assertFalse(pool.submit('refused'))
+
+        self.release.set()
+        pool.shutdown()
+        self.assertEqual(2, self.target.call_count)
+
+    def test_should_keep_working_after_task_fails(self):
+        self.target.side_effect = [ValueError(), None]
+        pool = resources.WorkerPool(1, 10, self.target)
+
+        pool.submit('bad')
+        pool.submit('good')
+        pool.shutdown()
+
+        self.assertEqual(2, self.target.call_count)
+
+
+class WhenProcessingOrdersWithSimpleQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.order_id = 'order1234'
+        self.keystone_id = 'keystone1234'
+        self.pool = MagicMock()
+        resources._POOL = self.pool
+
+    def tearDown(self):
+        resources._POOL = None
+
+    @patch('barbican.queue.simple.resources.BeginOrder')
+    def test_should_hand_order_to_pool(self, mock_begin_order):
+        self.pool.submit.return_value = True
+
+        resources.process_order(self.order_id, self.keystone_id)
+
+        self.pool.submit.assert_called_once_with(self.order_id,
+                                                 self.keystone_id)
+        self.assertFalse(mock_begin_order.called)
+
+    @patch('barbican.queue.simple.resources.BeginOrder')
+    def test_should_process_in_request_when_pool_full(self,
+                                                      mock_begin_order):
+        self.pool.submit.return_value = False
+
+        resources.process_order(self.order_id, self.keystone_id)
+
+        mock_begin_order.return_value.process.assert_called_once_with(
+            self.order_id, self.keystone_id)
+
+    def test_should_drain_pool_on_shutdown(self):
+        resources.shutdown()
+
+        self.pool.shutdown.assert_called_once_with(None)
+        self.assertEqual(None, resources._POOL)
+
+
+class WhenRunningPeriodicTasks(unittest.TestCase):
+
+    def setUp(self):
+        self.called = threading.Event()
+        self.target = MagicMock(side_effect=lambda: self.called.set())
+
+    def tearDown(self):
+        resources.stop_periodic_tasks()
+        resources.CONF.clear_override('interval', group='purge')
+        resources.CONF.clear_override('interval', group='sweep')
+        resources.CONF.clear_override('interval', group='tenant_usage')
+
+    def test_should_call_target_until_stopped(self):
+        task = resources.PeriodicTask(0.01, self.target, 'test')
+
+        self.assertTrue(self.called.wait(5))
+        task.stop()
+        calls = self.target.call_count
+        time.sleep(0.05)
+        self.assertEqual(calls, self.target.call_count)
+
+    def test_should_keep_running_after_target_fails(self):
+        results = [ValueError()]
+
+        def _fail_once():
+            if results:
+                raise results.pop()
+            self.called.set()
+        self.target.side_effect = _fail_once
+        task = resources.PeriodicTask(0.01, self.target, 'test')
+
+        self.assertTrue(self.called.wait(5))
+        task.stop()
+
+    @patch('barbican.queue.simple.resources.PurgeDeleted')
+    def test_should_start_purging_once(self, mock_purge):
+        resources.CONF.set_override('interval', 3600, group='purge')
+
+        resources.start_periodic_tasks()
+        purger = resources._PURGER
+        resources.start_periodic_tasks()
+
+        self.assertIsNotNone(purger)
+        self.assertIs(purger, resources._PURGER)
+
+    def test_should_not_purge_when_disabled(self):
+        resources.CONF.set_override('interval', 0, group='purge')
+
+        resources.start_periodic_tasks()
+
+        self.assertIsNone(resources._PURGER)
+
+    @patch('barbican.queue.simple.resources.SweepExpired')
+    def test_should_start_sweeping_once(self, mock_sweep):
+        resources.CONF.set_override('interval', 600, group='sweep')
+
+        resources.start_periodic_tasks()
+        sweeper = resources._SWEEPER
+        resources.start_periodic_tasks()
+
+        self.assertIsNotNone(sweeper)
+        self.assertIs(sweeper, resources._SWEEPER)
+
+    def test_should_not_sweep_when_disabled(self):
+        resources.CONF.set_override('interval', 0, group='sweep')
+
+        resources.start_periodic_tasks()
+
+        self.assertIsNone(resources._SWEEPER)
+
+    @patch('barbican.queue.simple.resources.ReconcileUsage')
+    def test_should_start_reconciling_once(self, mock_reconcile):
+        resources.CONF.set_override('interval', 86400, group='tenant_usage')
+
+        resources.start_periodic_tasks()
+        reconciler = resources._RECONCILER
+        resources.start_periodic_tasks()
+
+        self.assertIsNotNone(reconciler)
+        self.assertIs(reconciler, resources._RECONCILER)
+        resources.stop_periodic_tasks()
+        self.assertIsNone(resources._RECONCILER)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,18 +13,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from mock import MagicMock
+from mock import MagicMock, patch
 import json
+from oslo.config import cfg
 import unittest
 
 from datetime import datetime
 from barbican.crypto.extension_manager import CryptoExtensionManager
-from barbican.tasks.resources import BeginOrder
+from barbican.tasks.resources import (BeginOrder, PurgeDeleted,
+                                      ReconcileUsage, SweepExpired,
+                                      usage_opt_group, usage_opts)
 from barbican.model.models import (Tenant, Secret, TenantSecret,
                                    EncryptedDatum, Order, States)
+from barbican.model import repositories
 from barbican.model.repositories import OrderRepo
 from barbican.common import config
 from barbican.common import exception
+from barbican.common.resources import get_tenant_cache
 from barbican.openstack.common import timeutils
 
 
@@ -38,6 +43,8 @@ def suite():
 class WhenBeginningOrder(unittest.TestCase):
 
     def setUp(self):
+        get_tenant_cache().clear()
+
         self.requestor = 'requestor1234'
         self.order = Order()
         self.order.id = "id1"
@@ -114,6 +121,189 @@ class WhenBeginningOrder(unittest.TestCase):
         assert datum.cypher_text is not None
         assert datum.kek_metadata is not None
 
+    @patch('barbican.model.repositories.tenant_scope')
+    def test_should_process_order_in_tenant_shard(self, mock_tenant_scope):
+        self.resource.process(self.order.id, self.keystone_id)
+
+        mock_tenant_scope.assert_called_once_with(self.keystone_id)
+        self.assertTrue(mock_tenant_scope.return_value.__enter__.called)
+
+
+class WhenPurgingDeletedEntities(unittest.TestCase):
+
+    def setUp(self):
+        self.secret_repo = MagicMock()
+        self.tenant_secret_repo = MagicMock()
+        self.datum_repo = MagicMock()
+        self.order_repo = MagicMock()
+        self.idempotency_repo = MagicMock()
+        for repo in (self.secret_repo, self.tenant_secret_repo,
+                     self.datum_repo, self.order_repo,
+                     self.idempotency_repo):
+            repo.purge_deleted.return_value = 0
+
+        config.CONF.set_override('batch_size', 10, group='purge')
+        config.CONF.set_override('max_batches', 4, group='purge')
+
+        self.task = PurgeDeleted(self.secret_repo, self.tenant_secret_repo,
+                                 self.datum_repo, self.order_repo,
+                                 self.idempotency_repo)
+
+    def tearDown(self):
+        config.CONF.clear_override('batch_size', group='purge')
+        config.CONF.clear_override('max_batches', group='purge')
+
+    @patch('barbican.tasks.resources.sleep')
+    def test_should_purge_each_table_in_batches(self, mock_sleep):
+        config.CONF.set_override('max_batches', 10, group='purge')
+        self.secret_repo.purge_deleted.side_effect = [10, 3]
+        self.order_repo.purge_deleted.return_value = 2
+        self.idempotency_repo.purge_deleted.return_value = 1
+
+        counts = self.task.process()
+
+        self.assertEqual({'encrypted_data': 0, 'tenant_secret': 0,
+                          'secrets': 13, 'orders': 2,
+                          'idempotency_keys': 1}, counts)
+        self.assertEqual(2, self.secret_repo.purge_deleted.call_count)
+        args, kwargs = self.secret_repo.purge_deleted.call_args
+        self.assertTrue(args[0] < timeutils.utcnow())
+        self.assertEqual(10, args[1])
+        self.assertEqual(5, mock_sleep.call_count)
+
+    @patch('barbican.tasks.resources.sleep')
+    def test_should_stop_after_max_batches(self, mock_sleep):
+        self.datum_repo.purge_deleted.return_value = 10
+
+        counts = self.task.process()
+
+        self.assertEqual(40, counts['encrypted_data'])
+        self.assertEqual(4, self.datum_repo.purge_deleted.call_count)
+        self.assertEqual(1, self.secret_repo.purge_deleted.call_count)
+        self.assertEqual(7, mock_sleep.call_count)
+
+    @patch('barbican.tasks.resources.sleep')
+    def test_should_purge_every_table_with_a_backlog(self, mock_sleep):
+        for repo in (self.secret_repo, self.tenant_secret_repo,
+                     self.datum_repo, self.order_repo,
+                     self.idempotency_repo):
+            repo.purge_deleted.return_value = 10
+
+        counts = self.task.process()
+
+        self.assertEqual({'encrypted_data': 40, 'tenant_secret': 40,
+                          'secrets': 40, 'orders': 40,
+                          'idempotency_keys': 40}, counts)
+
+    @patch('barbican.tasks.resources.sleep')
+    @patch('barbican.model.repositories.get_shard_map')
+    def test_should_purge_each_shard(self, mock_get_shard_map, mock_sleep):
+        mock_get_shard_map.return_value.shards = [
+            repositories.Shard('default'),
+            repositories.Shard('other', 'sqlite://')]
+        self.order_repo.purge_deleted.return_value = 2
+
+        counts = self.task.process()
+
+        self.assertEqual(4, counts['orders'])
+        self.assertEqual(2, self.order_repo.purge_deleted.call_count)
+
+
+class WhenSweepingExpiredSecrets(unittest.TestCase):
+
+    def setUp(self):
+        self.secret_repo = MagicMock()
+        self.secret_repo.delete_expired.return_value = 0
+
+        config.CONF.set_override('batch_size', 10, group='sweep')
+        config.CONF.set_override('max_rate', 20.0, group='sweep')
+        config.CONF.set_override('max_batches', 4, group='sweep')
+
+        self.task = SweepExpired(self.secret_repo)
+
+    def tearDown(self):
+        config.CONF.clear_override('batch_size', group='sweep')
+        config.CONF.clear_override('max_rate', group='sweep')
+        config.CONF.clear_override('max_batches', group='sweep')
+
+    @patch('barbican.tasks.resources.sleep')
+    def test_should_delete_in_rate_limited_batches(self, mock_sleep):
+        self.secret_repo.delete_expired.side_effect = [10, 10, 3]
+
+        counts = self.task.process()
+
+        self.assertEqual({'secrets': 23, 'batches': 3}, counts)
+        args, kwargs = self.secret_repo.delete_expired.call_args
+        self.assertTrue(args[0] <= timeutils.utcnow())
+        self.assertEqual(10, args[1])
+        self.assertEqual([((0.5,), {}), ((0.5,), {})],
+                         mock_sleep.call_args_list)
+
+    @patch('barbican.tasks.resources.sleep')
+    def test_should_stop_after_max_batches(self, mock_sleep):
+        self.secret_repo.delete_expired.return_value = 10
+
+        counts = self.task.process()
+
+        self.assertEqual({'secrets': 40, 'batches': 4}, counts)
+
+    @patch('barbican.tasks.resources.sleep')
+    def test_should_not_pause_without_rate_limit(self, mock_sleep):
+        config.CONF.set_override('max_rate', 0, group='sweep')
+        self.secret_repo.delete_expired.side_effect = [10, 0]
+
+        self.task.process()
+
+        self.assertFalse(mock_sleep.called)
+
+
+class WhenReconcilingTenantUsage(unittest.TestCase):
+
+    def setUp(self):
+        self.usage_repo = MagicMock()
+        config.CONF.set_override('batch_size', 2, group='tenant_usage')
+
+        self.task = ReconcileUsage(self.usage_repo)
+
+    def tearDown(self):
+        config.CONF.clear_override('batch_size', group='tenant_usage')
+
+    @patch('barbican.tasks.resources.sleep')
+    def test_should_reconcile_tenants_in_batches(self, mock_sleep):
+        self.usage_repo.reconcile.side_effect = [('tenant2', 2, 1),
+                                                 ('tenant3', 1, 0)]
+
+        counts = self.task.process()
+
+        self.assertEqual({'tenants': 3, 'corrected': 1}, counts)
+        self.assertEqual([((2,), {'after': None}),
+                          ((2,), {'after': 'tenant2'})],
+                         self.usage_repo.reconcile.call_args_list)
+        self.assertEqual(1, mock_sleep.call_count)
+
+    @patch('barbican.tasks.resources.sleep')
+    @patch('barbican.model.repositories.get_shard_map')
+    def test_should_reconcile_each_shard(self, mock_get_shard_map,
+                                         mock_sleep):
+        mock_get_shard_map.return_value.shards = [
+            repositories.Shard('default'),
+            repositories.Shard('other', 'sqlite://')]
+        self.usage_repo.reconcile.return_value = (None, 0, 0)
+
+        self.task.process()
+
+        self.assertEqual(2, self.usage_repo.reconcile.call_count)
+
+    def test_should_read_options_once_configuration_is_parsed(self):
+        # Note: A group named 'usage' would be hidden by ConfigOpts.usage.
+        conf = cfg.ConfigOpts()
+        conf.register_group(usage_opt_group)
+        conf.register_opts(usage_opts, usage_opt_group)
+
+        conf([])
+
+        self.assertEqual(86400, conf.tenant_usage.interval)
+
 
 if __name__ == '__main__':
     unittest.main()
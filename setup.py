@@ -71,7 +71,8 @@ setup(
         'Programming Language :: Python :: 2.7',
         'Environment :: No Input/Output (Daemon)',
     ],
-    scripts=['bin/barbican-api'],
+    scripts=['bin/barbican-api', 'bin/barbican-db-manage',
+             'bin/barbican-tenant-shard', 'bin/barbican-periodic-worker'],
     py_modules=[],
     entry_points="""
     [barbican.crypto.extension]
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares the per-lookup cost of the repositories' cached lookup queries
+with building and compiling the same Query on every call, against an
+in-memory SQLite database.
+
+Usage: python tools/bench_lookups.py [iterations]
+"""
+
+import sys
+import timeit
+
+from barbican.model import models
+from barbican.model import repositories
+
+
+def main(iterations):
+    repositories.CONF.set_override('sql_connection', 'sqlite://')
+    repositories.configure_db()
+
+    repo = repositories.TenantRepo()
+    tenant = repo.create_or_get('keystone1234')
+
+    def uncached():
+        repositories.get_session().query(models.Tenant)\
+            .filter_by(id=tenant.id).filter_by(deleted=False).one()
+
+    def cached():
+        repo.get(tenant.id)
+
+    uncached_cost = min(timeit.repeat(uncached, number=iterations,
+                                      repeat=3))
+    cached_cost = min(timeit.repeat(cached, number=iterations, repeat=3))
+    print('Tenant lookup: {0:.0f}us uncached, {1:.0f}us cached, '
+          'speedup {2:.2f}x'.format(uncached_cost * 1e6 / iterations,
+                                    cached_cost * 1e6 / iterations,
+                                    uncached_cost / cached_cost))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares the per-response cost of the API serializers with the generic
+to_dict_fields() and jsonutils path they replace.
+
+Usage: python tools/bench_serializers.py [iterations]
+"""
+
+import datetime
+import sys
+import timeit
+
+from barbican.api import serializers
+from barbican.common import utils
+from barbican.crypto.mime_types import augment_fields_with_content_types
+from barbican.model.models import EncryptedDatum, Secret
+from barbican.openstack.common import jsonutils
+
+
+TENANT_ID = 'keystone1234'
+
+
+def _json_handler(obj):
+    return obj.isoformat() if hasattr(obj, 'isoformat') else obj
+
+
+def _make_secrets(count):
+    secrets = []
+    for idx in xrange(count):
+        secret = Secret({'name': 'name{0}'.format(idx),
+                         'mime_type': 'text/plain',
+                         'expiration': datetime.datetime.utcnow(),
+                         'algorithm': 'AES',
+                         'bit_length': 256,
+                         'cypher_type': 'CBC'})
+        secret.id = 'idsecret{0}'.format(idx)
+        secret.created_at = secret.updated_at = datetime.datetime.utcnow()
+        datum = EncryptedDatum()
+        datum.mime_type = 'text/plain'
+        secret.encrypted_data = [datum]
+        secrets.append(secret)
+    return secrets
+
+
+def generic_list(secrets):
+    listing = []
+    for secret in secrets:
+        fields = augment_fields_with_content_types(secret)
+        fields['secret_ref'] = utils.hostname_for_refs(
+            tenant_id=TENANT_ID, resource='secrets/' + secret.id)
+        listing.append(fields)
+    return jsonutils.dumps({'secrets': listing}, default=_json_handler)
+
+
+def serializer_list(secrets):
+    serializer = serializers.SecretSerializer(TENANT_ID)
+    return serializers.dumps({'secrets': [serializer.to_dict(secret)
+                                          for secret in secrets]})
+
+
+def main(iterations):
+    print('JSON encoder: {0} (C accelerated: {1})'.format(
+        serializers.json.__name__,
+        serializers.json.encoder.c_make_encoder is not None))
+
+    for count in (1, 10, 100):
+        secrets = _make_secrets(count)
+        generic = min(timeit.repeat(lambda: generic_list(secrets),
+                                    number=iterations, repeat=3))
+        serializer = min(timeit.repeat(lambda: serializer_list(secrets),
+                                       number=iterations, repeat=3))
+        print('{0:>4} secrets/response: generic {1:8.1f}us, '
+              'serializer {2:8.1f}us, speedup {3:.2f}x'.format(
+                  count,
+                  generic * 1e6 / iterations,
+                  serializer * 1e6 / iterations,
+                  generic / serializer))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)